@@ -245,6 +245,9 @@ def updateObjectProperties( c ):
         if not hasattr(c, 'lockRotation'):
             debugPrint(3,'updating properties of %s, to add lockRotation (default=false)' % c.Name )
             c.addProperty("App::PropertyBool","lockRotation","ConstraintInfo")
+        if not hasattr(c, 'axisDistance'):
+            debugPrint(3,'updating properties of %s, to add axisDistance (default=0)' % c.Name )
+            c.addProperty("App::PropertyDistance","axisDistance","ConstraintInfo")
     if FreeCAD.GuiUp:
         if not isinstance( c.ViewObject.Proxy , ConstraintViewProviderProxy):
             iconPaths = {
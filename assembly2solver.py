@@ -23,8 +23,10 @@ import time, numpy
 from numpy import pi, inf
 from numpy.linalg import norm
 from solverLib import *
-from variableManager import VariableManager
+from variableManager import VariableManager, SubElementTable
 from constraintSystems import *
+from globalConstraintSystem import GlobalConstraintSystem
+import solverTelemetry
 import traceback
 
 def constraintsObjectsAllExist( doc ):
@@ -57,12 +59,264 @@ def findBaseObject( doc, objectNames  ):
         debugPrint( 1, 'assembly 2 solver: assigning %s, %s a fixed position' % (objectNames[0], doc.getObject(objectNames[0]).Label))
         return objectNames[0]
 
-def solveConstraints( doc, showFailureErrorDialog=True, printErrors=True, cache=None ):
+def constraintComponents( doc, constraintObjectQue, baseObjectName ):
+    '''
+    splits the constraints into independent groups, the connected components of the constraint graph, using union-find over Object1/Object2.
+    Fixed objects (and the base object) are treated as cut points, as they are not moved by the solver and therefore do not couple the constraints attached to them.
+    returns [ (fixedObjectName, constraintObjs), ... ] in tree order, where fixedObjectName is None for groups without a fixed object.
+    '''
+    def fixed( objName ):
+        return objName == baseObjectName or getattr( doc.getObject( objName ), 'fixedPosition', False )
+    parent = {}
+    def find( objName ):
+        while parent[objName] != objName:
+            parent[objName] = parent[ parent[objName] ]
+            objName = parent[objName]
+        return objName
+    for c in constraintObjectQue:
+        movable = [ objName for objName in [c.Object1, c.Object2] if not fixed(objName) ]
+        for objName in movable:
+            parent.setdefault( objName, objName )
+        if len(movable) == 2:
+            root1, root2 = find( movable[0] ), find( movable[1] )
+            if root1 != root2:
+                parent[root2] = root1
+    components = {}
+    keys = []
+    for c in constraintObjectQue:
+        movable = [ objName for objName in [c.Object1, c.Object2] if not fixed(objName) ]
+        key = find( movable[0] ) if len(movable) > 0 else c.Name #constraint between fixed objects
+        if not key in components:
+            components[key] = []
+            keys.append( key )
+        components[key].append( c )
+    groups = []
+    for key in keys:
+        fixedObjects = [ objName for c in components[key] for objName in [c.Object1, c.Object2] if fixed(objName) ]
+        if baseObjectName in fixedObjects:
+            groups.append( ( baseObjectName, components[key] ) )
+        else:
+            groups.append( ( fixedObjects[0] if len(fixedObjects) > 0 else None, components[key] ) )
+    return groups
+
+maxDegreesOfFreedomRemoved = { AxisAlignmentUnion:2, AngleUnion:1, AxisDistanceUnion:2, PlaneOffsetUnion:1, LockRelativeAxialRotationUnion:1, VertexUnion:3 }
+
+solveOrderCache = {} #doc.Name : { signature : constraint names in solve order }, see solveOrder
+
+def solveOrder( doc, constraintObjs, baseObjectName ):
+    '''
+    reorders the constraints of a component (see constraintComponents) before the heirachy is built, so that
+      - each object is added to the system with all its constraints to the objects already in the system, before other objects are added (minimizing the degrees-of-freedom fan-out),
+      - the first constraint attaching an object finds it free, so that the unions analyticalSolutions are applicable (i.e. AxisAlignmentUnion with free rotation, VertexUnion with free translation).
+    Greedy, each step taking the first constraint (in doc.Objects order) of
+      1. constraints between objects already in the system,
+      2. constraints adding the object whose constraints to the system remove the most degrees-of-freedom (see maxDegreesOfFreedomRemoved), starting with the constraint which removes the most,
+      3. otherwise the first remaining constraint (free objects, see AddFreeObjectsUnion).
+    The order is deterministic, and cached per document so that repeat solves of an unchanged constraint queue skip the planning.
+    '''
+    fixed = lambda objName: objName == baseObjectName or getattr( doc.getObject(objName), 'fixedPosition', False )
+    signature = ( baseObjectName, tuple( ( c.Name, c.Type, c.Object1, c.SubElement1, c.Object2, c.SubElement2, getattr(c, 'lockRotation', False), fixed(c.Object1), fixed(c.Object2) ) for c in constraintObjs ) )
+    cached = solveOrderCache.get( doc.Name )
+    if cached != None and signature in cached:
+        order = cached[signature]
+        debugPrint( 4, 'solveOrder: using cached solve order' )
+    else:
+        dofsRemoved = dict( ( c.Name, sum( maxDegreesOfFreedomRemoved[ConstraintSystemClass] for ConstraintSystemClass, constraintValue in constraintUnions(c) ) ) for c in constraintObjs )
+        placed = set( objName for c in constraintObjs for objName in [c.Object1, c.Object2] if fixed(objName) )
+        remaining = list( constraintObjs )
+        order = []
+        while len(remaining) > 0:
+            closing = [ c for c in remaining if c.Object1 in placed and c.Object2 in placed ]
+            if len(closing) > 0:
+                c = closing[0]
+            else:
+                attaching = {} #new objName : [ degrees-of-freedom removed, index of first constraint ]
+                for i, c in enumerate(remaining):
+                    if ( c.Object1 in placed ) != ( c.Object2 in placed ):
+                        objName = c.Object2 if c.Object1 in placed else c.Object1
+                        attaching.setdefault( objName, [0, i] )[0] += dofsRemoved[c.Name]
+                if len(attaching) > 0:
+                    objName = min( attaching, key=lambda objName: ( -min( attaching[objName][0], 6 ), attaching[objName][1] ) )
+                    candidates = [ c for c in remaining if objName in (c.Object1, c.Object2) and ( c.Object1 in placed or c.Object2 in placed ) ]
+                    c = max( candidates, key=lambda c: dofsRemoved[c.Name] ) #first of the constraints removing the most degrees-of-freedom
+                else:
+                    c = remaining[0]
+            remaining.remove(c)
+            placed.update( [c.Object1, c.Object2] )
+            order.append( c.Name )
+        if cached == None or len(cached) >= 64: #limit cache size, i.e. when constraints are being edited
+            cached = solveOrderCache[doc.Name] = {}
+        cached[signature] = order
+    constraintObjs_byName = dict( (c.Name, c) for c in constraintObjs )
+    reordered = [ constraintObjs_byName[name] for name in order ]
+    if reordered != list(constraintObjs):
+        debugPrint( 3, 'solveOrder: constraints reordered to %s' % ', '.join( order ) )
+    return reordered
+
+rigidPairsCache = {} #doc.Name : { signature : { key : (R_rel, p_rel) } of the rigid pairs }, see rigidPairs
+
+def rigidPairs( doc, constraintObjs, subElements=None, telemetry=None ):
+    '''
+    finds the pairs of objects whose relative placement is fully constrained by the constraints between them, for example a circularEdge with lockRotation plus a plane.
+    The constraints of each pair are solved in isolation with the first object fixed, starting from the current placements; the pair is rigid if no degrees-of-freedom remain.
+    Which pairs are rigid, and their relative placements, are cached per document (as for solveOrder), so that repeat solves do not solve any pairs.
+    The relative placements are taken from the current placements if they satisfy the constraints of the pair, otherwise from the cache if those satisfy the constraints (checked in case the subelements changed),
+    and otherwise from the solution of the pair.
+    returns { frozenset([obj1Name, obj2Name]) : (pairConstraints, obj1Name, obj2Name, R_rel, p_rel) }, where obj2's placement = obj1's placement * ( R_rel, p_rel )
+    subElements - SubElementTable of the constraintObjs, shared with the variableManagers of the pairs as the subelements relative positions are the same.
+    telemetry - SolverTelemetry recording the pair solves (solverTelemetry.active if None), so their counters and times are included in the solve's totals
+    '''
+    fixed = lambda objName: getattr( doc.getObject(objName), 'fixedPosition', False )
+    signature = tuple( ( c.Name, c.Object1, c.SubElement1, c.Object2, c.SubElement2, tuple( ( ConstraintSystemClass.label, constraintValue ) for ConstraintSystemClass, constraintValue in constraintUnions(c) ), fixed(c.Object1), fixed(c.Object2) ) for c in constraintObjs )
+    pairs = {}
+    for c in constraintObjs:
+        key = frozenset([ c.Object1, c.Object2 ])
+        if len(key) == 2:
+            pairs.setdefault( key, [] ).append( c )
+    cached = rigidPairsCache.get( doc.Name )
+    if cached != None and signature in cached:
+        candidates = list( cached[signature].keys() )
+        debugPrint( 4, 'rigidPairs: using cached rigid pairs' )
+    else:
+        candidates = [ key for key, pairConstraints in pairs.items()
+                       if sum( maxDegreesOfFreedomRemoved[ConstraintSystemClass] for c in pairConstraints for ConstraintSystemClass, constraintValue in constraintUnions(c) ) >= 6
+                       and not all( fixed(objName) for objName in key ) ]
+    rigid = {}
+    for key in candidates:
+        pairConstraints = pairs[key]
+        obj1Name, obj2Name = pairConstraints[0].Object1, pairConstraints[0].Object2
+        vM = VariableManager( doc, [obj1Name, obj2Name] )
+        vM.subElements = subElements
+        if cached != None and signature in cached and not pairSatisfied( vM, pairConstraints ): #try the cached relative placement before solving the pair
+            R_rel, p_rel = cached[signature][key]
+            R1 = azimuth_elevation_rotation_matrix( *vM.X[3:6] )
+            vM.X[6:9] = vM.X[0:3] + dotProduct( R1, p_rel )
+            vM.X[9:12] = azimuth_elevation_rotation_angles( dotProduct( R1, R_rel ) )
+        if not ( cached != None and signature in cached and pairSatisfied( vM, pairConstraints ) ):
+            pairSystem, failedConstraintObj = addConstraints( FixedObjectSystem( vM, obj1Name ), vM, pairConstraints, telemetry if telemetry != None else solverTelemetry.active, printErrors=False )
+            if failedConstraintObj != None or len( pairSystem.degreesOfFreedom ) > 0:
+                continue
+        R1 = azimuth_elevation_rotation_matrix( *vM.X[3:6] )
+        R2 = azimuth_elevation_rotation_matrix( *vM.X[9:12] )
+        R_rel = dotProduct( R1.transpose(), R2 )
+        p_rel = dotProduct( R1.transpose(), vM.X[6:9] - vM.X[0:3] )
+        rigid[key] = ( pairConstraints, obj1Name, obj2Name, R_rel, p_rel )
+    if cached == None or len(cached) >= 64: #limit cache size, i.e. when constraints are being edited
+        cached = rigidPairsCache[doc.Name] = {}
+    cached[signature] = dict( ( key, rigid[key][3:] ) for key in rigid )
+    debugPrint( 3, 'solveConstraints: %i rigid pairs of objects' % len(rigid) )
+    return rigid
+
+def pairSatisfied( variableManager, pairConstraints ):
+    'True if the current placements of variableManager satisfy the constraint equations of pairConstraints'
+    for c in pairConstraints:
+        for ConstraintSystemClass, constraintValue in constraintUnions(c):
+            if ConstraintSystemClass == LockRelativeAxialRotationUnion: #removes a degree-of-freedom, rather than adding a constraint equation
+                continue
+            union = ConstraintSystemClass( None, variableManager, c, constraintValue )
+            if abs( union.constraintEq_value( variableManager.X ) ) > union.solveConstraintEq_tol:
+                return False
+    return True
+
+def addRigidPair( constraintSystem, variableManager, rigidPair ):
+    '''
+    adds rigidPair to the heiracical constraint system as a RigidClusterUnion.
+    returns None if not applicable (both objects already in the constraint system, or the member object is fixed), in which case the constraints are to be added individually.
+    '''
+    pairConstraints, obj1Name, obj2Name, R_rel, p_rel = rigidPair
+    fixed = lambda objName: getattr( variableManager.doc.getObject(objName), 'fixedPosition', False )
+    contains1 = constraintSystem.containtsObject( obj1Name )
+    contains2 = constraintSystem.containtsObject( obj2Name )
+    if contains1 and contains2:
+        return None
+    if contains2 or ( not contains1 and fixed(obj2Name) ): #obj2 as root
+        rootName, memberName, R_rel, p_rel = obj2Name, obj1Name, R_rel.transpose(), -dotProduct( R_rel.transpose(), p_rel )
+    else:
+        rootName, memberName = obj1Name, obj2Name
+    if fixed( memberName ):
+        return None
+    if not contains1 and not contains2:
+        constraintSystem = AddFreeObjectsUnion( constraintSystem, variableManager, pairConstraints[0] )
+    return RigidClusterUnion( constraintSystem, variableManager, pairConstraints, rootName, memberName, R_rel, p_rel )
+
+def addConstraints( constraintSystem, variableManager, constraintObjs, telemetry, cache=None, printErrors=True, rigid={}, conflicts=None ):
+    '''
+    adds constraintObjs one at a time to the heiracical constraint system.
+    rigid - rigid pairs of objects (see rigidPairs), added as a single RigidClusterUnion when the first of their constraints is reached.
+    conflicts - if not None, extended with the minimal set of contradicting constraints when the conflict pre-check fails (see ConstraintSystemPrototype.checkForConflicts)
+    telemetry - SolverTelemetry recording the solve, which is made solverTelemetry.active while the constraints are added, and attached to the Assembly2SolverError of a failed constraint
+    returns constraintSystem, failedConstraintObj (None if all the constraints were solved)
+    '''
+    previous = solverTelemetry.activate( telemetry ) #so that the counters of the unions are recorded alongside the times
+    try:
+        rigidAdded = []
+        for constraintObj in constraintObjs:
+            debugPrint( 3, '  parsing %s, type:%s' % (constraintObj.Name, constraintObj.Type ))
+            t_constraint_start = time.time()
+            try:
+                cArgs = [variableManager, constraintObj]
+                key = frozenset([ constraintObj.Object1, constraintObj.Object2 ])
+                if key in rigidAdded:
+                    continue
+                if key in rigid:
+                    rigidClusterUnion = addRigidPair( constraintSystem, variableManager, rigid[key] )
+                    if rigidClusterUnion != None:
+                        constraintSystem = rigidClusterUnion
+                        rigidAdded.append( key )
+                        telemetry.addTime( 'unionClass', RigidClusterUnion.label, time.time() - t_constraint_start )
+                        telemetry.addTime( 'constraint', constraintObj.Name, time.time() - t_constraint_start )
+                        continue
+                if not constraintSystem.containtsObject( constraintObj.Object1) and not constraintSystem.containtsObject( constraintObj.Object2):
+                    t_union_start = time.time()
+                    constraintSystem = AddFreeObjectsUnion(constraintSystem, *cArgs)
+                    telemetry.addTime( 'unionClass', AddFreeObjectsUnion.label, time.time() - t_union_start )
+                for ConstraintSystemClass, constraintValue in constraintUnions( constraintObj ):
+                    t_union_start = time.time()
+                    constraintSystem = ConstraintSystemClass( constraintSystem, *cArgs, constraintValue=constraintValue )
+                    telemetry.addTime( 'unionClass', ConstraintSystemClass.label, time.time() - t_union_start )
+                telemetry.addTime( 'constraint', constraintObj.Name, time.time() - t_constraint_start )
+                if cache:
+                    cache.record_levels.append( constraintSystem.numberOfParentSystems() )
+            except Assembly2SolverError as e:
+                if printErrors:
+                    FreeCAD.Console.PrintError('UNABLE TO SOLVE CONSTRAINTS! info:')
+                    FreeCAD.Console.PrintError(e)
+                if conflicts != None and isinstance( e, ConflictingConstraintsError ):
+                    conflicts.extend( e.constraintObjs )
+                e.telemetry = telemetry
+                return constraintSystem, constraintObj
+            except:
+                if printErrors:
+                    FreeCAD.Console.PrintError('UNABLE TO SOLVE CONSTRAINTS! info:')
+                    FreeCAD.Console.PrintError( traceback.format_exc())
+                return constraintSystem, constraintObj
+        return constraintSystem, None
+    finally:
+        solverTelemetry.activate( previous )
+
+def solveConstraints( doc, showFailureErrorDialog=True, printErrors=True, cache=None, engine=None, rigidClusters=True, planSolveOrder=True, conflicts=None, objName=None, updatePlacements=True ):
+    '''
+    engine - 'hierarchical' (constraints added one at a time, see constraintSystems.py) or 'global' (all constraints solved simultaneously, see globalConstraintSystem.py).
+             if None, the engine is set according to the useGlobalSolver preference. The hierarchical engine is used if any constraint has lockRotation set, or if the global engine fails.
+             The engine which solved the constraints is recorded as the engine attribute of the returned system.
+    rigidClusters - collapse rigidly constrained pairs of objects into a single RigidClusterUnion (hierarchical engine without cache only, see rigidPairs)
+    planSolveOrder - reorder the constraints of each group before building the heirachy, rather than using the doc.Objects order (hierarchical engine without cache only, see solveOrder)
+    conflicts - if not None, extended with the constraints found to contradict each other by the conflict pre-check, when the solver fails (see addConstraints)
+    objName - if not None, only the independent group of constraints containing objName is solved, which must be constrained (hierarchical engine without cache only, see dragSolver.DragSolver)
+    updatePlacements - if False, the solved placements are only kept in the returned system's variableManager, and the FreeCAD placements are left unchanged
+    '''
     if not constraintsObjectsAllExist(doc):
         return
+    if engine == None:
+        preferences = FreeCAD.ParamGet("User parameter:BaseApp/Preferences/Mod/Assembly2")
+        engine = 'global' if preferences.GetBool('useGlobalSolver', False) else 'hierarchical'
     T_start = time.time()
+    telemetry = solverTelemetry.start()
     updateOldStyleConstraintProperties(doc)
     constraintObjectQue = [ obj for obj in doc.Objects if 'ConstraintInfo' in obj.Content ]
+    if engine == 'global' and any( getattr( c, 'lockRotation', False ) for c in constraintObjectQue ):
+        FreeCAD.Console.PrintMessage('assembly2 solver: lockRotation is not supported by the global engine, using the hierarchical engine instead\n')
+        engine = 'hierarchical'
     #doc.Objects already in tree order so no additional sorting / order checking required for constraints.
     objectNames = []
     for c in constraintObjectQue:
@@ -72,58 +326,62 @@ def solveConstraints( doc, showFailureErrorDialog=True, printErrors=True, cache=
                 objectNames.append( objectName )
     variableManager = VariableManager( doc, objectNames )
     debugPrint(3,' variableManager.X0 %s' % variableManager.X0 )
-    constraintSystem = FixedObjectSystem( variableManager, findBaseObject(doc, objectNames) )
-    debugPrint(4, 'solveConstraints base system: %s' % constraintSystem.str() )
-    
-
+    t_subElements_start = time.time()
+    variableManager.subElements = SubElementTable( variableManager, constraintObjectQue, constraintUnions )
+    debugPrint(4,'  time to build subelement table %3.2fs' % (time.time() - t_subElements_start) )
     solved = True
-    if cache != None:
-        t_cache_start = time.time()
-        constraintSystem, que_start = cache.retrieve( constraintSystem, constraintObjectQue)
-        debugPrint(3,"~cached solution available for first %i out-off %i constraints (retrieved in %3.2fs)" % (que_start, len(constraintObjectQue), time.time() - t_cache_start ) )
-    else:
-        que_start = 0
-
-    for constraintObj in constraintObjectQue[que_start:]:
-        debugPrint( 3, '  parsing %s, type:%s' % (constraintObj.Name, constraintObj.Type ))
+    if conflicts == None:
+        conflicts = [] #contradicting constraints found by the conflict pre-check
+    if engine == 'global':
+        cache = None #cache only applicable to the hierarchical constraint system
+        constraintSystem = GlobalConstraintSystem( variableManager, findBaseObject(doc, objectNames), constraintObjectQue )
+        t_solve_start = time.time()
         try:
-            cArgs = [variableManager, constraintObj]
-            if not constraintSystem.containtsObject( constraintObj.Object1) and not constraintSystem.containtsObject( constraintObj.Object2):
-                constraintSystem = AddFreeObjectsUnion(constraintSystem, *cArgs)
-            if constraintObj.Type == 'plane':
-                if constraintObj.SubElement2.startswith('Face'): #otherwise vertex
-                    constraintSystem = AxisAlignmentUnion(constraintSystem, *cArgs,  constraintValue = constraintObj.directionConstraint )
-                constraintSystem = PlaneOffsetUnion(constraintSystem,  *cArgs, constraintValue = constraintObj.offset.Value)
-            elif constraintObj.Type == 'angle_between_planes':
-                constraintSystem = AngleUnion(constraintSystem,  *cArgs, constraintValue = constraintObj.angle.Value*pi/180 )
-            elif constraintObj.Type == 'axial':
-                constraintSystem = AxisAlignmentUnion(constraintSystem,  *cArgs, constraintValue = constraintObj.directionConstraint)
-                constraintSystem =  AxisDistanceUnion(constraintSystem,  *cArgs, constraintValue = 0)
-                if constraintObj.lockRotation: constraintSystem =  LockRelativeAxialRotationUnion(constraintSystem,  *cArgs, constraintValue = 0)
-            elif constraintObj.Type == 'circularEdge':
-                constraintSystem = AxisAlignmentUnion(constraintSystem,  *cArgs, constraintValue=constraintObj.directionConstraint)
-                constraintSystem = AxisDistanceUnion(constraintSystem,  *cArgs, constraintValue=0)
-                constraintSystem = PlaneOffsetUnion(constraintSystem,  *cArgs, constraintValue=constraintObj.offset.Value)
-                if constraintObj.lockRotation: constraintSystem =  LockRelativeAxialRotationUnion(constraintSystem,  *cArgs, constraintValue = 0)
-            elif constraintObj.Type == 'sphericalSurface':
-                constraintSystem = VertexUnion(constraintSystem,  *cArgs, constraintValue=0)
-            else:
-                raise NotImplementedError('constraintType %s not supported yet' % constraintObj.Type)
-            if cache:
-                cache.record_levels.append( constraintSystem.numberOfParentSystems() )
-        except Assembly2SolverError as e:
-            if printErrors:
-                FreeCAD.Console.PrintError('UNABLE TO SOLVE CONSTRAINTS! info:')
-                FreeCAD.Console.PrintError(e)
-            solved = False
-            break
+            constraintSystem.solve()
+            constraintSystem.determineDegreesOfFreedom()
+            telemetry.addTime( 'unionClass', constraintSystem.label, time.time() - t_solve_start )
         except:
-            if printErrors:
-                FreeCAD.Console.PrintError('UNABLE TO SOLVE CONSTRAINTS! info:')
-                FreeCAD.Console.PrintError( traceback.format_exc())
-            solved = False
-            break
+            failedConstraint = getattr( constraintSystem, 'failedConstraint', None )
+            FreeCAD.Console.PrintMessage('assembly2 solver: the global engine failed%s, using the hierarchical engine instead\n' % ( ' to satisfy "%s"' % failedConstraint.constraintObj.Name if failedConstraint != None else '' ))
+            debugPrint(3, traceback.format_exc() )
+            telemetry.addTime( 'unionClass', constraintSystem.label, time.time() - t_solve_start )
+            variableManager.X[:] = variableManager.X0
+            engine = 'hierarchical'
+    if engine == 'hierarchical':
+        baseObjectName = findBaseObject(doc, objectNames)
+        if cache != None: #cached solutions are recorded for a single constraint system
+            components = [ ( baseObjectName, constraintObjectQue ) ]
+            rigid = {}
+        else:
+            components = constraintComponents( doc, constraintObjectQue, baseObjectName )
+            debugPrint(3, 'solveConstraints: %i independent groups of constraints' % len(components) )
+            if objName != None:
+                components = [ ( componentBaseObjectName, componentQue ) for componentBaseObjectName, componentQue in components if any( objName in [c.Object1, c.Object2] for c in componentQue ) ]
+            if planSolveOrder:
+                components = [ ( componentBaseObjectName, solveOrder( doc, componentQue, componentBaseObjectName ) ) for componentBaseObjectName, componentQue in components ]
+            componentConstraints = sum( [ componentQue for componentBaseObjectName, componentQue in components ], [] )
+            rigid = rigidPairs( doc, [ c for c in constraintObjectQue if c in componentConstraints ], variableManager.subElements, telemetry ) if rigidClusters else {}
+        systems = []
+        for componentBaseObjectName, componentQue in components:
+            constraintSystem = FixedObjectSystem( variableManager, componentBaseObjectName ) if componentBaseObjectName != None else EmptySystem()
+            debugPrint(4, 'solveConstraints base system: %s' % constraintSystem.str() )
+            if cache != None:
+                t_cache_start = time.time()
+                constraintSystem, que_start = cache.retrieve( constraintSystem, constraintObjectQue)
+                debugPrint(3,"~cached solution available for first %i out-off %i constraints (retrieved in %3.2fs)" % (que_start, len(constraintObjectQue), time.time() - t_cache_start ) )
+            else:
+                que_start = 0
+            constraintSystem, constraintObj = addConstraints( constraintSystem, variableManager, componentQue[que_start:], telemetry, cache, printErrors, rigid, conflicts )
+            if constraintObj != None: #failed to solve constraintObj
+                solved = False
+                break
+            systems.append( constraintSystem )
+        if solved and len(systems) > 1:
+            constraintSystem = DisjointSystems( variableManager, systems )
+    telemetry.finish()
     if solved:
+        constraintSystem.telemetry = telemetry
+        constraintSystem.engine = engine
         debugPrint(4,'placement X %s' % constraintSystem.variableManager.X )
 
         t_cache_record_start = time.time()
@@ -131,18 +389,20 @@ def solveConstraints( doc, showFailureErrorDialog=True, printErrors=True, cache=
             cache.record( constraintSystem, constraintObjectQue, que_start)
         debugPrint( 4,'  time cache.record %3.2fs' % (time.time()-t_cache_record_start) )
 
-        t_update_freecad_start = time.time()
-        variableManager.updateFreeCADValues( constraintSystem.variableManager.X )
-        debugPrint( 4,'  time to update FreeCAD placement variables %3.2fs' % (time.time()-t_update_freecad_start) )
+        if updatePlacements:
+            t_update_freecad_start = time.time()
+            variableManager.updateFreeCADValues( constraintSystem.variableManager.X )
+            debugPrint( 4,'  time to update FreeCAD placement variables %3.2fs' % (time.time()-t_update_freecad_start) )
 
         debugPrint(2,'Constraint system solved in %2.2fs; resulting system has %i degrees-of-freedom' % (time.time()-T_start, len( constraintSystem.degreesOfFreedom)))
+        debugPrint(4,'solver telemetry %s' % telemetry.toJSON( indent=2 ))
     elif showFailureErrorDialog and  QtGui.qApp != None: #i.e. GUI active
         # http://www.blog.pythonlibrary.org/2013/04/16/pyside-standard-dialogs-and-message-boxes/
         flags = QtGui.QMessageBox.StandardButton.Yes 
         flags |= QtGui.QMessageBox.StandardButton.No
         #flags |= QtGui.QMessageBox.Ignore
         message = """The assembly2 solver failed to satisfy the constraint "%s".
-
+%s
 possible causes
   - impossible/contridictorary constraints have be specified, or  
   - the contraint problem is too difficult for the solver, or 
@@ -153,7 +413,7 @@ potential solutions
   - delete constraint, and try again using a different constraint scheme.
 
 Delete constraint "%s"?
-""" % (constraintObj.Name, constraintObj.Name)
+""" % (constraintObj.Name, '\nthe constraints %s contradict each other.\n' % ', '.join( '"%s"' % c.Name for c in conflicts ) if len(conflicts) > 0 else '', constraintObj.Name)
         response = QtGui.QMessageBox.critical(QtGui.qApp.activeWindow(), "Solver Failure!", message, flags)
         if response == QtGui.QMessageBox.Yes:
             removeConstraint( constraintObj )
@@ -185,12 +445,17 @@ FreeCADGui.addCommand('assembly2SolveConstraints', Assembly2SolveConstraintsComm
 
 
 if __name__ == '__main__':
-    import glob, argparse, time
+    import glob, argparse, time, os
     print('Testing assembly 2 solver on assemblies under tests/')
     parser = argparse.ArgumentParser(description="Test assembly 2 solver.")
     parser.add_argument('--lastTestCaseOnly', action='store_true')
     parser.add_argument('--doNotTestCache', action='store_true')
+    parser.add_argument('--numericalSolver', choices=['newton','levenberg_marquardt'], default='newton')
+    parser.add_argument('--compareNumericalSolvers', action='store_true', help='solve each test case with each numerical solver and print a comparison')
+    parser.add_argument('--engine', choices=['hierarchical','global'], default='hierarchical')
+    parser.add_argument('--timeUpdates', action='store_true', help='time 20 updates of the degrees-of-freedom of each solved test case')
     args = parser.parse_args()
+    ConstraintSystemPrototype.numericalSolver = args.numericalSolver
 
     if args.doNotTestCache:
         solverCache = None
@@ -201,24 +466,123 @@ if __name__ == '__main__':
     debugPrint.level = 4
     t_solver = 0
     t_cache = 0
+    t_updates = []
     t_start = time.time()
     testFiles = sorted(glob.glob('tests/*.fcstd')) 
     if args.lastTestCaseOnly:
         testFiles = testFiles[-1:]
+    expectedConflicts = { #test cases which should fail, and the constraints which should be reported as contradicting each other
+        'testAssembly19-bolted_stack_conflict.fcstd' : ['circularEdgeConstraint%02i' % i for i in range(1,15)] + ['planeConstraint01'], #only found if the unions of each circularEdge constraint are dropped together
+        }
+    compareEngines = { #test cases also solved with the global engine, which should give the same number of degrees-of-freedom, and the engine which then solves them
+        'testAssembly06.fcstd' : 'global',
+        'testAssembly08.fcstd' : 'hierarchical', #global solve not converged within GlobalConstraintSystem.maxIt, so the hierarchical engine is used instead
+        'testAssembly11-Pipe_assembly.fcstd' : 'hierarchical', #global solve stalls far from the initial placements
+        'testAssembly11b-Pipe_assembly.fcstd' : 'hierarchical', #global solve stalls far from the initial placements
+        'testAssembly13-spherical_surfaces_hip.fcstd' : 'global', #angles of 0, see AngleUnion.residualKernel
+        'testAssembly14-lock_relative_axial_rotation.fcstd' : 'hierarchical', #lockRotation
+        'testAssembly15-triangular-link-assembly.fcstd' : 'global',
+        'testAssembly21-axis_distance.fcstd' : 'global',
+        }
+    expectedDegreesOfFreedom = { #test cases whose degrees-of-freedom are known
+        'testAssembly21-axis_distance.fcstd' : 7, #non-zero axisDistance, i.e. parallel axes a distance apart, leaving the rotation about the other axis (4 if the axisDistance is ignored)
+        'testAssembly22-near_pole_spheres.fcstd' : 3,
+        }
+    analyticalCases = [ #test cases which should be solved without any numerical iterations (see solverTelemetry)
+        'testAssembly13-spherical_surfaces_cube_vertices.fcstd', #closed-form rotations about the pivot of a spherical joint, see VertexUnion.rotateAboutPivot
+        'testAssembly13-spherical_surfaces_hip.fcstd',
+        ]
+    localRotationCases = [ #test cases solved with local rotations (see degreesOfFreedom.LocalRotations), and also without for comparison
+        'testAssembly22-near_pole_spheres.fcstd', #rotation axes within 1e-7 of elevation -pi/2, only solved with local rotations
+        ]
+    rigidClusterCases = [ #test cases whose rigid pairs should be collapsed into RigidClusterUnions (when solved without the cache), giving the same degrees-of-freedom as without rigid clusters
+        'testAssembly20-bolted_chain.fcstd',
+        ]
+    if args.compareNumericalSolvers:
+        debugPrint.level = 1
+        numericalSolvers = ['newton','levenberg_marquardt']
+        t_totals = [ 0 for n in numericalSolvers ]
+        print('%-40s %-24s %-24s' % tuple( ['test case'] + numericalSolvers ))
+        for testFile in testFiles:
+            results = []
+            for j, numericalSolver in enumerate(numericalSolvers):
+                ConstraintSystemPrototype.numericalSolver = numericalSolver
+                doc =  FreeCAD.open(testFile)
+                t_start_solver = time.time()
+                constraintSystem = solveConstraints( doc, showFailureErrorDialog=False )
+                t_totals[j] = t_totals[j] + time.time() - t_start_solver
+                results.append( '%s %3.2fs' % ( 'solved' if constraintSystem != None else 'FAILED', time.time() - t_start_solver ) )
+                FreeCAD.closeDocument( doc.Name )
+            print('%-40s %-24s %-24s' % tuple( [testFile] + results ))
+        print('%-40s %-24s %-24s' % tuple( ['total'] + [ '%3.2fs' % t for t in t_totals ] ))
+        exit()
     for testFile in testFiles:
         print(testFile)
+        if os.path.basename(testFile) in compareEngines and args.engine == 'hierarchical':
+            doc = FreeCAD.open(testFile)
+            globalSystem = solveConstraints( doc, engine='global' )
+            dofs_global = len( globalSystem.degreesOfFreedom ) if globalSystem != None else None
+            FreeCAD.closeDocument( doc.Name )
+            if globalSystem == None or globalSystem.engine != compareEngines[os.path.basename(testFile)]:
+                print('Failed on %s, expected the %s engine to solve it when using the global engine, got %s' % (testFile, compareEngines[os.path.basename(testFile)], globalSystem.engine if globalSystem != None else None))
+                exit()
+        if os.path.basename(testFile) in rigidClusterCases and args.engine == 'hierarchical':
+            dofs_rigid = []
+            rigidClusterUnions = 0
+            for rigidClusters in [True, False]:
+                doc = FreeCAD.open(testFile)
+                constraintSystem = solveConstraints( doc, rigidClusters=rigidClusters )
+                dofs_rigid.append( len( constraintSystem.degreesOfFreedom ) if constraintSystem != None else None )
+                while rigidClusters and constraintSystem != None:
+                    rigidClusterUnions = rigidClusterUnions + isinstance( constraintSystem, RigidClusterUnion )
+                    constraintSystem = constraintSystem.parentSystem
+                FreeCAD.closeDocument( doc.Name )
+            if rigidClusterUnions == 0 or None in dofs_rigid or dofs_rigid[0] != dofs_rigid[1]:
+                print('Failed on %s, %i RigidClusterUnions, degrees-of-freedom with and without rigid clusters %s' % (testFile, rigidClusterUnions, dofs_rigid))
+                exit()
+        if os.path.basename(testFile) in localRotationCases:
+            doc = FreeCAD.open(testFile)
+            print('without local rotations: %s' % ( 'solved' if solveConstraints( doc, showFailureErrorDialog=False ) != None else 'FAILED' ))
+            FreeCAD.closeDocument( doc.Name )
+        ConstraintSystemPrototype.localRotations = os.path.basename(testFile) in localRotationCases
         doc =  FreeCAD.open(testFile)
         t_start_solver = time.time()
-        constraintSystem = solveConstraints( doc, cache=solverCache )
+        conflicts = []
+        constraintSystem = solveConstraints( doc, cache=solverCache, engine=args.engine, conflicts=conflicts )
         t_solver = t_solver + time.time() - t_start_solver
+        if os.path.basename(testFile) in expectedConflicts:
+            reported = sorted( c.Name for c in conflicts )
+            if constraintSystem != None or ( args.engine == 'hierarchical' and reported != sorted( expectedConflicts[os.path.basename(testFile)] ) ): #conflict pre-check only run by the hierarchical engine
+                print('Failed on %s, expected the conflicting constraints %s, reported %s' % (testFile, expectedConflicts[os.path.basename(testFile)], reported) )
+                exit()
+            print('\n\n\n')
+            continue
         if constraintSystem == None:
             print('Failed on %s' % testFile)
             exit()
+        if os.path.basename(testFile) in compareEngines and args.engine == 'hierarchical' and dofs_global != len( constraintSystem.degreesOfFreedom ):
+            print('Failed on %s, the global engine gave %s degrees-of-freedom rather than %i' % (testFile, dofs_global, len( constraintSystem.degreesOfFreedom )))
+            exit()
+        if os.path.basename(testFile) in analyticalCases and args.engine == 'hierarchical':
+            iterations = dict( ( key, constraintSystem.telemetry.counters.get( key, 0 ) ) for key in ['numericalSolutions', 'newtonIterations', 'levenbergMarquardtIterations'] )
+            if sum( iterations.values() ) > 0:
+                print('Failed on %s, expected no numerical iterations, telemetry counters %s' % (testFile, iterations))
+                exit()
+        if os.path.basename(testFile) in expectedDegreesOfFreedom and len( constraintSystem.degreesOfFreedom ) != expectedDegreesOfFreedom[os.path.basename(testFile)]:
+            print('Failed on %s, %i degrees-of-freedom rather than %i' % (testFile, len( constraintSystem.degreesOfFreedom ), expectedDegreesOfFreedom[os.path.basename(testFile)]))
+            exit()
+        if args.timeUpdates:
+            t_start_updates = time.time()
+            for k in range(20):
+                for d in constraintSystem.degreesOfFreedom:
+                    d.setValue( d.getValue() + 0.01 )
+                constraintSystem.update()
+            t_updates.append( ( testFile, len( constraintSystem.degreesOfFreedom ), time.time() - t_start_updates ) )
         if solverCache != None:
             print('\n\n')
             t_start_cache = time.time()
             solverCache.debugMode = 1
-            constraintSystem = solveConstraints( doc, cache=solverCache )
+            constraintSystem = solveConstraints( doc, cache=solverCache, engine=args.engine )
             solverCache.debugMode = 0
             t_cache = t_cache  + time.time() - t_start_cache 
             constraintSystem.update()
@@ -227,3 +591,5 @@ if __name__ == '__main__':
     print('   time assembly2 solver:  %3.2fs' % t_solver )
     print('   time cached solutions:  %3.2fs' % t_cache )
     print('   total running time:     %3.2fs' % (time.time() - t_start) )
+    for testFile, dofs, t in t_updates:
+        print('   20 updates of the %i degrees-of-freedom of %s: %3.2fs' % (dofs, testFile, t) )
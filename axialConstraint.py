@@ -41,6 +41,7 @@ def parseSelection(selection, objectToUpdate=None):
           c.addProperty("App::PropertyEnumeration","directionConstraint", "ConstraintInfo")
           c.directionConstraint = ["none","aligned","opposed"]
           c.addProperty("App::PropertyBool","lockRotation","ConstraintInfo")
+          c.addProperty("App::PropertyDistance","axisDistance","ConstraintInfo")
                          
           c.setEditorMode('Type',1)
           for prop in ["Object1","Object2","SubElement1","SubElement2"]:
@@ -94,9 +94,9 @@ class CacheInput:
         elif constraint.Type == 'angle_between_planes':
             self.constraintArgs = ( constraint.angle.Value )
         elif constraint.Type == 'axial':
-            self.constraintArgs = ( constraint.directionConstraint, constraint.lockRotation )
+            self.constraintArgs = ( constraint.directionConstraint, constraint.lockRotation, axisDistance(constraint) )
         elif constraint.Type == 'circularEdge':
-            self.constraintArgs = ( constraint.directionConstraint, constraint.offset.Value, constraint.lockRotation )
+            self.constraintArgs = ( constraint.directionConstraint, constraint.offset.Value, constraint.lockRotation, axisDistance(constraint) )
         elif  constraint.Type == 'sphericalSurface':
             self.constraintArgs = ()
         else:
@@ -113,9 +113,16 @@ class ShapeElementInfo:
         self.objName = objName
         obj = vM.doc.getObject( objName )
         self.category = classifySubElement( obj, elementName )
-        self.pos =  vM.rotateAndMoveUndo( objName, getSubElementPos( obj, elementName ), vM.X0 )
+        subElements = getattr( vM, 'subElements', None ) #see variableManager.SubElementTable
+        if subElements != None and subElements.hasSubElement( objName, elementName ):
+            self.pos = subElements.pos( objName, elementName )
+        else:
+            self.pos =  vM.rotateAndMoveUndo( objName, getSubElementPos( obj, elementName ), vM.X0 )
         if self.category in ['plane','cylindricalSurface','circularEdge','linearEdge']:
-            self.axis =  vM.rotateUndo( objName, getSubElementAxis( obj, elementName ), vM.X0 )
+            if subElements != None and subElements.hasSubElement( objName, elementName ):
+                self.axis = subElements.axis( objName, elementName )
+            else:
+                self.axis =  vM.rotateUndo( objName, getSubElementAxis( obj, elementName ), vM.X0 )
     def __eq__(self, b, tol = 10 **-5):
         if self.objName != b.objName:
             return False
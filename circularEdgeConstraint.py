@@ -41,6 +41,7 @@ def parseSelection(selection, objectToUpdate=None, callSolveConstraints=True, lo
         c.directionConstraint = ["none","aligned","opposed"]
         c.addProperty("App::PropertyDistance","offset","ConstraintInfo")
         c.addProperty("App::PropertyBool","lockRotation","ConstraintInfo").lockRotation = lockRotation
+        c.addProperty("App::PropertyDistance","axisDistance","ConstraintInfo")
     
         c.setEditorMode('Type',1)
         for prop in ["Object1","Object2","SubElement1","SubElement2"]:
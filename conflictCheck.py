@@ -0,0 +1,154 @@
+'''
+Conflicting constraints pre-check
+---------------------------------
+
+Test for constraints which contradict each other, run before a numerical solution whose constraint gradient vanishes (see ConstraintSystemPrototype.gradientVanishing),
+so that a minimal set of contradicting constraints is reported rather than only the constraint being added.
+
+At placement X, the constraint equations F(Y) = 0 are linearized as F + J dY = 0.
+The linearized equations have no solution if F has a component F_perp orthogonal to the range of J.
+This is the case for constraints whose equations are dependent, but whose values disagree (e.g. 2 plane offsets between the same parallel faces).
+The constraints with residuals in F_perp are then reduced to a minimal set using a deletion filter, where each constraint object is dropped in turn if the remaining constraints are still inconsistent.
+
+The linearization can also be inconsistent at singular placements of consistent constraints (e.g. an angle constraint at 0 degrees, where the gradient of the cosine is zero).
+The minimal set is therefore solved on its own, using the heirachical constraint system without continuation or nested pre-checks (see solvable).
+The cost of this confirmation depends on the size of the minimal set rather than on the assembly, and if it fails the conflict is reported straight away,
+without spending the numerical solution of the full system on it.
+
+Nomeclature as in constraintSystems.py, with
+Y - placement variables of the non-fixed objects of the constraints checked
+'''
+
+import numpy
+from numpy.linalg import norm
+from solverLib import GradientApproximatorCentralDifference
+from constraintArrays import ConstraintArrays
+
+class LinearizedConstraints:
+    '''
+    residuals F and Jacobian J of the constraint unions (detached, see ConstraintSystemPrototype.detachedUnions) at the placement X,
+    with respect to the placement variables of the objects not in fixedObjects.
+    The Jacobian is central differenced, with all the perturbed placements evaluated in a single pass of the constraint arrays.
+    '''
+    def __init__( self, variableManager, unions, fixedObjects, X ):
+        vM = variableManager
+        self.variableManager = vM
+        self.unions = unions
+        self.fixedObjects = fixedObjects
+        self.constraintArrays = ConstraintArrays( vM, unions )
+        self.objectNames = []
+        for c in unions:
+            for objName in [c.obj1Name, c.obj2Name]:
+                if not objName in fixedObjects and not objName in self.objectNames:
+                    self.objectNames.append( objName )
+        self.columns_X = numpy.array( sum( [ list( range( vM.index[objName], vM.index[objName] + 6 ) ) for objName in self.objectNames ], [] ), dtype=int )
+        self.X = numpy.array( X, dtype=float )
+        self.Y0 = self.X[ self.columns_X ]
+        self.F = self.f( self.Y0 )
+        if len( self.columns_X ) > 0:
+            self.J = self.grad_f( self.Y0 )
+        else:
+            self.J = numpy.zeros([ len(self.F), 0 ])
+
+    def f( self, Y ):
+        return self.f_batch( numpy.array([ Y ]) )[0]
+
+    def f_batch( self, Ys ):
+        Xs = numpy.tile( self.X, ( len(Ys), 1 ) )
+        Xs[:, self.columns_X ] = Ys
+        return self.constraintArrays.residuals( Xs )
+
+    def grad_f( self, Y ):
+        return GradientApproximatorCentralDifference( self.f_batch, batch=True )( Y ).reshape( len(self.F), len(Y) )
+
+    def residualRows( self, k ):
+        'residual indices of the unions k'
+        rows = self.constraintArrays.rows
+        return numpy.concatenate( [ numpy.arange( rows[i], rows[i+1] ) for i in k ] ).astype( int )
+
+    def perpendicularResiduals( self, k, rcond=10**-6 ):
+        'component of the residuals of the unions k which the linearized equations of the unions k can not remove'
+        rows = self.residualRows( k )
+        J, F = self.J[rows], self.F[rows]
+        if J.shape[1] == 0:
+            return F
+        dY = numpy.linalg.lstsq( J, -F, rcond=rcond )[0]
+        return F + numpy.dot( J, dY )
+
+    def inconsistent( self, k, abs_tol=10**-6, rel_tol=10**-3 ):
+        F_perp = self.perpendicularResiduals( k )
+        return norm( F_perp ) > max( abs_tol, rel_tol * norm( self.F[ self.residualRows(k) ] ) )
+
+
+def conflictingConstraints( variableManager, unions, fixedObjects, X=None ):
+    '''
+    returns a minimal list of unions which can not be satisfied together, or [] if no conflict is detected.
+    The conflict is confirmed by solving the constraint objects of the minimal list on their own (see solvable).
+    The deletion filter drops all the unions of a constraint object together, as a conflict may depend on several unions of the same constraint object (i.e. a plane offset which can only be changed by tilting, if not for the axis alignment).
+    Conflicts which only show up away from X (i.e. nonlinear conflicts such as an axis distance greater than the length of a linkage) are not detected.
+    '''
+    X = variableManager.X if X is None else X
+    L = LinearizedConstraints( variableManager, unions, fixedObjects, X )
+    allUnions = list( range( len(unions) ) )
+    if len(unions) == 0 or not L.inconsistent( allUnions ):
+        return []
+    F_perp = L.perpendicularResiduals( allUnions )
+    rows = L.constraintArrays.rows
+    F_perp_norms = numpy.array([ norm( F_perp[ rows[i]:rows[i+1] ] ) for i in allUnions ])
+    groups = [] #unions of each constraint object, in order
+    for i, c in enumerate( unions ):
+        matches = [ g for g in groups if unions[g[0]].constraintObj is c.constraintObj ]
+        if len(matches) > 0:
+            matches[0].append( i )
+        else:
+            groups.append( [i] )
+    candidates = [ g for g in groups if F_perp_norms[g].max() > 10**-3 * F_perp_norms.max() ]
+    if not L.inconsistent( sum( candidates, [] ) ):
+        candidates = groups
+    for g in list( candidates ): #deletion filter
+        remaining = [ h for h in candidates if h is not g ]
+        if len(remaining) > 0 and L.inconsistent( sum( remaining, [] ) ):
+            candidates = remaining
+    minimal = [ unions[i] for i in sum( candidates, [] ) ]
+    constraintObjs = []
+    for c in minimal:
+        if not c.constraintObj in constraintObjs:
+            constraintObjs.append( c.constraintObj )
+    if solvable( variableManager, constraintObjs, fixedObjects, X ):
+        return []
+    return minimal
+
+def solvable( variableManager, constraintObjs, fixedObjects, X ):
+    '''
+    True if constraintObjs can be solved on their own, using a heirachical constraint system built from the placement X on a copy of variableManager's objects.
+    The constraints are added in the given order, i.e. the order of the heirachy the pre-check was run for, starting from the first of fixedObjects constrained by them.
+    The continuation solve (see ConstraintSystemPrototype.continuationSolution) and the conflict pre-check are disabled while doing so,
+    the first as it adds numerical solves which are only needed to reach far away solutions, the second as it would check the same constraints again.
+    '''
+    from constraintSystems import ConstraintSystemPrototype, FixedObjectSystem, EmptySystem, AddFreeObjectsUnion, Assembly2SolverError, constraintUnions
+    from variableManager import VariableManager
+    objectNames = []
+    for c in constraintObjs:
+        for objName in [c.Object1, c.Object2]:
+            if not objName in objectNames:
+                objectNames.append( objName )
+    vM = VariableManager( variableManager.doc, objectNames )
+    vM.subElements = getattr( variableManager, 'subElements', None )
+    for objName in objectNames:
+        vM.X[ vM.index[objName]:vM.index[objName]+6 ] = X[ variableManager.index[objName]:variableManager.index[objName]+6 ]
+    fixed = [ objName for objName in fixedObjects if objName in objectNames ]
+    conflictPreCheck, useContinuation = ConstraintSystemPrototype.conflictPreCheck, ConstraintSystemPrototype.useContinuation
+    ConstraintSystemPrototype.conflictPreCheck = False
+    ConstraintSystemPrototype.useContinuation = False
+    try:
+        system = FixedObjectSystem( vM, fixed[0] ) if len(fixed) > 0 else EmptySystem()
+        for c in constraintObjs:
+            if not system.containtsObject( c.Object1 ) and not system.containtsObject( c.Object2 ):
+                system = AddFreeObjectsUnion( system, vM, c )
+            for ConstraintSystemClass, constraintValue in constraintUnions( c ):
+                system = ConstraintSystemClass( system, vM, c, constraintValue=constraintValue )
+    except Assembly2SolverError:
+        return False
+    finally:
+        ConstraintSystemPrototype.conflictPreCheck, ConstraintSystemPrototype.useContinuation = conflictPreCheck, useContinuation
+    return True
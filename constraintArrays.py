@@ -0,0 +1,122 @@
+'''
+Flattened constraint representation
+-----------------------------------
+
+The constraint equations of a list of unions (see constraintSystems.py) stored as arrays, rather than as a list of Python objects each evaluating its own residuals:
+
+  kernels        - residual kernel name of each constraint (see residualKernels)
+  ind1, ind2     - index in X of the placement variables of each constraint's 2 objects
+  a1_r, a2_r     - axes relative to the objects placements (shape n,3; rows of zeros where not used by the constraint type)
+  pos1_r, pos2_r - positions relative to the objects placements (shape n,3)
+  values         - constraint target values (nan where not applicable)
+  directions     - direction constraint codes for axis alignment, see directionCodes
+
+so that the residuals of all the constraints sharing a kernel are evaluated in a single vectorized pass over X, or over a stack of X values (shape k,len(X)).
+Constraints without a residual kernel are evaluated using their own constraintEq_residuals.
+
+Used by the global solver for all its constraint equations, and by the heirarchical unions for their constraintEq_residuals (see ConstraintSystemPrototype.constraintEq_residuals),
+so that both evaluate the residuals using the same kernels.
+'''
+
+import numpy
+from lib3D import *
+
+directionCodes = { 'none':0, 'aligned':1, 'opposed':2 }
+
+def rotations( X, ind ):
+    'rotation matrices of the placement variables at indices ind of X (or a stack of X values); returns an array of shape X.shape[:-1] + (len(ind),3,3)'
+    azi, ela, theta = X[...,ind+3], X[...,ind+4], X[...,ind+5]
+    return azimuth_elevation_rotation_matrices( azi, ela, theta )
+
+def rotated( R, v ):
+    return numpy.einsum( '...ij,...j->...i', R, v )
+
+def axisAlignmentResiduals( A, k, R1, t1, R2, t2 ):
+    a = rotated( R1, A.a1_r[k] )
+    b = rotated( R2, A.a2_r[k] )
+    directions = A.directions[k]
+    sign = numpy.where( directions == directionCodes['aligned'], -1.0, 1.0 )[:,None]
+    return numpy.where( (directions == directionCodes['none'])[:,None], crossProduct( a, b ), a + sign*b )
+
+def angleResiduals( A, k, R1, t1, R2, t2 ):
+    a = rotated( R1, A.a1_r[k] )
+    b = rotated( R2, A.a2_r[k] )
+    return ( cos( A.values[k] ) - dotProducts( a, b ) )[...,None]
+
+def planeOffsetResiduals( A, k, R1, t1, R2, t2 ):
+    a = rotated( R1, A.a1_r[k] )
+    pos1 = rotated( R1, A.pos1_r[k] ) + t1
+    pos2 = rotated( R2, A.pos2_r[k] ) + t2
+    return ( dotProducts( a, pos1 - pos2 ) - A.values[k] )[...,None]
+
+def axisOffsetVectors( A, k, R1, t1, R2, t2 ):
+    'offset of pos2 from the axis through pos1'
+    a = rotated( R1, A.a1_r[k] )
+    pos1 = rotated( R1, A.pos1_r[k] ) + t1
+    pos2 = rotated( R2, A.pos2_r[k] ) + t2
+    d = pos2 - pos1
+    return d - dotProducts( a, d )[...,None]*a
+
+def axisDistanceResiduals( A, k, R1, t1, R2, t2 ):
+    offset = axisOffsetVectors( A, k, R1, t1, R2, t2 )
+    return ( dotProducts( offset, offset )**0.5 - A.values[k] )[...,None]
+
+def vertexResiduals( A, k, R1, t1, R2, t2 ):
+    pos1 = rotated( R1, A.pos1_r[k] ) + t1
+    pos2 = rotated( R2, A.pos2_r[k] ) + t2
+    return pos1 - pos2
+
+residualKernels = { #name : ( kernel, number of residuals per constraint )
+    'axisAlignment' : ( axisAlignmentResiduals, 3 ),
+    'angle'         : ( angleResiduals, 1 ),
+    'planeOffset'   : ( planeOffsetResiduals, 1 ),
+    'axisOffset'    : ( axisOffsetVectors, 3 ), #axis distance of 0, as the distance is not differentiable at the solution
+    'axisDistance'  : ( axisDistanceResiduals, 1 ),
+    'vertex'        : ( vertexResiduals, 3 ),
+    }
+
+
+class ConstraintArrays:
+    def __init__( self, variableManager, constraints ):
+        vM = variableManager
+        self.variableManager = vM
+        self.constraints = constraints
+        n = len(constraints)
+        self.kernels = [ c.residualKernel() for c in constraints ]
+        self.ind1 = numpy.array([ vM.index[c.obj1Name] for c in constraints ], dtype=int)
+        self.ind2 = numpy.array([ vM.index[c.obj2Name] for c in constraints ], dtype=int)
+        self.a1_r, self.a2_r, self.pos1_r, self.pos2_r = [ numpy.zeros([n,3]) for i in range(4) ]
+        self.values = numpy.zeros(n) * numpy.nan
+        self.directions = numpy.zeros(n, dtype=int)
+        widths = []
+        for i, (c, kernel) in enumerate( zip( constraints, self.kernels ) ):
+            for name in ['a1_r', 'a2_r', 'pos1_r', 'pos2_r']:
+                if hasattr( c, name ):
+                    getattr( self, name )[i] = getattr( c, name )
+            if kernel == 'axisAlignment':
+                self.directions[i] = directionCodes.get( c.alignmentDirection(), directionCodes['opposed'] )
+            elif kernel != None:
+                self.values[i] = c.constraintValue
+            widths.append( residualKernels[kernel][1] if kernel != None else len( c.constraintEq_residuals( vM.X ) ) )
+        self.rows = numpy.cumsum( [0] + widths ) #residuals of constraint i are rows[i]:rows[i+1]
+        self.groups = [] #( kernel name, constraint indices, residual indices )
+        for kernel in sorted( set( k for k in self.kernels if k != None ) ):
+            k = numpy.array([ i for i in range(n) if self.kernels[i] == kernel ], dtype=int)
+            self.groups.append( ( kernel, k, self.rows[k][:,None] + numpy.arange( residualKernels[kernel][1] ) ) )
+        self.others = [ i for i in range(n) if self.kernels[i] == None ]
+
+    def numberOfResiduals( self ):
+        return self.rows[-1]
+
+    def residuals( self, X ):
+        'residuals of all the constraints, in the order of the constraints, for X or a stack of X values (in which case an array of shape (k, numberOfResiduals) is returned)'
+        F = numpy.zeros( X.shape[:-1] + ( self.rows[-1], ) )
+        for kernel, k, cols in self.groups:
+            ind1, ind2 = self.ind1[k], self.ind2[k]
+            t1 = X[..., ind1[:,None] + numpy.arange(3) ]
+            t2 = X[..., ind2[:,None] + numpy.arange(3) ]
+            F_k = residualKernels[kernel][0]( self, k, rotations( X, ind1 ), t1, rotations( X, ind2 ), t2 )
+            F[..., cols.ravel() ] = F_k.reshape( F_k.shape[:-2] + (-1,) )
+        for i in self.others:
+            F[..., self.rows[i]:self.rows[i+1] ] = self.constraints[i].constraintEq_residuals( X )
+        return F
@@ -28,6 +28,8 @@ from numpy import pi, inf
 from numpy.linalg import norm
 from solverLib import *
 from degreesOfFreedom import *
+from constraintArrays import ConstraintArrays
+import solverTelemetry
 
 class Assembly2SolverError(Exception):
     def __init__(self, value):
@@ -35,6 +37,12 @@ class Assembly2SolverError(Exception):
     def __str__(self):
         return self.parameter
 
+class ConflictingConstraintsError(Assembly2SolverError):
+    'raised when the conflict pre-check (see conflictCheck.py) finds constraints which contradict each other; constraintObjs is a minimal set of such constraints'
+    def __init__(self, value, constraintObjs):
+        self.parameter = value
+        self.constraintObjs = constraintObjs
+
 #debugPrint, replaced to reduce overhead
 def dp( msg ):
     FreeCAD.Console.PrintMessage(msg + '\n')
@@ -43,6 +51,13 @@ def dp( msg ):
 class ConstraintSystemPrototype:
     label = '' #over-ride in inheritence
     solveConstraintEq_tol = 10**-9
+    numericalSolver = 'newton' #or 'levenberg_marquardt', solver used by solveConstraintEq when no analytical solution is available
+    useContinuation = True #walk large changes in the constraint value to the target in steps, see continuationSolution
+    localRotations = False #numerically solve for the rotation of objects with free rotation as increments to their current orientation, see degreesOfFreedom.LocalRotations. Off by default, as each evaluation converts the quaternions back to placement variables (see assembly2solver __main__ localRotationCases)
+    conflictPreCheck = True #check for contradicting constraints before numerically solving the top level system, if its gradient vanishes (see gradientVanishing and checkForConflicts)
+    continuationStep = None #over-ride in inheritence, None if the constraint value is not continuous
+    subElementAxes = (False, False) #over-ride in inheritence, whether init2 uses the axes of (subElement1, subElement2), see variableManager.SubElementTable
+    solveCount = 0 #incremented each time solveConstraintEq runs, see upToDate
     def __init__(self, parentSystem, variableManager, constraintObj, constraintValue ):
         self.parentSystem = parentSystem
         self.variableManager = variableManager
@@ -56,6 +71,9 @@ class ConstraintSystemPrototype:
         self.subElement2 = constraintObj.SubElement2
         self.constraintValue = constraintValue
         self.childSystem = None
+        if parentSystem == None: #detached constraint system, only used to evaluate the constraint equation (see globalConstraintSystem.py)
+            self.init2()
+            return
         parentSystem.childSystem = self
         doc = variableManager.doc
         assert parentSystem.containtsObject( obj1Name ) or parentSystem.containtsObject( obj2Name )
@@ -96,28 +114,32 @@ class ConstraintSystemPrototype:
                 raise Assembly2SolverError("%s no degrees-of-freedom to adjust to satify constraints:\n%s" % (self.str(), self.strSystemTree()))
             else:
                 if self.analyticalSolution(): #if analytical solution then will update X
+                    solverTelemetry.count('analyticalSolutions')
                 #if False:
                     #self.analyticalSolution() #forcing analytical solution to run twice as to decrease numerical error
                     if abs( self.constraintEq_value(self.variableManager.X) ) > tol:
                         if debugPrint.level >= 4+PLO: dp('  **numerical round off error in analytical solution repeating')
                         self.analyticalSolution()
                 else: #numerical solution
+                    solverTelemetry.count('numericalSolutions')
+                    dofs = self.solveConstraintEq_dofs
+                    if self.localRotations:
+                        self.solveConstraintEq_dofs = localRotationDofs( dofs )
                     Y0 =      [ d.getValue() for d in self.solveConstraintEq_dofs ]
                     if debugPrint.level >= 4+PLO: dp('%s: attempting to find solution numerically' % (self.str()))
-                    yOpt = solve_via_Newtons_method( 
-                        self.constraintEq_f, 
-                        Y0, #Y0, 
-                        [ d.maxStep() for d in self.solveConstraintEq_dofs ], #maxStep, while not really, more like recommended max step...
-                        f_tol=tol, 
-                        x_tol=0, 
-                        maxIt=42, 
-                        randomPertubationCount=2, 
-                        lineSearchIt=10,
-                        debugPrintLevel=debugPrint.level-2-PLO, 
-                        printF= lambda txt: debugPrint(2, txt ),
-                        record = not self.childSystem #only record top level optimization.
-                        )
+                    self.constraintEq_coupledDofs = self.determineCoupledDofs( Y0 )
+                    if self.conflictPreCheck and not self.childSystem and not hasattr( self, 'degreesOfFreedom' ) and self.gradientVanishing( Y0 ): #i.e. while adding this system to the heirachy
+                        self.checkForConflicts()
+                    if self.useContinuation and self.continuationStep != None:
+                        measuredValue = self.measuredConstraintValue( self.variableManager.X )
+                        if measuredValue != None and abs( self.continuationTarget() - measuredValue ) > self.continuationStep:
+                            Y0 = self.continuationSolution( Y0 )
+                    yOpt = self.numericalSolution( Y0 )
                     self.constraintEq_setY(yOpt) #this will automatically update X
+                    if self.solveConstraintEq_dofs != dofs:
+                        self.solveConstraintEq_dofs = dofs
+                        yOpt = [ d.getValue() for d in dofs ]
+                    self.solveConstraintEq_solution = ( list(self.solveConstraintEq_dofs), numpy.array(yOpt) ) #for generateDegreesOfFreedomNumerically to reuse the coupled dofs analysis
             if abs( self.constraintEq_value(self.variableManager.X) ) > tol:
                 raise Assembly2SolverError("%s abs( self.constraintEq_value(self.X) ) > tol [%e > %e]. Constraint Tree:\n%s" % (self.str(), abs( self.constraintEq_value(self.variableManager.X) ), tol, self.strSystemTree()))
         else:
@@ -132,6 +154,71 @@ class ConstraintSystemPrototype:
                 self.updateDegreesOfFreedomAnalytically( )
             else:
                 self.updateDegreesOfFreedomNumerically( )
+        self.solveCount = self.solveCount + 1
+        self.solvedState = ( self.parentSystem.solveCount, self.variableManager.X[ self.dependencyIndices() ] )
+
+    def dependencyIndices( self ):
+        'indices of the placement variables of obj1 and obj2 in X'
+        vM = self.variableManager
+        i1 = vM.index[self.obj1Name]
+        i2 = vM.index[self.obj2Name]
+        return numpy.r_[ i1:i1+6, i2:i2+6 ]
+
+    def upToDate( self ):
+        '''
+        True if the placement variables of obj1 and obj2 are unchanged since solveConstraintEq last ran, and the parent system has not been re-solved since (which may have updated degrees-of-freedom shared with this system).
+        In which case the constraint is still satisfied and its degrees-of-freedom are still current, so that update does not need to re-solve this system.
+        '''
+        state = getattr( self, 'solvedState', None )
+        if state == None or state[0] != self.parentSystem.solveCount:
+            return False
+        return numpy.array_equal( state[1], self.variableManager.X[ self.dependencyIndices() ] )
+
+    def gradientVanishing( self, Y, ratio=10**3 ):
+        '''
+        True if a linear step of less than ratio times the degrees-of-freedom maxSteps can not satisfy the constraint from Y, according to constraintEq_grad.
+        Only then can the linearized constraints of this system and its parent systems be inconsistent (as adjusting the degrees-of-freedom keeps the parent systems satisfied),
+        so that checkForConflicts is skipped for the other numerical solutions.
+        '''
+        g = self.constraintEq_grad( Y ) * numpy.array([ d.maxStep() for d in self.solveConstraintEq_dofs ])
+        solverTelemetry.count('gradientEvaluations')
+        return abs( self.constraintEq_value( self.variableManager.X ) ) > ratio * norm( g )
+
+    def checkForConflicts( self ):
+        '''
+        checks if the linearized constraints of this system and its parent systems are inconsistent (see conflictCheck.py),
+        raising ConflictingConstraintsError with the minimal set of contradicting constraints if that set can not be solved on its own,
+        before the numerical solution of this system is attempted.
+        '''
+        from conflictCheck import conflictingConstraints
+        solverTelemetry.count('conflictPreChecks')
+        vM = self.variableManager
+        unions = []
+        fixedObjects = []
+        s = self
+        while s != None:
+            unions = s.detachedUnions() + unions
+            if s.parentSystem == None and isinstance( s, FixedObjectSystem ) and hasattr( s, 'objName' ):
+                fixedObjects.append( s.objName )
+            s = s.parentSystem
+        for objName in vM.index:
+            if getattr( vM.doc.getObject( objName ), 'fixedPosition', False ):
+                fixedObjects.append( objName )
+        conflicting = conflictingConstraints( vM, unions, fixedObjects )
+        if len(conflicting) > 0:
+            raise self.conflictingConstraintsError( conflicting )
+
+    def conflictingConstraintsError( self, conflicting ):
+        'ConflictingConstraintsError listing the constraint objects of the conflicting unions'
+        constraintObjs = []
+        for c in conflicting:
+            if not c.constraintObj in constraintObjs:
+                constraintObjs.append( c.constraintObj )
+        return ConflictingConstraintsError( "%s conflicting constraints: %s\n%s" % ( self.str(), ', '.join( c.Name for c in constraintObjs ), '\n'.join( c.str('  ') for c in conflicting ) ), constraintObjs )
+
+    def detachedUnions( self ):
+        'detached copies of the constraint unions of this system (as used by the global solver), which evaluate the constraint equations without updating the heirachy'
+        return [ self.__class__( None, self.variableManager, self.constraintObj, self.constraintValue ) ]
 
     def constraintEq_setY(self, Y):
         for d,y in zip( self.solveConstraintEq_dofs, Y):
@@ -139,21 +226,218 @@ class ConstraintSystemPrototype:
         self.parentSystem.update()
         self.sys2.update()
 
+    def numericalSolution( self, Y0, maxIt=42 ):
+        tol = self.solveConstraintEq_tol
+        PLO = 0 if not self.childSystem else 1 #print level offset
+        if self.numericalSolver == 'levenberg_marquardt':
+            return solve_via_Levenberg_Marquardt(
+                self.constraintEq_f, 
+                Y0,
+                [ d.maxStep() for d in self.solveConstraintEq_dofs ], #trust-region radius units
+                grad_f = self.constraintEq_grad,
+                f_tol=tol, 
+                x_tol=0, 
+                maxIt=maxIt, 
+                debugPrintLevel=debugPrint.level-2-PLO, 
+                printF= lambda txt: debugPrint(2, txt ),
+                record = not self.childSystem
+                )
+        else:
+            for broyden in [True, False]: #Broyden updates can stall where the full Jacobian does not, in which case the solve is repeated without them
+                yOpt = solve_via_Newtons_method( 
+                    self.constraintEq_f, 
+                    Y0, #Y0, 
+                    [ d.maxStep() for d in self.solveConstraintEq_dofs ], #maxStep, while not really, more like recommended max step...
+                    grad_f = self.constraintEq_grad,
+                    f_tol=tol, 
+                    x_tol=0, 
+                    maxIt=maxIt, 
+                    randomPertubationCount=2, 
+                    lineSearchIt=10,
+                    debugPrintLevel=debugPrint.level-2-PLO, 
+                    printF= lambda txt: debugPrint(2, txt ),
+                    record = not self.childSystem, #only record top level optimization.
+                    broyden = broyden
+                    )
+                self.constraintEq_setY( yOpt )
+                if abs( self.constraintEq_value( self.variableManager.X ) ) <= tol:
+                    break
+            return yOpt
+
+    def measuredConstraintValue( self, X ):
+        'value of self.constraintValue for which the constraint would be satisfied at X, or None if not measurable. Over-ride in inheritence for continuation support'
+        return None
+
+    def continuationTarget( self ):
+        return self.constraintValue
+
+    def continuationSolution( self, Y0, stepReductions=4, maxIt=12 ):
+        '''
+        walks the constraint value from its measured value at the current placement towards the target constraint value,
+        warm-starting the numerical solution of each step from the previous one.
+        The step size is doubled after a successful step and halved after a failed step, giving up after stepReductions halvings of continuationStep.
+        Returns the degrees-of-freedom values for the last successful step, as the starting point for solving the target constraint value.
+        '''
+        vM = self.variableManager
+        tol = self.solveConstraintEq_tol
+        constraintValue = self.constraintValue
+        target = self.continuationTarget()
+        value = self.measuredConstraintValue( vM.X )
+        if value == None:
+            return Y0
+        step = self.continuationStep
+        Y = Y0
+        if debugPrint.level >= 4: dp('%s: continuation from constraint value %f to %f' % (self.label, value, target))
+        try:
+            while abs( target - value ) > step:
+                value_c = value + step * numpy.sign( target - value )
+                self.constraintValue = value_c
+                solverTelemetry.count('continuationSteps')
+                Y_c = self.numericalSolution( Y, maxIt=maxIt )
+                self.constraintEq_setY( Y_c )
+                if abs( self.constraintEq_value( vM.X ) ) < tol:
+                    Y = Y_c
+                    value = value_c
+                    step = 2*step
+                else:
+                    step = step / 2
+                    if step < self.continuationStep / 2**stepReductions:
+                        if debugPrint.level >= 4: dp('  %s: continuation step failed at constraint value %f, giving up' % (self.label, value_c))
+                        break
+                if debugPrint.level >= 5: dp('  %s: continuation constraint value %f, step %f' % (self.label, value, step))
+        finally:
+            self.constraintValue = constraintValue
+        return Y
+
     def update(self):
         if self.parentSystem != None:
             self.parentSystem.update()
-        self.solveConstraintEq()  
+        if not self.upToDate():
+            self.solveConstraintEq()  
 
     def constraintEq_f( self, Y ):
         #print(self.variableManager.X)
+        solverTelemetry.count('residualEvaluations')
         self.constraintEq_setY(Y)
         f_X = self.constraintEq_value(self.variableManager.X)
         PLO = 0 if not self.childSystem else 1 #print level offset
         if debugPrint.level >= 6+PLO: dp('constraintEq_f, X %s, f(X) %s' % (self.variableManager.X,f_X))
         return f_X
+
+    def constraintEq_f_batch( self, Ys ):
+        '''
+        constraintEq_f for a stack of degrees-of-freedom values (shape k,len(Y)).
+        The parent systems still have to be updated for each Y, but constraintEq_value is evaluated in a single pass over the stacked placement variables.
+        '''
+        solverTelemetry.count('residualEvaluations', len(Ys))
+        f_Xs = self.constraintEq_value( self.constraintEq_X_batch( Ys ) )
+        PLO = 0 if not self.childSystem else 1 #print level offset
+        if debugPrint.level >= 6+PLO: dp('constraintEq_f_batch, %i evaluations, f(X) %s' % (len(Ys), f_Xs))
+        return f_Xs
+
+    def constraintEq_X_batch( self, Ys ):
+        'placement variables for a stack of degrees-of-freedom values, updating the parent systems for each Y'
+        Xs = numpy.zeros( [ len(Ys), len(self.variableManager.X) ] )
+        for k, Y in enumerate(Ys):
+            self.constraintEq_setY(Y)
+            Xs[k] = self.variableManager.X
+        return Xs
+
+    def constraintEq_residuals_batch( self, Ys ):
+        'constraintEq_residuals for a stack of degrees-of-freedom values, as for constraintEq_f_batch'
+        solverTelemetry.count('residualEvaluations', len(Ys))
+        return self.constraintEq_residuals( self.constraintEq_X_batch( Ys ) )
+
     def constraintEq_value( self, X ):
         raise Assembly2SolverError('ConstraintSystemPrototype not supposed to be called directly')
 
+    def constraintEq_residuals( self, X ):
+        '''
+        constraint equation as a vector of residuals, which are all zero when the constraint is satisfied.
+        Used by the global solver, so that constraints such as the distance between 2 points can be expressed in a form which is differentiable at the solution.
+        As with constraintEq_value, X can also be a stack of placement variables, in which case an array of shape (k, number of residuals) is returned.
+        Evaluated using the union's residual kernel (see constraintArrays.py) if it has one.
+        '''
+        if self.residualKernel() == None:
+            return numpy.asarray( self.constraintEq_value( X ) )[...,None]
+        arrays = getattr( self, 'residualArrays', None )
+        if arrays == None or arrays[0] != self.constraintValue: #built lazily, and rebuilt if the constraint value changes (i.e. during continuationSolution)
+            arrays = ( self.constraintValue, ConstraintArrays( self.variableManager, [self] ) )
+            self.residualArrays = arrays
+        return arrays[1].residuals( X )
+
+    def residualKernel( self ):
+        'name of the constraintArrays.residualKernels entry which evaluates constraintEq_residuals, or None if the constraintEq_value is used as the residual'
+        return None
+
+    def constraintEq_gradient( self, X ):
+        '''
+        closed-form gradient of constraintEq_value, returned as { objName : (df_dt, df_dw) } where df_dt and df_dw are the gradients
+        with respect to a translation of objName and a rotation of objName about its placement base (both in global co-ordinates).
+        objects not in the dictionary do not effect the constraint. None is returned if no closed-form gradient is available.
+        '''
+        return None
+
+    def constraintEq_gradient_X( self, X, G ):
+        '''converts the closed-form gradient G (see constraintEq_gradient) to the gradient with respect to the placement variables X'''
+        grad = numpy.zeros( len(X) )
+        for objName, (df_dt, df_dw) in G.items():
+            i = self.variableManager.index[objName]
+            grad[i:i+3] = df_dt
+            grad[i+3:i+6] = [ dotProduct( df_dw, w ) for w in azimuth_elevation_angular_velocities( *X[i+3:i+6] ) ]
+        return grad
+
+    def constraintEq_grad( self, Y, eps=10**-6 ):
+        '''
+        gradient of constraintEq_f, using the closed-form gradient and the degrees-of-freedoms twists (dF/dY = dF/dX * dX/dY).
+        For the degrees-of-freedom coupled to the parent systems (see determineCoupledDofs), dX/dY is determined by
+        a forward difference of the placement variables, as adjusting them causes the parent systems to move other placement variables.
+        '''
+        vM = self.variableManager
+        self.constraintEq_setY(Y)
+        G = self.constraintEq_gradient( vM.X )
+        if G is None: #no closed-form gradient or singular point (i.e. distance of zero)
+            return GradientApproximatorCentralDifference( self.constraintEq_f_batch, batch=True )( numpy.array(Y) )
+        grad = numpy.zeros( len(Y) )
+        coupled = getattr( self, 'constraintEq_coupledDofs', range(len(Y)) )
+        for j, d in enumerate( self.solveConstraintEq_dofs ):
+            if d.objName in G and not j in coupled:
+                df_dt, df_dw = G[d.objName]
+                dt, dw = d.twist()
+                grad[j] = dotProduct( df_dt, dt ) + dotProduct( df_dw, dw )
+        if len(coupled) > 0:
+            X_Y = vM.X.copy()
+            df_dX = self.constraintEq_gradient_X( X_Y, G )
+            for j in coupled:
+                self.constraintEq_setY( addEps( numpy.array(Y), j, eps) )
+                grad[j] = dotProduct( df_dX, vM.X - X_Y ) / eps
+            self.constraintEq_setY(Y)
+        return grad
+
+    def determineCoupledDofs( self, Y, eps=10**-6, tol=10**-3 ):
+        '''
+        returns the indices of self.solveConstraintEq_dofs which, when adjusted, cause the parent systems to adjust the placement variables
+        in order to remain satisfied; i.e. the degrees-of-freedom which are not perfect with respect to the parent systems.
+        '''
+        vM = self.variableManager
+        Y = numpy.array(Y)
+        self.constraintEq_setY(Y)
+        coupled = []
+        for j, d in enumerate( self.solveConstraintEq_dofs ):
+            d.setValue( Y[j] + eps )
+            X_own = vM.X.copy()
+            self.parentSystem.update()
+            self.sys2.update()
+            if norm( vM.X - X_own ) > tol*eps:
+                coupled.append(j)
+            self.constraintEq_setY(Y)
+        if debugPrint.level >= 4: dp('  %s: %i of %i degrees-of-freedom coupled to parent systems' % (self.label, len(coupled), len(Y)))
+        return coupled
+
+    def placementBase( self, objName, X ):
+        i = self.variableManager.index[objName]
+        return X[i:i+3]
+
     def analyticalSolution(self):
         return False
 
@@ -171,6 +455,22 @@ class ConstraintSystemPrototype:
         obj =  self.variableManager.doc.getObject( objName )
         return getSubElementAxis(obj, subElement)
 
+    def getPos_r(self, objName, subElement):
+        'position of the subElement relative to objNames placement in X0, from the variableManagers subElements table if available'
+        vM = self.variableManager
+        subElements = getattr( vM, 'subElements', None )
+        if subElements != None and subElements.hasSubElement( objName, subElement ):
+            return subElements.pos( objName, subElement )
+        return vM.rotateAndMoveUndo( objName, self.getPos(objName, subElement), vM.X0 )
+
+    def getAxis_r(self, objName, subElement):
+        'axis of the subElement relative to objNames placement in X0, see getPos_r'
+        vM = self.variableManager
+        subElements = getattr( vM, 'subElements', None )
+        if subElements != None and subElements.hasSubElement( objName, subElement ):
+            return subElements.axis( objName, subElement )
+        return vM.rotateUndo( objName, self.getAxis(objName, subElement), vM.X0 )
+
     def str(self, indent='', addDOFs=False):
         txt = '%s<%s System %s:%s-%s:%s heirachy %i>' % (indent, self.label, self.obj1Name, self.subElement1, self.obj2Name, self.subElement2, self.numberOfParentSystems())
         if addDOFs and hasattr( self, 'degreesOfFreedom'):
@@ -206,52 +506,78 @@ class ConstraintSystemPrototype:
             self.generateDegreesOfFreedomNumerically_case = 0 #system has no degrees of freedom, so nothing to do
             self.degreesOfFreedom = D    
             return
+        X_org = self.variableManager.X.copy()
+        yOpt = numpy.array([ d.getValue() for d in self.solveConstraintEq_dofs ]) #values update in solve equation.
+        self.generateDegreesOfFreedomNumerically_case = 0
+        if len( self.constraintEq_residuals( X_org ) ) > 1:
+            #constraint value is a norm of the residuals, so its gradient at the solution is degenerate
+            df_dy = None
+            self.solveConstraintEq_solution = None
         else:
-            X_org = self.variableManager.X.copy()
-            yOpt = [ d.getValue() for d in self.solveConstraintEq_dofs ] #values update in solve equation.
-            df_dy = GradientApproximatorForwardDifference(self.constraintEq_f)(numpy.array(yOpt))
+            df_dy = self.jacobianAtSolution( yOpt )
             #debugPrint(5, '  df_dy == %s' % str(df_dy))
             self.variableManager.X = X_org.copy()
             if all(df_dy == 0):
                 if debugPrint.level >= 4: dp('  generateDegreesOfFreedomNumerically, all(df_dy == 0), so assuming constraint is reduntant.')
-                self.generateDegreesOfFreedomNumerically_case = 0
                 self.degreesOfFreedom = D
                 return
-            else:
-                removeInd = None
-                if len(df_dy) - sum(df_dy == 0) == 1:
-                    if debugPrint.level >= 4: dp('  generateDegreesOfFreedomNumerically, len(df_dy) - sum(df_dy == 0) == 1, removing dof with gradient != 0')
-                    removeInd = list(df_dy == 0).index(False)
-                elif len(df_dy) - sum(abs(df_dy) < max(abs(df_dy))*1e-6) == 1:
-                    if debugPrint.level >= 4: dp('  generateDegreesOfFreedomNumerically, len(df_dy) - sum(abs(df_dy) < max(abs(df_dy))*1e-6) == 1, removing dof with largest gradient')
-                    removeInd = list( abs(df_dy) == max(abs(df_dy)) ).index(True)
-                if removeInd != None:
-                    self.generateDegreesOfFreedomNumerically_case = 0
-                    if debugPrint.level >= 4: dp('    removing %s' % D[removeInd])
-                    self.degreesOfFreedom = [ d for i,d in enumerate(D) if i != removeInd ]
-                    return
-                else:
-                     if debugPrint.level >= 4: dp('  generateDegreesOfFreedomNumerically, trivial reductions failed; attempting to determine non-perfect DOF by trail and error.')
-                     active_D = [ d for d, df_dy_i in zip(self.solveConstraintEq_dofs,df_dy) if abs(df_dy_i) > 1e-6 ]
-                     dormant_D = [ d for d, df_dy_i in zip(self.solveConstraintEq_dofs,df_dy) if abs(df_dy_i) <= 1e-6 ]
-                     if debugPrint.level >= 4: dp('    len(active_D) %i, len(dormant_D) %i' % (len(active_D),len((dormant_D))))
-                     self.degreesOfFreedom = [] #prevent coming solve calls from entering this function agoin
-                     self.generateDegreesOfFreedomNumerically_case = 0 # "
-                     for i in range(len(active_D)):
-                         active_D[i].setValue( active_D[i].getValue() + 0.1 ) #delta = 0.1
-                         active_D[i].locked = True
-                         try:
-                             self.solveConstraintEq()
-                         except Assembly2SolverError:
-                             if debugPrint.level >= 4: dp('unable to solve system after the locking the first %i DOFs, therefore passing through %i/%i of active_DOF' % (i+1,i,len(active_D)))
-                             for j in range(i+1):
-                                 active_D[i].locked = False
-                             self.variableManager.X = X_org
-                             self.degreesOfFreedom = active_D[:i] + dormant_D
-                             return 
-
-                
-        raise NotImplementedError('generateDegreesOfFreedomNumerically Logic not programmed for the reduction of degrees of freedom with df_dy=%s, self.solveConstraintEq_dofs:\n%s' % (df_dy,'\n'.join(d.str('  ') for d in self.solveConstraintEq_dofs )))
+            removeInd = None
+            if len(df_dy) - sum(df_dy == 0) == 1:
+                if debugPrint.level >= 4: dp('  generateDegreesOfFreedomNumerically, len(df_dy) - sum(df_dy == 0) == 1, removing dof with gradient != 0')
+                removeInd = list(df_dy == 0).index(False)
+            elif len(df_dy) - sum(abs(df_dy) < max(abs(df_dy))*1e-6) == 1:
+                if debugPrint.level >= 4: dp('  generateDegreesOfFreedomNumerically, len(df_dy) - sum(abs(df_dy) < max(abs(df_dy))*1e-6) == 1, removing dof with largest gradient')
+                removeInd = list( abs(df_dy) == max(abs(df_dy)) ).index(True)
+            if removeInd != None:
+                if debugPrint.level >= 4: dp('    removing %s' % D[removeInd])
+                self.degreesOfFreedom = [ d for i,d in enumerate(D) if i != removeInd ]
+                return
+        if debugPrint.level >= 4: dp('  generateDegreesOfFreedomNumerically, determining the null space of the constraint residuals Jacobian.')
+        J = GradientApproximatorForwardDifference( self.constraintEq_residuals_batch, batch=True )( yOpt )
+        solverTelemetry.count('gradientEvaluations')
+        self.variableManager.X = X_org.copy()
+        rank, pivots = nullSpaceParametrization( J, abs_tol=10**-6 ) #abs_tol, as entries below the forward difference noise level are to be ignored
+        if rank == 0 and df_dy is not None: #residual insensitive at the solution, so fall back to the constraint value gradient
+            rank, pivots = nullSpaceParametrization( df_dy )
+        if debugPrint.level >= 4: dp('    rank %i, removing %s' % (rank, ', '.join( D[i].str() for i in pivots )))
+        self.degreesOfFreedom = [ d for i,d in enumerate(D) if not i in pivots ]
+
+    def jacobianAtSolution( self, Y ):
+        '''
+        gradient of constraintEq_f at Y for generateDegreesOfFreedomNumerically.
+        If Y is the numerical solution found by solveConstraintEq for the same degrees-of-freedom, the closed-form gradient is evaluated at Y (constraintEq_grad),
+        reusing the degrees-of-freedom coupled to the parent systems found by the solve (determineCoupledDofs), so that only those require the parent systems to be updated.
+        The solver's own Jacobians are not reused, as they are taken at the iterates before the solution.
+        Otherwise, if the parent systems degrees-of-freedom are all perfect (i.e. adjusting them does not cause the parent systems to move other placement variables),
+        the closed-form gradient is used without any parent system updates, with a forward difference as the fall back.
+        Entries negligible compared to the largest entry are set to zero, as the degrees-of-freedom reduction is determined from the zero entries.
+        '''
+        solution = getattr( self, 'solveConstraintEq_solution', None )
+        self.solveConstraintEq_solution = None
+        closedForm = self.constraintEq_gradient( self.variableManager.X ) != None
+        if closedForm and solution != None and len(solution[0]) == len(Y) and all( d1 is d2 for d1, d2 in zip( solution[0], self.solveConstraintEq_dofs ) ) and numpy.array_equal( solution[1], Y ):
+            if debugPrint.level >= 4: dp('  %s: closed-form gradient at numerical solution, reusing its coupled degrees-of-freedom' % self.label)
+            df_dy = self.constraintEq_grad( Y )
+            solverTelemetry.count('gradientEvaluations')
+        elif closedForm and self.parentDofsPerfect():
+            self.constraintEq_coupledDofs = []
+            df_dy = self.constraintEq_grad( Y )
+            solverTelemetry.count('gradientEvaluations')
+        else:
+            df_dy = GradientApproximatorForwardDifference(self.constraintEq_f_batch, batch=True)(Y)
+            solverTelemetry.count('gradientEvaluations')
+            return df_dy
+        df_dy[ abs(df_dy) <= abs(df_dy).max() * 10**-12 ] = 0
+        return df_dy
+
+    def parentDofsPerfect( self ):
+        'True if none of the parent systems generated their degrees-of-freedom numerically'
+        system = self.parentSystem
+        while system != None:
+            if not getattr( system, 'dof_updated_analytically', True ):
+                return False
+            system = system.parentSystem
+        return True
 
     def updateDegreesOfFreedomNumerically( self ):
         if self.generateDegreesOfFreedomNumerically_case == 0:
@@ -273,15 +599,18 @@ class FixedObjectSystem(ConstraintSystemPrototype):
         pass
     def update(self):
         pass
+    def detachedUnions( self ):
+        return []
     def str(self, indent='', addDOFs=False):
         return '%s<FixedObjectSystem %s> %s' % (indent, self.objName, '0 degrees of freedom' if addDOFs else '')
 
 class EmptySystem( FixedObjectSystem ):
     def __init__(self ):
         self.degreesOfFreedom = []
+        self.parentSystem = None
     def containtsObject(self, objName):
         return False
-    def str(self, indent=''):
+    def str(self, indent='', addDOFs=False):
         return '%s<EmptySystem>' % (indent)   
 
 class FreeObjectSystem( FixedObjectSystem ):
@@ -299,20 +628,20 @@ class FreeObjectSystem( FixedObjectSystem ):
 
 class AxisAlignmentUnion(ConstraintSystemPrototype):
     label = 'AxisAlignmentUnion'
+    subElementAxes = (True, True)
     solveConstraintEq_tol = 10**-9
 
     def init2(self):
-        vM = self.variableManager
         #get rotation r(relative) to objects initial placement.
-        self.a1_r = vM.rotateUndo( self.obj1Name, self.getAxis(self.obj1Name, self.subElement1), vM.X0 )
-        self.a2_r = vM.rotateUndo( self.obj2Name, self.getAxis(self.obj2Name, self.subElement2), vM.X0 )
+        self.a1_r = self.getAxis_r( self.obj1Name, self.subElement1 )
+        self.a2_r = self.getAxis_r( self.obj2Name, self.subElement2 )
         #if debugPrint.level >= 4: dp('    a1_r %s, a2_r %s, directionConstraintFlag %s' % (self.a1_r, self.a2_r, self.constraintValue))
 
     def constraintEq_value( self, X ):
         vM = self.variableManager
         a = vM.rotate( self.obj1Name, self.a1_r, X )
         b = vM.rotate( self.obj2Name, self.a2_r, X )
-        ax_prod = dotProduct( a,b )
+        ax_prod = dotProducts( a,b )
         directionConstraintFlag = self.constraintValue
         if directionConstraintFlag == "none" : 
             return (1 - abs(ax_prod))
@@ -321,6 +650,28 @@ class AxisAlignmentUnion(ConstraintSystemPrototype):
         else:
             return (1 + ax_prod)
 
+    def residualKernel( self ):
+        return 'axisAlignment'
+
+    def alignmentDirection( self ):
+        'direction constraint of the axisAlignment residual kernel'
+        return self.constraintValue
+
+    def constraintEq_gradient( self, X ):
+        vM = self.variableManager
+        a = vM.rotate( self.obj1Name, self.a1_r, X )
+        b = vM.rotate( self.obj2Name, self.a2_r, X )
+        directionConstraintFlag = self.constraintValue
+        if directionConstraintFlag == "none" :
+            sign = 1 if dotProduct( a,b ) >= 0 else -1
+        elif directionConstraintFlag == "aligned":
+            sign = 1
+        else:
+            sign = -1
+        # d(a.b) = dot( w1 x a, b ) + dot( a, w2 x b ) = dot( w1 - w2, a x b )
+        c = crossProduct( a, b )
+        return { self.obj1Name : ( numpy.zeros(3), -sign*c ), self.obj2Name : ( numpy.zeros(3), sign*c ) }
+
     def analyticalSolution(self):
         D = self.solveConstraintEq_dofs #degrees of freedom
         for objName in [self.obj1Name, self.obj2Name]:
@@ -501,11 +852,12 @@ class AxisAlignmentUnion(ConstraintSystemPrototype):
 
 class AngleUnion(AxisAlignmentUnion):
     label = 'AngleUnion'
+    continuationStep = pi/8
     def constraintEq_value( self, X ):
         vM = self.variableManager
         a = vM.rotate( self.obj1Name, self.a1_r, X )
         b = vM.rotate( self.obj2Name, self.a2_r, X )
-        return cos(self.constraintValue) - dotProduct( a,b )
+        return cos(self.constraintValue) - dotProducts( a,b )
         # for another day
         #c = crossProduct( a, b)
         #if norm(c) > 0:
@@ -518,6 +870,30 @@ class AngleUnion(AxisAlignmentUnion):
         #    angle = 0 if dotProduct( a,b ) == 1 else pi
         #return self.constraintValue - angle
 
+    def constraintEq_gradient( self, X ):
+        vM = self.variableManager
+        a = vM.rotate( self.obj1Name, self.a1_r, X )
+        b = vM.rotate( self.obj2Name, self.a2_r, X )
+        c = crossProduct( a, b )
+        return { self.obj1Name : ( numpy.zeros(3), -c ), self.obj2Name : ( numpy.zeros(3), c ) }
+
+    def residualKernel( self ):
+        if abs( cos( self.constraintValue ) ) > 1 - 10**-12: #parallel planes, where cos(angle) - a.b is not differentiable at the solution
+            return 'axisAlignment'
+        return 'angle'
+
+    def alignmentDirection( self ):
+        return 'aligned' if cos( self.constraintValue ) > 0 else 'opposed'
+
+    def measuredConstraintValue( self, X ):
+        vM = self.variableManager
+        a = vM.rotate( self.obj1Name, self.a1_r, X )
+        b = vM.rotate( self.obj2Name, self.a2_r, X )
+        return numpy.arccos( numpy.clip( dotProducts( a,b ), -1, 1 ) )
+
+    def continuationTarget( self ):
+        return numpy.arccos( cos( self.constraintValue ) ) #as the constraint equation only depends on cos(self.constraintValue)
+
     def analyticalSolutionAdjustAngle( self, actual_angle, axis, v, v_ref ):
         desired_angle = self.constraintValue
         correction = actual_angle - desired_angle
@@ -526,21 +902,40 @@ class AngleUnion(AxisAlignmentUnion):
 
 class PlaneOffsetUnion(ConstraintSystemPrototype):
     label = 'PlaneOffsetUnion'
+    subElementAxes = (True, False)
+    continuationStep = maxStep_linearDisplacement
     def init2(self):
-        vM = self.variableManager
         #get rotation r(relative) to objects initial placement.
-        self.a1_r =   vM.rotateUndo( self.obj1Name, self.getAxis(self.obj1Name, self.subElement1), vM.X0 )
-        self.pos1_r = vM.rotateAndMoveUndo( self.obj1Name, self.getPos(self.obj1Name, self.subElement1), vM.X0 )
-        self.pos2_r = vM.rotateAndMoveUndo( self.obj2Name, self.getPos(self.obj2Name, self.subElement2), vM.X0 )
+        self.a1_r =   self.getAxis_r( self.obj1Name, self.subElement1 )
+        self.pos1_r = self.getPos_r( self.obj1Name, self.subElement1 )
+        self.pos2_r = self.getPos_r( self.obj2Name, self.subElement2 )
         
     def constraintEq_value( self, X ):
         vM = self.variableManager
         a = vM.rotate( self.obj1Name, self.a1_r, X )
         pos1 = vM.rotateAndMove( self.obj1Name, self.pos1_r, X )
         pos2 = vM.rotateAndMove( self.obj2Name, self.pos2_r, X )
-        dist = dotProduct(a, pos1 - pos2) #distance between planes
+        dist = dotProducts(a, pos1 - pos2) #distance between planes
         return dist - self.constraintValue
 
+    def residualKernel( self ):
+        return 'planeOffset'
+
+    def measuredConstraintValue( self, X ):
+        return self.constraintEq_value( X ) + self.constraintValue
+
+    def constraintEq_gradient( self, X ):
+        vM = self.variableManager
+        a = vM.rotate( self.obj1Name, self.a1_r, X )
+        pos1 = vM.rotateAndMove( self.obj1Name, self.pos1_r, X )
+        pos2 = vM.rotateAndMove( self.obj2Name, self.pos2_r, X )
+        r1 = pos1 - self.placementBase( self.obj1Name, X ) #lever arms
+        r2 = pos2 - self.placementBase( self.obj2Name, X )
+        return {
+            self.obj1Name : ( a, crossProduct( a, pos1 - pos2 ) + crossProduct( r1, a ) ),
+            self.obj2Name : ( -a, crossProduct( a, r2 ) )
+            }
+
     def analyticalSolution(self):
         D = self.solveConstraintEq_dofs #degrees of freedom
         for objName in [self.obj1Name, self.obj2Name]:
@@ -644,14 +1039,14 @@ class PlaneOffsetUnion(ConstraintSystemPrototype):
 
 class AxisDistanceUnion(ConstraintSystemPrototype):
     label = 'AxisDistanceUnion'
+    subElementAxes = (True, True)
     solveConstraintEq_tol = 10**-5
     def init2(self):
-        vM = self.variableManager
         #get rotation r(relative) to objects initial placement.
-        self.a1_r =   vM.rotateUndo( self.obj1Name, self.getAxis(self.obj1Name, self.subElement1), vM.X0 )
-        self.a2_r =   vM.rotateUndo( self.obj2Name, self.getAxis(self.obj2Name, self.subElement2), vM.X0 )
-        self.pos1_r = vM.rotateAndMoveUndo( self.obj1Name, self.getPos(self.obj1Name, self.subElement1), vM.X0 )
-        self.pos2_r = vM.rotateAndMoveUndo( self.obj2Name, self.getPos(self.obj2Name, self.subElement2), vM.X0 )
+        self.a1_r =   self.getAxis_r( self.obj1Name, self.subElement1 )
+        self.a2_r =   self.getAxis_r( self.obj2Name, self.subElement2 )
+        self.pos1_r = self.getPos_r( self.obj1Name, self.subElement1 )
+        self.pos2_r = self.getPos_r( self.obj2Name, self.subElement2 )
 
     def constraintEq_value( self, X ):
         vM = self.variableManager
@@ -664,43 +1059,82 @@ class AxisDistanceUnion(ConstraintSystemPrototype):
         # dist = distance_between_two_axes_3_points( pos1, a1, pos2, a2 )
         #   is sensitive to axis misalignment, which is should not be because, axis alignment should be taken care of in the axis alignment constraint. Therefore
         dist = distance_between_axis_and_point( pos1, a1, pos2 )
-        if numpy.isnan(dist):
+        if numpy.any( numpy.isnan(dist) ):
             if debugPrint.level >= 1: dp('numpy.isnan(dist)')
             if debugPrint.level >= 1: dp('  locals %s' % formatDictionary(locals(),' '*6) )
             if debugPrint.level >= 1: dp('  %s.__dict %s' % (self.label, formatDictionary( self.__dict__,' '*6 ) ) )   
             raise ValueError(' assembly2 AxisDistanceUnion numpy.isnan(dist) check console for details')
         return dist - self.constraintValue
 
+    def residualKernel( self ):
+        return 'axisOffset' if self.constraintValue == 0 else 'axisDistance' #offset of pos2 from the axis if 0, as the distance is not differentiable at the solution
+
+    def constraintEq_gradient( self, X ):
+        vM = self.variableManager
+        a = vM.rotate( self.obj1Name, self.a1_r, X )
+        pos1 = vM.rotateAndMove( self.obj1Name, self.pos1_r, X )
+        pos2 = vM.rotateAndMove( self.obj2Name, self.pos2_r, X )
+        d = pos2 - pos1
+        offset = d - dotProduct(a,d)*a
+        if norm(offset) < 10**-12: #distance not differentiable
+            return None
+        n = offset / norm(offset)
+        r1 = pos1 - self.placementBase( self.obj1Name, X )
+        r2 = pos2 - self.placementBase( self.obj2Name, X )
+        # d norm(offset) = dot(n, d_pos2 - d_pos1) - dot(a,d) * dot(n, w1 x a), as dot(n,a) == 0
+        return {
+            self.obj1Name : ( -n, -crossProduct( r1, n ) - dotProduct(a,d)*crossProduct( a, n ) ),
+            self.obj2Name : ( n, crossProduct( r2, n ) )
+            }
+
+    def radialDirection( self, X ):
+        'unit vector from the axis to pos2, perpendicular to the axis. If pos2 is on the axis, an arbitrary direction perpendicular to the axis is returned'
+        vM = self.variableManager
+        a = vM.rotate( self.obj1Name, self.a1_r, X )
+        d = vM.rotateAndMove( self.obj2Name, self.pos2_r, X ) - vM.rotateAndMove( self.obj1Name, self.pos1_r, X )
+        offset = d - dotProduct(a,d)*a
+        if norm(offset) > 10**-12:
+            return normalize(offset)
+        return plane_degrees_of_freedom( a )[0]
+
     def analyticalSolution(self):
-        if  self.constraintValue == 0:
-            D = self.solveConstraintEq_dofs #degrees of freedom
-            for objName in [self.obj1Name, self.obj2Name]:
-                matches = [d for d in D if d.objName == objName and not d.rotational() ]
-                if len(matches) > 0:
-                    if debugPrint.level >= 4: dp('    %s %s has linear displacement degrees of freedom, checking for analyticalSolution.'% (self.label, objName))
-                    vM = self.variableManager
-                    a = vM.rotate( self.obj1Name, self.a1_r, vM.X )
-                    pos1 = vM.rotateAndMove( self.obj1Name, self.pos1_r, vM.X )
-                    pos2 = vM.rotateAndMove( self.obj2Name, self.pos2_r, vM.X )
-                    error_v =  (pos1-pos2) - dotProduct(a,pos1-pos2)*a
-                    a_v = normalize(error_v)
-                    error =  norm( error_v ) - self.constraintValue
-                    requiredDisp = a_v*error
-                    if objName == self.obj1Name:
-                        requiredDisp = -requiredDisp
-                    if debugPrint.level >= 4: dp('    requiredDisp %s' % requiredDisp )
-                    V = [ dot( m.directionVector, requiredDisp ) for m in matches ]
-                    #for m,v in zip(matches,V):
-                    #    print(m,v)
-                    #debugPrint(4,str(V))
-                    actualDisp = sum( v*m.directionVector for m,v in zip(matches,V) )
-                    if abs(dot(a_v,requiredDisp) - dot(a_v,actualDisp)) < 10**-9:
-                        if debugPrint.level >= 3: dp('    %s analyticalSolution available by moving %s.'% (self.label, objName))
-                        for m,v in zip(matches,V):
-                            m.setValue( m.getValue() + v  )
-                        self.parentSystem.update() 
-                        self.sys2.update()
+        D = self.solveConstraintEq_dofs #degrees of freedom
+        for objName in [self.obj1Name, self.obj2Name]:
+            matches = [d for d in D if d.objName == objName and not d.rotational() ]
+            if len(matches) > 0:
+                if debugPrint.level >= 4: dp('    %s %s has linear displacement degrees of freedom, checking for analyticalSolution.'% (self.label, objName))
+                vM = self.variableManager
+                a = vM.rotate( self.obj1Name, self.a1_r, vM.X )
+                pos1 = vM.rotateAndMove( self.obj1Name, self.pos1_r, vM.X )
+                pos2 = vM.rotateAndMove( self.obj2Name, self.pos2_r, vM.X )
+                error_v =  (pos1-pos2) - dotProduct(a,pos1-pos2)*a
+                a_v = -self.radialDirection( vM.X ) #from pos2 towards the axis
+                error =  norm( error_v ) - self.constraintValue
+                requiredDisp = a_v*error #moves pos2 radially, so that its distance from the axis is self.constraintValue
+                if objName == self.obj1Name:
+                    requiredDisp = -requiredDisp
+                if debugPrint.level >= 4: dp('    requiredDisp %s' % requiredDisp )
+                V = [ dot( m.directionVector, requiredDisp ) for m in matches ]
+                #for m,v in zip(matches,V):
+                #    print(m,v)
+                #debugPrint(4,str(V))
+                actualDisp = sum( v*m.directionVector for m,v in zip(matches,V) )
+                if self.constraintValue == 0:
+                    available = abs(dot(a_v,requiredDisp) - dot(a_v,actualDisp)) < 10**-9
+                else: #distance from the axis after moving objName by actualDisp
+                    offset = -error_v + ( actualDisp if objName == self.obj2Name else -actualDisp )
+                    available = abs( norm( offset - dotProduct(a,offset)*a ) - self.constraintValue ) < 10**-9
+                if available:
+                    if debugPrint.level >= 3: dp('    %s analyticalSolution available by moving %s.'% (self.label, objName))
+                    X_org = vM.X.copy()
+                    for m,v in zip(matches,V):
+                        m.setValue( m.getValue() + v  )
+                    self.parentSystem.update() 
+                    self.sys2.update()
+                    if abs( self.constraintEq_value( vM.X ) ) <= self.solveConstraintEq_tol:
                         return True
+                    if debugPrint.level >= 3: dp('    %s parent systems moved %s, as its degrees of freedom are not perfect; analyticalSolution failed.'% (self.label, objName))
+                    vM.X = X_org
         return False
 
 
@@ -710,7 +1144,7 @@ class AxisDistanceUnion(ConstraintSystemPrototype):
         #first try to look for an object which has 3 linear motion degrees of freedom'
         success = False
         if self.constraintValue != 0:
-            raise NotImplementedError('%s self.constraintValue != 0 not implemented yet' % self.label)
+            return self.generateDegreesOfFreedomAnalytically_offset( dofs )
         vM = self.variableManager
         axisVector = vM.rotate( self.obj1Name, self.a1_r, vM.X )
         self.dof_added = False
@@ -758,8 +1192,50 @@ class AxisDistanceUnion(ConstraintSystemPrototype):
         #    raise NotImplementedError, 'Panic! %s.generateDegreesOfFreedomAnalytical Logic not programmed for the reduction of degrees of freedom of:\n%s' % ( self.label, '\n'.join(d.str('  ') for d in dofs) )
         return success
         
+    def generateDegreesOfFreedomAnalytically_offset( self, dofs ):
+        '''
+        non-zero axis distance, so that pos2 lies on a cylinder of radius self.constraintValue about the axis.
+        The linear displacement degrees of freedom of an object are reduced by removing their radial component:
+          3 -> 2, along the axis and tangential to the cylinder,
+          2 -> 1, tangential to the cylinder within the movement plane,
+          1 -> 0, unless the degree of freedom is along the axis.
+        The tangential directions are updated after each solve (see updateDegreesOfFreedomAnalytically), the radial error being corrected by analyticalSolution.
+        '''
+        vM = self.variableManager
+        axisVector = vM.rotate( self.obj1Name, self.a1_r, vM.X )
+        self.offsetDOFs = [] #( degree of freedom, 'axial' / 'tangential' / matches spanning the movement plane )
+        for objName in [self.obj1Name, self.obj2Name]:
+            matches = [d for d in dofs if d.objName == objName and not d.rotational() ]
+            if len(matches) == 3:
+                if debugPrint.level >= 4: dp('%s Logic: %s - reducing linear displacement degrees of freedom from 3 to 2' % (self.label, objName))
+                self.offsetDOFs = [ ( LinearMotionDegreeOfFreedom( self, objName ), 'axial' ), ( LinearMotionDegreeOfFreedom( self, objName ), 'tangential' ) ]
+            elif len(matches) == 2:
+                if debugPrint.level >= 4: dp('%s Logic: %s - reducing linear displacement degrees of freedom from 2 to 1' % (self.label, objName))
+                self.offsetDOFs = [ ( LinearMotionDegreeOfFreedom( self, objName ), matches ) ]
+            elif len(matches) == 1 and abs( dotProduct( axisVector, matches[0].directionVector ) ) < 1 - 10**-9:
+                if debugPrint.level >= 4: dp('%s Logic: %s - linear displacement degree of freedom not along axis -> reducing degrees of freedom from 1 to 0' % (self.label, objName))
+            else:
+                continue
+            self.degreesOfFreedom = [ d for d in dofs if not d in matches ] + [ d for d, direction in self.offsetDOFs ]
+            self.updateDegreesOfFreedomAnalytically()
+            return True
+        return False
+
     def updateDegreesOfFreedomAnalytically( self ):
-        if self.dof_added:
+        if self.constraintValue != 0:
+            vM = self.variableManager
+            axisVector = vM.rotate( self.obj1Name, self.a1_r, vM.X )
+            radial = self.radialDirection( vM.X )
+            for d, direction in self.offsetDOFs:
+                if direction == 'axial':
+                    d.setDirection( axisVector )
+                elif direction == 'tangential':
+                    d.setDirection( normalize( crossProduct( axisVector, radial ) ) )
+                else:
+                    planeNormal = normalize( crossProduct( direction[0].directionVector, direction[1].directionVector ) )
+                    t = crossProduct( planeNormal, radial )
+                    d.setDirection( normalize(t) if norm(t) > 10**-6 else axisVector ) #movement plane tangent to the cylinder, along the axis
+        elif self.dof_added:
             vM = self.variableManager
             axisVector = vM.rotate( self.obj1Name, self.a1_r, vM.X )
             self.degreesOfFreedom[-1].setDirection(axisVector)
@@ -771,17 +1247,35 @@ class AxisDistanceUnion(ConstraintSystemPrototype):
 class VertexUnion(ConstraintSystemPrototype):
     label = 'VertexUnion'
     def init2(self):
-        vM = self.variableManager
         #get rotation r(relative) to objects initial placement.
-        self.pos1_r = vM.rotateAndMoveUndo( self.obj1Name, self.getPos(self.obj1Name, self.subElement1), vM.X0 )
-        self.pos2_r = vM.rotateAndMoveUndo( self.obj2Name, self.getPos(self.obj2Name, self.subElement2), vM.X0 )
+        self.pos1_r = self.getPos_r( self.obj1Name, self.subElement1 )
+        self.pos2_r = self.getPos_r( self.obj2Name, self.subElement2 )
         self.DOF_to_remove = None
+        self.pivotObject = None #object whose linear displacement degrees of freedom were removed, see pivotSystem
+        self.rotationDOF = None
         
     def constraintEq_value( self, X ):
         vM = self.variableManager
         pos1 = vM.rotateAndMove( self.obj1Name, self.pos1_r, X )
         pos2 = vM.rotateAndMove( self.obj2Name, self.pos2_r, X )
-        return norm(pos1 - pos2)
+        return dotProducts( pos1 - pos2, pos1 - pos2 ) ** 0.5
+
+    def residualKernel( self ):
+        return 'vertex'
+
+    def constraintEq_gradient( self, X ):
+        vM = self.variableManager
+        pos1 = vM.rotateAndMove( self.obj1Name, self.pos1_r, X )
+        pos2 = vM.rotateAndMove( self.obj2Name, self.pos2_r, X )
+        if norm(pos1 - pos2) < 10**-12: #norm not differentiable
+            return None
+        n = (pos1 - pos2) / norm(pos1 - pos2)
+        r1 = pos1 - self.placementBase( self.obj1Name, X )
+        r2 = pos2 - self.placementBase( self.obj2Name, X )
+        return {
+            self.obj1Name : ( n, crossProduct( r1, n ) ),
+            self.obj2Name : ( -n, -crossProduct( r2, n ) )
+            }
 
     def analyticalSolution(self):
         D = self.solveConstraintEq_dofs #degrees of freedom
@@ -810,9 +1304,65 @@ class VertexUnion(ConstraintSystemPrototype):
                     self.parentSystem.update() # required else degrees of freedom whose systems are more then 1 level up the constraint system tree do not update
                     self.sys2.update()
                     return True
-
+        for objName in [self.obj1Name, self.obj2Name]:
+            if self.pivotRotations( objName, D ) != None:
+                if self.rotateAboutPivot( objName ):
+                    if debugPrint.level >= 3: dp('    %s analyticalSolution available by rotating %s about its pivot.'% (self.label, objName))
+                    self.parentSystem.update()
+                    self.sys2.update()
+                    return True
         return False
 
+    def pos_r( self, objName ):
+        return self.pos1_r if objName == self.obj1Name else self.pos2_r
+
+    def pivotSystem( self, objName ):
+        '''
+        VertexUnion up the heirachy which removed the linear displacement degrees of freedom of objName, so that adjusting objName's rotation degrees of freedom
+        (and updating the parent systems) rotates objName about that VertexUnion's point, the pivot. None if there is no such VertexUnion.
+        '''
+        system = self.parentSystem
+        while system != None:
+            if isinstance( system, VertexUnion ) and system.pivotObject == objName:
+                return system
+            system = system.parentSystem
+        return None
+
+    def pivotRotations( self, objName, D ):
+        'the 3 placement rotation degrees of freedom of objName in D, if objName can only rotate about a pivot (see pivotSystem), else None'
+        if any( d.objName == objName and not d.rotational() for d in D ):
+            return None
+        rotations = [ d for d in D if d.objName == objName and isinstance( d, PlacementDegreeOfFreedom ) and d.rotational() ]
+        if len(rotations) == 3 and self.pivotSystem( objName ) != None:
+            return rotations
+        return None
+
+    def rotateAboutPivot( self, objName, tol=10**-9 ):
+        '''
+        spherical joint on an object which can only rotate about a pivot; closed form solution rotating objName about the pivot,
+        so that its vertex is moved onto the other objects vertex. Only possible if both vertices are the same distance from the pivot.
+        '''
+        vM = self.variableManager
+        X = vM.X
+        otherName = self.obj2Name if objName == self.obj1Name else self.obj1Name
+        pivot = vM.rotateAndMove( objName, self.pivotSystem( objName ).pos_r( objName ), X )
+        u = vM.rotateAndMove( objName, self.pos_r( objName ), X ) - pivot
+        v = vM.rotateAndMove( otherName, self.pos_r( otherName ), X ) - pivot
+        if norm(u) == 0 or abs( norm(u) - norm(v) ) > tol:
+            if debugPrint.level >= 4: dp('    %s %s vertex and target at different distances from pivot (%e, %e)' % (self.label, objName, norm(u), norm(v)))
+            return False
+        c = crossProduct( u, v )
+        if norm(c) > 0:
+            axis = normalize(c)
+        else: #u and v aligned or opposite
+            axis, notUsed = plane_degrees_of_freedom( normalize(u) )
+        R_align = axis_rotation_matrix( arctan2( norm(c), dotProduct(u, v) ), *axis )
+        i = vM.index[objName]
+        R = dotProduct( R_align, vM.rotationMatrix( objName, X ) )
+        X[i:i+3] = dotProduct( R_align, X[i:i+3] - pivot ) + pivot
+        X[i+3:i+6] = azimuth_elevation_rotation_angles( R )
+        return True
+
     def generateDegreesOfFreedomAnalytically( self ):
         D = self.parentSystem.degreesOfFreedom + self.sys2.degreesOfFreedom
         self.degreesOfFreedom = []
@@ -823,15 +1373,29 @@ class VertexUnion(ConstraintSystemPrototype):
             if len(matches) == 3: #todo somehow add support for 3,2 cases
                 if debugPrint.level >= 3: dp('  VertexUnion Logic: %s removing all 3 movement degrees of freedom' % objName )
                 self.degreesOfFreedom = [ d for d in D if not d in matches ] 
+                self.pivotObject = objName
                 success = True
                 break
+        if not success:
+            for objName in [self.obj1Name, self.obj2Name]:
+                rotations = self.pivotRotations( objName, D )
+                if rotations != None and norm( self.pos_r( objName ) - self.pivotSystem( objName ).pos_r( objName ) ) > 0:
+                    if debugPrint.level >= 3: dp('  VertexUnion Logic: %s can only rotate about its pivot, reducing rotation degrees of freedom from 3 to 1' % objName )
+                    self.rotationDOF = AxisRotationDegreeOfFreedom( self, objName )
+                    self.rotationAxis_r = normalize( self.pos_r( objName ) - self.pivotSystem( objName ).pos_r( objName ) ) #line through the pivot and the vertex, relative to objName
+                    self.degreesOfFreedom = [ d for d in D if not d in rotations ] + [ self.rotationDOF ]
+                    self.updateDegreesOfFreedomAnalytically()
+                    success = True
+                    break
         return success
         #if not success:
         #    raise NotImplementedError, 'Panic! PlaneOffsetUnion Logic not programmed for the reduction of degrees of freedom of:\n%s' % '\n'.join(d.str('  ') for d in dofs )
 
         
     def updateDegreesOfFreedomAnalytically( self):
-        pass
+        if self.rotationDOF != None:
+            vM = self.variableManager
+            self.rotationDOF.setAxis( vM.rotate( self.rotationDOF.objName, self.rotationAxis_r, vM.X ), self.rotationAxis_r )
 
 
 
@@ -847,7 +1411,10 @@ class LockRelativeAxialRotationUnion(ConstraintSystemPrototype):
         self.objectToLock = sys.sys2.objName
 
     def constraintEq_value( self, X ):
-        return 0
+        return numpy.zeros( X.shape[:-1] )
+
+    def constraintEq_gradient( self, X ):
+        return {}
 
     def generateDegreesOfFreedomAnalytically( self ):
         #only works for simple case described below
@@ -866,6 +1433,9 @@ class LockRelativeAxialRotationUnion(ConstraintSystemPrototype):
     def updateDegreesOfFreedomAnalytically( self):
         pass
 
+    def detachedUnions( self ):
+        return [] #removes a degree-of-freedom, rather than adding a constraint equation
+
 
 class AddFreeObjectsUnion(ConstraintSystemPrototype): #for adding free objects to parent system which are not constrainted to the parent system
     label = 'AddFreeObjectsUnion'
@@ -888,7 +1458,10 @@ class AddFreeObjectsUnion(ConstraintSystemPrototype): #for adding free objects t
         if debugPrint.level >= 3 : dp('AddFreeObjectsUnion resulting system:\n%s' % self.str(indent=' '*4, addDOFs=debugPrint.level>3))
 
     def constraintEq_value( self, X ):
-        return 0
+        return numpy.zeros( X.shape[:-1] )
+
+    def constraintEq_gradient( self, X ):
+        return {}
 
     def generateDegreesOfFreedomAnalytically( self ):
         self.degreesOfFreedom =  self.parentSystem.degreesOfFreedom + self.sys2.degreesOfFreedom +  self.sys3.degreesOfFreedom
@@ -896,3 +1469,124 @@ class AddFreeObjectsUnion(ConstraintSystemPrototype): #for adding free objects t
         
     def updateDegreesOfFreedomAnalytically( self):
         pass
+
+    def detachedUnions( self ):
+        return []
+
+
+class RigidClusterUnion(ConstraintSystemPrototype):
+    '''
+    replaces the constraints between 2 objects which fully constrain their relative placement (see assembly2solver.rigidPairs).
+    The member object is placed relative to the root object in closed form, so that the pair is presented to the rest of the heiracy as a rigid body with the root object's degrees-of-freedom.
+    placement of member = placement of root * ( R_rel, p_rel )
+    '''
+    label = 'RigidClusterUnion'
+
+    def __init__(self, parentSystem, variableManager, constraintObjs, rootName, memberName, R_rel, p_rel ):
+        self.parentSystem = parentSystem
+        self.variableManager = variableManager
+        self.constraintObj = constraintObjs[0]
+        self.constraintObjs = constraintObjs
+        self.obj1Name = rootName
+        self.obj2Name = memberName
+        self.subElement1 = ''
+        self.subElement2 = ''
+        self.R_rel = R_rel
+        self.p_rel = p_rel
+        self.constraintValue = None
+        self.sys2 = FreeObjectSystem( variableManager, memberName ) if not parentSystem.containtsObject( memberName ) else EmptySystem()
+        self.childSystem = None
+        parentSystem.childSystem = self
+        self.solveConstraintEq()
+        if debugPrint.level >= 3 : dp('RigidClusterUnion resulting system:\n%s' % self.str(indent=' '*4, addDOFs=debugPrint.level>3))
+
+    def constraintEq_value( self, X ):
+        'distance between the member placement and the root placement * (R_rel, p_rel), with the rotation error taken as the Frobenius norm'
+        vM = self.variableManager
+        i = vM.index[self.obj1Name]
+        j = vM.index[self.obj2Name]
+        R_root = vM.rotationMatrix( self.obj1Name, X )
+        error_p = X[j:j+3] - ( dotProduct( R_root, self.p_rel ) + X[i:i+3] )
+        error_R = vM.rotationMatrix( self.obj2Name, X ) - dotProduct( R_root, self.R_rel )
+        return ( dotProducts( error_p, error_p ) + numpy.sum( error_R**2 ) )**0.5
+
+    def analyticalSolution(self):
+        vM = self.variableManager
+        i = vM.index[self.obj1Name]
+        R = dotProduct( vM.rotationMatrix( self.obj1Name, vM.X ), self.R_rel )
+        j = vM.index[self.obj2Name]
+        vM.X[j:j+3] = vM.rotateAndMove( self.obj1Name, self.p_rel, vM.X )
+        vM.X[j+3:j+6] = azimuth_elevation_rotation_angles( R )
+        return True
+
+    def generateDegreesOfFreedomAnalytically( self ):
+        self.degreesOfFreedom = [ d for d in self.parentSystem.degreesOfFreedom + self.sys2.degreesOfFreedom if d.objName != self.obj2Name ]
+        return True
+
+    def updateDegreesOfFreedomAnalytically( self ):
+        pass
+
+    def detachedUnions( self ):
+        return [ ConstraintSystemClass( None, self.variableManager, c, constraintValue ) for c in self.constraintObjs for ConstraintSystemClass, constraintValue in constraintUnions( c ) if ConstraintSystemClass != LockRelativeAxialRotationUnion ]
+
+    def str(self, indent='', addDOFs=False):
+        txt = '%s<%s System %s-%s (%s) heirachy %i>' % (indent, self.label, self.obj1Name, self.obj2Name, ','.join( c.Name for c in self.constraintObjs ), self.numberOfParentSystems())
+        if addDOFs and hasattr( self, 'degreesOfFreedom'):
+            txt = txt + ' %i degrees of freedom:' % len(self.degreesOfFreedom)
+            txt = txt + ''.join( [ '\n%s%s' %(indent, d.str('  ')) for d in  self.degreesOfFreedom ] )
+        return txt
+
+
+class DisjointSystems:
+    '''
+    constraint systems for independent groups of constraints (see assembly2solver.constraintComponents), which share the variableManager but no objects other than fixed objects.
+    '''
+    label = 'DisjointSystems'
+    def __init__(self, variableManager, systems):
+        self.variableManager = variableManager
+        self.systems = systems
+        self.parentSystem = None
+        self.childSystem = None
+        self.degreesOfFreedom = sum( [ s.degreesOfFreedom for s in systems ], [] )
+
+    def containtsObject( self, objName ):
+        return any( s.containtsObject( objName ) for s in self.systems )
+
+    def update( self ):
+        for s in self.systems:
+            s.update()
+
+    def numberOfParentSystems( self ):
+        return max( s.numberOfParentSystems() for s in self.systems )
+
+    def str(self, indent='', addDOFs=False):
+        return '%s<%s %i systems, %i degrees of freedom>' % (indent, self.label, len(self.systems), len(self.degreesOfFreedom))
+
+    def strSystemTree(self, dofs=True):
+        return '\n'.join( [ self.str() ] + [ s.strSystemTree( dofs ) for s in self.systems ] )
+
+
+def axisDistance( constraintObj ):
+    'distance between the axes of an axial or circularEdge constraint, 0 if the constraint has no axisDistance property (see assembly2lib.updateObjectProperties)'
+    return constraintObj.axisDistance.Value if hasattr( constraintObj, 'axisDistance' ) else 0
+
+def constraintUnions( constraintObj ):
+    'returns the constraint systems, [ (ConstraintSystemClass, constraintValue), ... ], used to represent the assembly 2 constraint constraintObj'
+    if constraintObj.Type == 'plane':
+        unions = []
+        if constraintObj.SubElement2.startswith('Face'): #otherwise vertex
+            unions.append( (AxisAlignmentUnion, constraintObj.directionConstraint) )
+        unions.append( (PlaneOffsetUnion, constraintObj.offset.Value) )
+    elif constraintObj.Type == 'angle_between_planes':
+        unions = [ (AngleUnion, constraintObj.angle.Value*pi/180) ]
+    elif constraintObj.Type == 'axial':
+        unions = [ (AxisAlignmentUnion, constraintObj.directionConstraint), (AxisDistanceUnion, axisDistance(constraintObj)) ]
+        if constraintObj.lockRotation: unions.append( (LockRelativeAxialRotationUnion, 0) )
+    elif constraintObj.Type == 'circularEdge':
+        unions = [ (AxisAlignmentUnion, constraintObj.directionConstraint), (AxisDistanceUnion, axisDistance(constraintObj)), (PlaneOffsetUnion, constraintObj.offset.Value) ]
+        if constraintObj.lockRotation: unions.append( (LockRelativeAxialRotationUnion, 0) )
+    elif constraintObj.Type == 'sphericalSurface':
+        unions = [ (VertexUnion, 0) ]
+    else:
+        raise NotImplementedError('constraintType %s not supported yet' % constraintObj.Type)
+    return unions
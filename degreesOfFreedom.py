@@ -31,6 +31,12 @@ class PlacementDegreeOfFreedom:
             return pi/5
     def rotational(self):
         return self.ind % 6 > 2
+    def twist(self):
+        'translation and angular velocity (about the placement base) of the object for a unit increase in value'
+        if self.ind % 6 < 3:
+            return self.directionVector, numpy.zeros(3)
+        i = self.ind - self.ind % 6
+        return numpy.zeros(3), azimuth_elevation_angular_velocities( *self.vM.X[i+3:i+6] )[ self.ind % 6 - 3 ]
     def migrate_to_new_variableManager( self, new_vM):
         self.vM = new_vM
         self.ind =  new_vM.index[self.objName] + self.object_dof
@@ -60,6 +66,8 @@ class LinearMotionDegreeOfFreedom:
         return maxStep_linearDisplacement #inf
     def rotational(self):
         return False
+    def twist(self):
+        return self.directionVector, numpy.zeros(3)
     def migrate_to_new_variableManager( self, new_vM):
         self.vM = new_vM
         self.objInd =  new_vM.index[self.objName]
@@ -126,7 +134,7 @@ class AxisRotationDegreeOfFreedom:
 
     def getValue( self, refApproach=True, tol=10**-7 ):
         i = self.objInd
-        R_effective = azimuth_elevation_rotation_matrix( *self.vM.X[i+3:i+6] )
+        R_effective = self.vM.rotationMatrix( self.objName, self.vM.X )
         if refApproach:
             v = dotProduct( R_effective, self.x_ref_r)
             if tol != None and abs( dotProduct(v, self.axis) ) > tol:
@@ -158,6 +166,8 @@ class AxisRotationDegreeOfFreedom:
         return pi/5
     def rotational(self):
         return True
+    def twist(self):
+        return numpy.zeros(3), self.axis
     def migrate_to_new_variableManager( self, new_vM):
         self.vM = new_vM
         self.objInd =  new_vM.index[self.objName]
@@ -167,6 +177,118 @@ class AxisRotationDegreeOfFreedom:
         return self.str()
 
 
+class LocalRotations:
+    '''
+    rotation of objName as increments ( v_x, v_y, v_z ) about the global x, y and z axes to a reference orientation, stored as the unit quaternion q_ref:
+      R = R_z(v_z) * R_y(v_y) * R_x(v_x) * R_ref
+    which is regular about v = 0 for any R_ref; whereas the azimuth, elevation and rotation angle placement variables are singular at elevation = +-pi/2.
+    The placement variables in X remain the azimuth, elevation and rotation angle, which are written by each setValue, at the cost of converting the quaternion to an axis and angle, and the axis to an azimuth and elevation.
+    The reference orientation is taken from the placement variables when created (i.e. once per numerical solution, see ConstraintSystemPrototype.solveConstraintEq and localRotationDofs), and then held fixed,
+    so that the placement written for given increments does not depend on whatever else wrote the placement variables in between (i.e. a parent system being updated).
+    '''
+    def __init__(self, vM, objName):
+        self.vM = vM
+        self.objName = objName
+        self.objInd = vM.index[objName]
+        i = self.objInd
+        azi, ela, theta = vM.X[i+3:i+6]
+        self.q_ref = numpy.array( quaternion2( theta, *azimuth_and_elevation_angles_to_axis( azi, ela ) ) )
+        self.values = numpy.zeros(3)
+        self.written = vM.X[i+3:i+6].copy()
+
+    def getValue( self, k ):
+        return self.values[k]
+
+    def setValue( self, k, value ):
+        i = self.objInd
+        if self.values[k] == value and numpy.array_equal( self.written, self.vM.X[i+3:i+6] ):
+            return
+        self.values[k] = value
+        q = self.q_ref
+        for j in range(3):
+            if self.values[j] != 0:
+                q = quaternion_multiply( quaternion2( self.values[j], *numpy.eye(3)[j] ), q )
+        axis, theta = quaternion_to_axis_and_angle( q[1], q[2], q[3], q[0] )
+        azi, ela = axis_to_azimuth_and_elevation_angles( *axis )
+        self.vM.X[i+3:i+6] = azi, ela, theta
+        self.written = self.vM.X[i+3:i+6].copy()
+
+    def angularVelocity( self, k ):
+        'angular velocity for a unit increase in v_k'
+        w = numpy.eye(3)[k]
+        for j in range(k+1, 3):
+            w = dotProduct( axis_rotation_matrix( self.values[j], *numpy.eye(3)[j] ), w )
+        return w
+
+
+class LocalRotationDegreeOfFreedom:
+    'rotation of objName about the global axis k (0,1,2 for x,y,z) through its placement base, as an increment to a reference orientation; see LocalRotations'
+    def __init__(self, localRotations, k):
+        self.localRotations = localRotations
+        self.objName = localRotations.objName
+        self.k = k
+    def getValue( self ):
+        return self.localRotations.getValue( self.k )
+    def setValue( self, value ):
+        self.localRotations.setValue( self.k, value )
+    def maxStep(self):
+        return pi/5
+    def rotational(self):
+        return True
+    def twist(self):
+        return numpy.zeros(3), self.localRotations.angularVelocity( self.k )
+    def str(self, indent=''):
+        return '%s<LocalRotation DegreeOfFreedom %s-%s value:%f>' % (indent, self.objName, 'xyz'[self.k], self.getValue())
+    def __repr__(self):
+        return self.str()
+
+class NullSpaceDegreeOfFreedom:
+    '''
+    motion along the null space vector v of the constraint Jacobian at the solution of a GlobalConstraintSystem, where v holds the translation and local rotation increments (see LocalRotations) of the non-fixed objects.
+    The increments are sum_k value_k * v_k over the null space vectors of the system, which is then updated to remove the second order constraint violations.
+    objName is the object which v moves the most.
+    '''
+    def __init__(self, parentSystem, k, v):
+        self.system = parentSystem
+        self.vM = parentSystem.variableManager
+        self.k = k
+        self.v = v
+        self.objName = max( parentSystem.freeObjects, key=lambda objName: norm( v[ parentSystem.columns[objName] ] ) )
+        self.v_obj = v[ parentSystem.columns[self.objName] ]
+    def getValue( self ):
+        return self.system.nullSpaceValues[self.k]
+    def setValue( self, value ):
+        self.system.nullSpaceValues[self.k] = value
+        self.system.setNullSpaceValues()
+    def maxStep(self):
+        return pi/5 if self.rotational() else maxStep_linearDisplacement
+    def rotational(self):
+        return norm( self.v_obj[3:] ) > norm( self.v_obj[:3] )
+    def twist(self):
+        return self.v_obj[:3], self.v_obj[3:]
+    def str(self, indent=''):
+        return '%s<NullSpace DegreeOfFreedom %s value:%f>' % (indent, self.objName, self.getValue())
+    def __repr__(self):
+        return self.str()
+
+def localRotationDofs( dofs ):
+    '''
+    dofs, with the azimuth, elevation and rotation angle PlacementDegreeOfFreedoms of each object with all 3 replaced by LocalRotationDegreeOfFreedoms.
+    Used for numerical solutions (see ConstraintSystemPrototype.localRotations), as Newton steps in the increments do not suffer from the elevation = +-pi/2 singularity.
+    '''
+    rotations = {}
+    for d in dofs:
+        if isinstance( d, PlacementDegreeOfFreedom ) and d.rotational():
+            rotations.setdefault( d.objName, [] ).append( d )
+    replaced = {}
+    for objName, matches in rotations.items():
+        if sorted( d.ind % 6 for d in matches ) == [3,4,5]:
+            L = LocalRotations( matches[0].vM, objName )
+            for k, d in enumerate( sorted( matches, key=lambda d: d.ind ) ):
+                replaced[d] = LocalRotationDegreeOfFreedom( L, k )
+    return [ replaced.get( d, d ) for d in dofs ]
+
+
 if __name__ == '__main__':
     from numpy.random import rand
     import sys
@@ -81,6 +81,7 @@ class AnimateDegreesOfFreedomTaskPanel:
     def reject(self): #or more correctly close, given the button settings
         if  'animation' in moduleVars:
             moduleVars['animation'].timer.stop()
+            self.constraintSystem.variableManager.invalidateWritten()
             self.constraintSystem.variableManager.updateFreeCADValues(moduleVars['animation'].X_before_animation)
             del moduleVars['animation']
         FreeCADGui.Control.closeDialog()
@@ -98,6 +99,7 @@ class AnimateDOF(object):
         self.degreesOfFreedomToAnimate = degreesOfFreedomToAnimate
         self.Y0 = numpy.array([ d.getValue() for d in degreesOfFreedomToAnimate] )
         self.X_before_animation = constraintSystem.variableManager.X.copy()
+        constraintSystem.variableManager.invalidateWritten() #placements may have been changed since the constraint system was solved
         self.framesPerDOF = framesPerDOF
         self.rotationAmplification = rotationAmplification
         self.linearDispAmplification = linearDispAmplification
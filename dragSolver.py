@@ -0,0 +1,110 @@
+'''
+Drag solve
+----------
+
+Keeps a solved constraint system in memory while a part is dragged (see importPart.PartMover), so that the constraints stay satisfied during the drag rather than requiring a full solve afterwards.
+
+On each mouse event the cursor position is treated as a soft target for the placement base of the dragged object.
+The degrees-of-freedom of the constraint system which move the dragged object are adjusted to minimize the distance between its placement base and the target,
+using a few Levenberg-Marquardt iterations warm-started from the previous frame's placement variables.
+Only the independent group of constraints (see assembly2solver.constraintComponents) containing the dragged object is solved,
+and each evaluation only updates the union systems up to the last one containing the dragged object (see dragSystem), re-solving those whose objects have moved (see ConstraintSystemPrototype.upToDate).
+The rest of the group is updated once the frame's placement variables are found.
+If the constraint system can not be updated, the dragged object is moved to the cursor without the constraints, as when not solving while moving.
+'''
+
+from assembly2lib import *
+import numpy
+from numpy.linalg import norm
+from solverLib import solve_via_Levenberg_Marquardt, GradientApproximatorForwardDifference
+from constraintSystems import Assembly2SolverError
+from assembly2solver import solveConstraints
+
+class DragSolver:
+    def __init__( self, doc, objName, maxIt=4, eps=10**-4 ):
+        '''
+        solves the constraints of the group containing objName, without writing the FreeCAD placements, and determines which degrees-of-freedom move the placement base of objName.
+        self.system is None if the constraints could not be solved or objName is not constrained, in which case the object should be moved directly.
+        '''
+        self.objName = objName
+        self.maxIt = maxIt
+        self.system = None
+        self.dofs = []
+        if not any( objName in [c.Object1, c.Object2] for c in doc.Objects if 'ConstraintInfo' in c.Content ):
+            return
+        constraintSystem = solveConstraints( doc, showFailureErrorDialog=False, printErrors=False, engine='hierarchical', objName=objName, updatePlacements=False )
+        if constraintSystem == None or not constraintSystem.containtsObject( objName ):
+            return
+        self.variableManager = vM = constraintSystem.variableManager
+        self.ind = vM.index[objName]
+        self.system = constraintSystem
+        self.dragSystem = constraintSystem
+        while self.dragSystem.parentSystem != None and not objName in [ getattr( self.dragSystem, 'obj1Name', None ), getattr( self.dragSystem, 'obj2Name', None ) ]:
+            self.dragSystem = self.dragSystem.parentSystem #later unions do not move objName
+        X_solved = vM.X.copy()
+        base = self.base()
+        for d in self.system.degreesOfFreedom:
+            v = d.getValue()
+            try:
+                d.setValue( v + eps )
+                self.dragSystem.update()
+                if norm( self.base() - base ) > 10**-9:
+                    self.dofs.append( d )
+            except Assembly2SolverError:
+                pass
+            vM.X = X_solved.copy()
+            self.system.update()
+        debugPrint( 3, 'DragSolver: %i of %i degrees-of-freedom move %s' % ( len(self.dofs), len(self.system.degreesOfFreedom), objName ) )
+        if len( self.dofs ) == 0:
+            self.system = None
+
+    def base( self ):
+        i = self.ind
+        return self.variableManager.X[i:i+3].copy()
+
+    def setY( self, Y, system=None ):
+        for d,y in zip( self.dofs, Y ):
+            d.setValue( y )
+        ( system or self.dragSystem ).update()
+
+    def f( self, Y ):
+        self.setY( Y )
+        return self.base() - self.target
+
+    def moveTo( self, target ):
+        '''
+        moves the dragged object towards target while satisfying the constraints, starting from the previous frame's placement variables, and updates the FreeCAD placements.
+        returns False if the constraint system could not be updated, in which case the other objects keep the previous frame's placements and the dragged object is moved to target without the constraints.
+        '''
+        vM = self.variableManager
+        self.target = numpy.array( target, dtype=float )
+        X_prev = vM.X.copy()
+        Y0 = [ d.getValue() for d in self.dofs ]
+        try:
+            Y = solve_via_Levenberg_Marquardt(
+                self.f,
+                Y0,
+                [ d.maxStep() for d in self.dofs ],
+                grad_f = GradientApproximatorForwardDifference( self.f ),
+                x_tol = 10**-6,
+                maxIt = self.maxIt
+                )
+            self.setY( Y, self.system )
+            if not numpy.isfinite( vM.X ).all():
+                raise ValueError('non-finite placement variables')
+        except ( Assembly2SolverError, ValueError, numpy.linalg.LinAlgError ):
+            debugPrint( 3, 'DragSolver: unable to update constraint system, moving %s without the constraints' % self.objName )
+            vM.X = X_prev
+            if numpy.isfinite( self.target ).all():
+                vM.X[self.ind:self.ind+3] = self.target
+            vM.updateFreeCADValues( vM.X )
+            return False
+        vM.updateFreeCADValues( vM.X )
+        return True
+
+    def reset( self ):
+        'restores the placements read before the constraints were solved, i.e. from before the drag'
+        vM = self.variableManager
+        vM.X = vM.X0.copy()
+        vM.invalidateWritten() #all placements restored, including any changed outside of the drag solver
+        vM.updateFreeCADValues( vM.X )
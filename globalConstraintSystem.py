@@ -0,0 +1,199 @@
+'''
+Global constraint solver
+------------------------
+
+Alternative to the heiracical constraint system (see constraintSystems.py), where every child system re-solves its parent systems on each function evaluation.
+Here all the constraint equations are collected into a single residual vector, over the translations and local rotations (see LocalRotations) of the non-fixed objects,
+and solved simultaneously using solve_via_Levenberg_Marquardt, until every constraint's constraintEq_value is within its tolerance (the same test as the hierarchical engine).
+The residuals are evaluated using the flattened constraint representation (see constraintArrays.py), a single vectorized pass per constraint type.
+The lockRotation constraint property is not supported (it removes a degree-of-freedom rather than adding a constraint equation), and the degrees-of-freedom are determined from the Jacobian at the solution rather than from each union.
+
+Each constraint equation only depends on the placement variables of 2 objects,
+so that the Jacobian is stored as a SparseJacobian with a block of 12 columns per constraint equation.
+The closed-form constraint gradients are used where available, the remaining blocks are finite differenced with column colouring,
+so that the number of residual evaluations depends on how many objects are constrained to each other rather than the number of objects.
+
+Nomeclature as in constraintSystems.py, with
+Y - translations and local rotation increments of the non-fixed objects
+'''
+
+from assembly2lib import *
+from lib3D import *
+import numpy
+from numpy.linalg import norm
+from solverLib import *
+from constraintSystems import *
+from constraintArrays import ConstraintArrays
+from degreesOfFreedom import NullSpaceDegreeOfFreedom, localRotationDofs
+import solverTelemetry
+
+class GlobalConstraintSystem:
+    label = 'GlobalConstraintSystem'
+    maxIt = 200 #Levenberg-Marquardt iterations
+    def __init__(self, variableManager, baseObjectName, constraintObjects ):
+        self.variableManager = variableManager
+        self.parentSystem = None
+        self.childSystem = None
+        vM = variableManager
+        self.constraints = [] #detached constraint systems
+        for c in constraintObjects:
+            for ConstraintSystemClass, constraintValue in constraintUnions( c ):
+                if ConstraintSystemClass == LockRelativeAxialRotationUnion: #removes a degree-of-freedom, rather than adding a constraint equation
+                    raise NotImplementedError('%s: lockRotation of %s not supported, use the hierarchical engine' % (self.label, c.Name))
+                self.constraints.append( ConstraintSystemClass( None, vM, c, constraintValue ) )
+        self.fixedObjects = [ objName for objName in vM.index.keys() if objName == baseObjectName or getattr( vM.doc.getObject(objName), 'fixedPosition', False ) ]
+        self.freeObjects = sorted( [ objName for objName in vM.index.keys() if not objName in self.fixedObjects ], key=lambda objName: vM.index[objName] )
+        self.solveConstraintEq_dofs = sum( [ FreeObjectSystem( vM, objName ).degreesOfFreedom for objName in self.freeObjects ], [] )
+        self.solveVariables = localRotationDofs( self.solveConstraintEq_dofs ) #reference orientations updated each solve
+        self.columns = {} #objName : columns of its translations and local rotations in Y
+        for j, objName in enumerate( self.freeObjects ):
+            self.columns[objName] = list( range(6*j, 6*j+6) )
+        self.degreesOfFreedom = [] #see determineDegreesOfFreedom
+        if debugPrint.level >= 3: dp('%s: %i constraint equations, %i placement variables' % (self.label, len(self.constraints), len(self.solveConstraintEq_dofs)))
+
+    def containtsObject( self, objName ):
+        return objName in self.variableManager.index
+
+    def constraintEq_setY(self, Y):
+        for d,y in zip( self.solveVariables, Y):
+            d.setValue(y)
+
+    def constraintsSatisfied( self, Y ):
+        'stopping test for solve_via_Levenberg_Marquardt, in the same units as the acceptance test in solve'
+        self.constraintEq_setY(Y)
+        X = self.variableManager.X
+        return all( abs( c.constraintEq_value( X ) ) <= c.solveConstraintEq_tol for c in self.constraintEqs )
+
+    def constraintEq_f( self, Y ):
+        solverTelemetry.count('residualEvaluations')
+        self.constraintEq_setY(Y)
+        return self.constraintArrays.residuals( self.variableManager.X )
+
+    def constraintEq_f_batch( self, Ys, constraintArrays ):
+        'residuals of constraintArrays for a stack of Y values, evaluated in a single pass over the stacked placement variables'
+        solverTelemetry.count('residualEvaluations', len(Ys))
+        vM = self.variableManager
+        Y_org = [ d.getValue() for d in self.solveVariables ]
+        Xs = numpy.zeros([ len(Ys), len(vM.X) ])
+        for k, Y in enumerate( Ys ):
+            self.constraintEq_setY( Y )
+            Xs[k] = vM.X
+        self.constraintEq_setY( Y_org )
+        return constraintArrays.residuals( Xs )
+
+    def constraintEq_grad( self, Y ):
+        '''
+        Jacobian of constraintEq_f as a SparseJacobian, where each constraint's block covers the placement variables of its 2 objects.
+        The closed-form gradient is used for constraints with a single residual, combined with the twist of each translation and local rotation,
+        the other blocks are central differenced with column colouring.
+        '''
+        self.constraintEq_setY(Y)
+        X = self.variableManager.X
+        J = SparseJacobian( (self.rows[-1].stop, len(Y)), self.footprint )
+        fd_indices = [] #constraints to be finite differenced
+        for k, (c, B) in enumerate( zip( self.constraintEqs, J.blocks ) ):
+            G = c.constraintEq_gradient( X ) if B.shape[0] == 1 else None
+            if G != None:
+                for j, col in enumerate( self.footprint[k][1] ):
+                    d = self.solveVariables[col]
+                    if d.objName in G:
+                        dt, dw = d.twist()
+                        B[0,j] = dotProduct( G[d.objName][0], dt ) + dotProduct( G[d.objName][1], dw )
+            else:
+                fd_indices.append( k )
+        if len(fd_indices) > 0:
+            if fd_indices != self.fd_indices: #closed-form gradient not always available, i.e. AxisDistanceUnion with a distance of 0
+                self.setup_fd_gradientApproximator( fd_indices )
+            J_fd = self.gradientApproximator_fd( numpy.array(Y) )
+            for k, B_fd in zip( fd_indices, J_fd.blocks ):
+                J.blocks[k][:,:] = B_fd
+        return J
+
+    def setup_fd_gradientApproximator( self, fd_indices ):
+        self.fd_indices = fd_indices
+        fd_constraints = ConstraintArrays( self.variableManager, [ self.constraintEqs[k] for k in fd_indices ] )
+        footprint = []
+        for k in fd_indices:
+            rows, cols = self.footprint[k]
+            start = footprint[-1][0].stop if len(footprint) > 0 else 0
+            footprint.append( ( slice(start, start + rows.stop - rows.start), cols ) )
+        self.gradientApproximator_fd = GradientApproximatorSparseCentralDifference(
+            lambda Ys: self.constraintEq_f_batch( Ys, fd_constraints ), 
+            ( footprint[-1][0].stop, len(self.solveVariables) ), 
+            footprint,
+            batch=True )
+        if debugPrint.level >= 4: dp('  %s: %i of %i constraints finite differenced, using %i colours for %i columns' % (self.label, len(fd_indices), len(self.constraintEqs), self.gradientApproximator_fd.noColours, len(self.solveVariables)))
+
+    def solve( self ):
+        vM = self.variableManager
+        self.failedConstraint = None
+        self.constraintEqs = [ c for c in self.constraints if c.obj1Name in self.columns or c.obj2Name in self.columns ]
+        self.constraintArrays = ConstraintArrays( vM, self.constraintEqs )
+        self.rows = [ slice( start, stop ) for start, stop in zip( self.constraintArrays.rows[:-1], self.constraintArrays.rows[1:] ) ] #rows of each constraints residuals in constraintEq_f
+        self.footprint = [] #rows and the columns of Y they depend on, for each constraint
+        for c, rows in zip( self.constraintEqs, self.rows ):
+            self.footprint.append( ( rows, sum( [ self.columns[objName] for objName in [c.obj1Name, c.obj2Name] if objName in self.columns ], [] ) ) )
+        self.fd_indices = []
+        if len(self.constraintEqs) > 0:
+            solverTelemetry.count('numericalSolutions')
+            self.solveVariables = localRotationDofs( self.solveConstraintEq_dofs )
+            Y0 = [ d.getValue() for d in self.solveVariables ]
+            yOpt = solve_via_Levenberg_Marquardt(
+                self.constraintEq_f,
+                Y0,
+                [ d.maxStep() for d in self.solveVariables ],
+                grad_f = self.constraintEq_grad,
+                converged = self.constraintsSatisfied, #residuals are not scaled the same as constraintEq_value
+                x_tol = 0,
+                maxIt = self.maxIt,
+                debugPrintLevel = debugPrint.level-2,
+                printF = lambda txt: debugPrint(2, txt )
+                )
+            self.constraintEq_setY(yOpt)
+        for c in self.constraints:
+            if abs( c.constraintEq_value( vM.X ) ) > c.solveConstraintEq_tol:
+                self.failedConstraint = c
+                raise Assembly2SolverError("%s abs( constraintEq_value(X) ) > tol [%e > %e]" % (c.str(), abs( c.constraintEq_value(vM.X) ), c.solveConstraintEq_tol))
+
+    def determineDegreesOfFreedom( self, tol=10**-6 ):
+        '''
+        degrees-of-freedom of the solved system, from the null space of the constraint Jacobian at the solution (see NullSpaceDegreeOfFreedom),
+        unlike the hierarchical engine where they are determined from the geometry of each union.
+        The Jacobian is taken with respect to the translations and local rotations (see LocalRotations) of the non-fixed objects,
+        as the azimuth, elevation and rotation angle placement variables do not move an object in every direction (i.e. at a rotation angle of 0).
+        '''
+        self.X_ref = self.variableManager.X.copy()
+        self.nullSpaceDofs = localRotationDofs( self.solveConstraintEq_dofs )
+        self.nullSpaceDofs_ref = [ d.getValue() for d in self.nullSpaceDofs ]
+        if len(self.constraintEqs) > 0:
+            J = GradientApproximatorCentralDifference( self.nullSpaceResiduals )( numpy.zeros( len(self.nullSpaceDofs) ) )
+            U, s, V = numpy.linalg.svd( J )
+            nullSpace = V[ sum( s > tol * max( s.max(), 1 ) ): ]
+        else:
+            nullSpace = numpy.eye( len(self.nullSpaceDofs) )
+        self.setNullSpaceDofs( numpy.zeros( len(self.nullSpaceDofs) ) )
+        self.nullSpaceValues = numpy.zeros( len(nullSpace) )
+        self.degreesOfFreedom = [ NullSpaceDegreeOfFreedom( self, k, v ) for k, v in enumerate( nullSpace ) ]
+
+    def setNullSpaceDofs( self, values ):
+        'sets the placement variables to the solution moved by values, the increments of the translations and local rotations of the non-fixed objects'
+        self.variableManager.X[:] = self.X_ref
+        for d, value_ref, value in zip( self.nullSpaceDofs, self.nullSpaceDofs_ref, values ):
+            d.setValue( value_ref + value )
+
+    def nullSpaceResiduals( self, values ):
+        self.setNullSpaceDofs( values )
+        return self.constraintArrays.residuals( self.variableManager.X )
+
+    def setNullSpaceValues( self ):
+        'called by NullSpaceDegreeOfFreedom.setValue'
+        self.setNullSpaceDofs( numpy.dot( self.nullSpaceValues, [ d.v for d in self.degreesOfFreedom ] ) )
+
+    def update( self ):
+        self.solve()
+
+    def str(self, indent='', addDOFs=False):
+        return '%s<%s %i constraint equations, fixed objects %s>' % (indent, self.label, len(self.constraints), ','.join(self.fixedObjects))
+
+    def strSystemTree(self, dofs=True):
+        return '\n'.join( [self.str()] + [ c.str('  ') for c in self.constraints ] )
@@ -16,6 +16,7 @@ from PySide import QtGui
 import os, numpy, shutil, copy, time, posixpath, ntpath
 from lib3D import *
 from assembly2solver import solveConstraints
+from dragSolver import DragSolver
 from muxAssembly import muxObjects, Proxy_muxAssemblyObj, muxMapColors
 from viewProviderProxies import group_constraints_under_parts
 
@@ -329,19 +330,34 @@ def duplicateImportedPart( part ):
     return newObj
 
 
+def solveWhileMoving():
+    preferences = FreeCAD.ParamGet("User parameter:BaseApp/Preferences/Mod/Assembly2")
+    return preferences.GetBool('solveWhileMoving', False)
+
 class PartMover:
     def __init__(self, view, obj):
         self.obj = obj
         self.initialPostion = self.obj.Placement.Base
         self.copiedObject = False
         self.view = view
+        self.startDragSolve()
         self.callbackMove = self.view.addEventCallback("SoLocation2Event",self.moveMouse)
         self.callbackClick = self.view.addEventCallback("SoMouseButtonEvent",self.clickMouse)
         self.callbackKey = self.view.addEventCallback("SoKeyboardEvent",self.KeyboardEvent)
+    def startDragSolve(self):
+        'if solving while moving, the constraints are kept satisfied during the drag, with the cursor position as a soft target for the part (see dragSolver.py)'
+        self.dragSolver = None
+        if solveWhileMoving() and not self.copiedObject:
+            dragSolver = DragSolver( FreeCAD.ActiveDocument, self.obj.Name )
+            if dragSolver.system != None:
+                self.dragSolver = dragSolver
     def moveMouse(self, info):
         newPos = self.view.getPoint( *info['Position'] )
         debugPrint(5, 'new position %s' % str(newPos))
-        self.obj.Placement.Base = newPos
+        if self.dragSolver != None:
+            self.dragSolver.moveTo( newPos )
+        else:
+            self.obj.Placement.Base = newPos
     def removeCallbacks(self):
         self.view.removeEventCallback("SoLocation2Event",self.callbackMove)
         self.view.removeEventCallback("SoMouseButtonEvent",self.callbackClick)
@@ -354,17 +370,21 @@ class PartMover:
             elif info['ShiftDown']: #copy object
                 self.obj = duplicateImportedPart( self.obj )
                 self.copiedObject = True
+                self.dragSolver = None #the copy is not constrained
             elif info['CtrlDown']:
                 azi   =  ( numpy.random.rand() - 0.5 )*numpy.pi*2
                 ela   =  ( numpy.random.rand() - 0.5 )*numpy.pi
                 theta =  ( numpy.random.rand() - 0.5 )*numpy.pi
                 axis = azimuth_and_elevation_angles_to_axis( azi, ela )
                 self.obj.Placement.Rotation.Q = quaternion( theta, *axis )
+                self.dragSolver = None #the random rotation is not constrained
 
     def KeyboardEvent(self, info):
         debugPrint(4, 'KeyboardEvent info %s' % str(info))
         if info['State'] == 'UP' and info['Key'] == 'ESCAPE':
-            if not self.copiedObject:
+            if self.dragSolver != None:
+                self.dragSolver.reset()
+            elif not self.copiedObject:
                 self.obj.Placement.Base = self.initialPostion
             else:
                 FreeCAD.ActiveDocument.removeObject(self.obj.Name)
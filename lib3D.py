@@ -8,6 +8,10 @@ from numpy.linalg import norm
 dotProduct = numpy.dot
 crossProduct = numpy.cross
 
+def dotProducts( a, b ):
+    'dot product over the last axis, so that stacks of vectors (shape k,3) can be used in place of single vectors'
+    return ( numpy.asarray(a) * b ).sum( axis=-1 )
+
 def arcsin2( v, allowableNumericalError=10**-1 ):
     if -1 <= v and v <= 1:
         return arcsin(v)
@@ -64,14 +68,19 @@ def axis_to_azimuth_and_elevation_angles( u_x, u_y, u_z ):
 
 def quaternion_multiply( q1, q2 ):
     'http://en.wikipedia.org/wiki/Quaternion#Hamilton_product'
-    a_1, b_1, c_1, d_1 = q1
-    a_2, b_2, c_2, d_2 = q2
-    return numpy.array([
+    return quaternion_products( q1, q2 )
+
+def quaternion_products( q1, q2 ):
+    'batched quaternion_multiply, for quaternions of shape (...,4) in wikipedias order (see quaternion2); returns an array of the broadcast shape'
+    a_1, b_1, c_1, d_1 = numpy.rollaxis( numpy.asarray( q1, dtype=float ), -1 )
+    a_2, b_2, c_2, d_2 = numpy.rollaxis( numpy.asarray( q2, dtype=float ), -1 )
+    Q = numpy.array([
            a_1*a_2 - b_1*b_2 - c_1*c_2 - d_1*d_2,
            a_1*b_2 + b_1*a_2 + c_1*d_2 - d_1*c_2,
            a_1*c_2 - b_1*d_2 + c_1*a_2 + d_1*b_2,
            a_1*d_2 + b_1*c_2 - c_1*b_2 + d_1*a_2
            ])
+    return numpy.rollaxis( Q, 0, Q.ndim ) #quaternion components last
 
 def euler_to_quaternion(angle1, angle2, angle3, axis1=3, axis2=2, axis3=1):
     '''http://en.wikipedia.org/wiki/Conversion_between_quaternions_and_Euler_angles '''
@@ -88,12 +97,16 @@ def quaternion_rotation(p, q_1, q_2, q_3, q_0 ):
     rotate the vector p using the quaternion u
     http://en.wikipedia.org/wiki/Quaternions_and_spatial_rotation
     '''
-    q =     numpy.array( [q_0,  q_1,  q_2,  q_3] ) 
-    q_inv = numpy.array( [q_0, -q_1, -q_2, -q_3] ) 
-    p_q =   numpy.array( [  0, p[0], p[1], p[2]] ) #p as a quaternion
-    p_q_rotated = quaternion_multiply( q, quaternion_multiply( p_q, q_inv ) )
-    #print( p_q_rotated )
-    return p_q_rotated[1:]
+    return quaternion_rotations( p, [q_1, q_2, q_3, q_0] )
+
+def quaternion_rotations( p, q ):
+    'batched quaternion_rotation, for vectors p of shape (...,3) and quaternions q of shape (...,4) in FreeCADs order (q_1, q_2, q_3, q_0)'
+    p, q = numpy.asarray( p, dtype=float ), numpy.asarray( q, dtype=float )
+    q = numpy.concatenate( [ q[...,3:], q[...,:3] ], axis=-1 ) # q_0 first
+    q_inv = q * [ 1, -1, -1, -1 ]
+    p_q = numpy.concatenate( [ numpy.zeros( p.shape[:-1] + (1,) ), p ], axis=-1 ) #p as a quaternion
+    p_q_rotated = quaternion_products( q, quaternion_products( p_q, q_inv ) )
+    return p_q_rotated[...,1:]
 
 def euler_rotation(p, angle1, angle2, angle3, axis1=3, axis2=2, axis3=3 ):
     ''' http://en.wikipedia.org/wiki/Rotation_matrix ,
@@ -117,36 +130,83 @@ def euler_rotation(p, angle1, angle2, angle3, axis1=3, axis2=2, axis3=3 ):
 
 def euler_ZYX_rotation_matrix( angle1, angle2, angle3 ):
     ''' http://en.wikipedia.org/wiki/Rotation_matrix '''
+    return euler_ZYX_rotation_matrices( angle1, angle2, angle3 )
+
+def euler_ZYX_rotation_matrices( angle1, angle2, angle3 ):
+    'batched euler_ZYX_rotation_matrix, for angles of the same shape (or scalars); returns an array of that shape + (3,3)'
     c_1, s_1 = cos(angle1), sin(angle1)
     c_2, s_2 = cos(angle2), sin(angle2)
     c_3, s_3 = cos(angle3), sin(angle3)
-    return numpy.array( [
-        [ c_1*c_2 , c_1*s_2*s_3 - c_3*s_1 , s_1*s_3 + c_1*c_3*s_2 ],
-        [ c_2*s_1 , c_1*c_3 + s_1*s_2*s_3 , c_3*s_1*s_2 - c_1*s_3 ],
-        [ - s_2   , c_2*s_3 , c_2*c_3 ]
-    ])
+    R = numpy.empty( numpy.broadcast( angle1, angle2, angle3 ).shape + (3,3) )
+    R[...,0,0], R[...,0,1], R[...,0,2] = c_1*c_2 , c_1*s_2*s_3 - c_3*s_1 , s_1*s_3 + c_1*c_3*s_2
+    R[...,1,0], R[...,1,1], R[...,1,2] = c_2*s_1 , c_1*c_3 + s_1*s_2*s_3 , c_3*s_1*s_2 - c_1*s_3
+    R[...,2,0], R[...,2,1], R[...,2,2] = - s_2   , c_2*s_3 , c_2*c_3
+    return R
     
 def euler_ZYX_rotation(p, angle1, angle2, angle3 ):
     return dotProduct(euler_ZYX_rotation_matrix( angle1, angle2, angle3 ), p)
 
 def axis_rotation_matrix( theta, u_x, u_y, u_z ):
     ''' http://en.wikipedia.org/wiki/Rotation_matrix '''
-    return numpy.array( [
-            [ cos(theta) + u_x**2 * ( 1 - cos(theta)) , u_x*u_y*(1-cos(theta)) - u_z*sin(theta) ,  u_x*u_z*(1-cos(theta)) + u_y*sin(theta) ] ,
-            [ u_y*u_x*(1-cos(theta)) + u_z*sin(theta) , cos(theta) + u_y**2 * (1-cos(theta))    ,  u_y*u_z*(1-cos(theta)) - u_x*sin(theta )] ,
-            [ u_z*u_x*(1-cos(theta)) - u_y*sin(theta) , u_z*u_y*(1-cos(theta)) + u_x*sin(theta) ,              cos(theta) + u_z**2*(1-cos(theta))   ]
-            ])
+    return axis_rotation_matrices( theta, u_x, u_y, u_z )
+
+def axis_rotation_matrices( theta, u_x, u_y, u_z ):
+    'batched axis_rotation_matrix, for theta and axis components of the same shape (or scalars); returns an array of that shape + (3,3)'
+    c, s = cos(theta), sin(theta)
+    C = 1 - c
+    R = numpy.empty( numpy.broadcast( theta, u_x, u_y, u_z ).shape + (3,3) )
+    R[...,0,0], R[...,0,1], R[...,0,2] = c + u_x**2 * C   , u_x*u_y*C - u_z*s , u_x*u_z*C + u_y*s
+    R[...,1,0], R[...,1,1], R[...,1,2] = u_y*u_x*C + u_z*s , c + u_y**2 * C   , u_y*u_z*C - u_x*s
+    R[...,2,0], R[...,2,1], R[...,2,2] = u_z*u_x*C - u_y*s , u_z*u_y*C + u_x*s , c + u_z**2 * C
+    return R
 
 def axis_rotation( p, theta, u_x, u_y, u_z ):
     return dotProduct(axis_rotation_matrix( theta, u_x, u_y, u_z ), p)
 
 def azimuth_elevation_rotation_matrix(azi, ela, theta ):
     #print('azimuth_and_elevation_angles_to_axis(azi, ela) %s' % azimuth_and_elevation_angles_to_axis(azi, ela))
-    return axis_rotation_matrix( theta, *azimuth_and_elevation_angles_to_axis(azi, ela))
+    return azimuth_elevation_rotation_matrices( azi, ela, theta )
 
 def azimuth_elevation_rotation( p, azi, ela, theta ):
     return dotProduct(azimuth_elevation_rotation_matrix( azi, ela, theta ), p)
 
+def azimuth_elevation_rotation_matrices( azi, ela, theta ):
+    '''batched azimuth_elevation_rotation_matrix, for arrays azi, ela and theta of the same shape (i.e. length N); returns an array of that shape + (3,3)'''
+    return axis_rotation_matrices( theta, *azimuth_and_elevation_angles_to_axis( azi, ela ) )
+
+def azimuth_elevation_rotation_angles( R ):
+    '''
+    inverse of azimuth_elevation_rotation_matrix, returns azi, ela, theta.
+    arctan2 is used throughout so that the angles are accurate to machine precision, unlike rotation_matrix_axis_and_angle and axis_to_azimuth_and_elevation_angles,
+    where arccos and arcsin loose precision for small rotations and axes close to the z-axis.
+    '''
+    w = numpy.array([ R[2,1]-R[1,2], R[0,2]-R[2,0], R[1,0]-R[0,1] ]) # 2*sin(theta)*axis
+    s = 0.5 * norm(w)
+    c = 0.5 * ( R[0,0] + R[1,1] + R[2,2] - 1 )
+    if c >= 0:
+        if s == 0:
+            return 0.0, 0.0, 0.0
+        axis = w / (2*s)
+    else: #axis from the symmetric part, (R + R^T)/2 - c*I = (1-c)*outer(axis,axis), as w is inaccurate for theta close to pi
+        B = 0.5*( R + R.transpose() ) - c*numpy.eye(3)
+        k = numpy.argmax( numpy.diag(B) )
+        axis = B[:,k] / ( B[k,k] * (1-c) )**0.5
+        if dotProduct( axis, w ) < 0:
+            axis = -axis
+    return arctan2( axis[1], axis[0] ), arctan2( axis[2], ( axis[0]**2 + axis[1]**2 )**0.5 ), arctan2( s, c )
+
+def azimuth_elevation_angular_velocities( azi, ela, theta ):
+    '''
+    angular velocity vectors [ w_azi, w_ela, w_theta ] of azimuth_elevation_rotation_matrix( azi, ela, theta ),
+    for unit rates of change of azi, ela and theta respectively. i.e. dR/dazi = [w_azi]x R, where [w]x is the cross product matrix.
+    for R = axis_rotation_matrix( theta, *u ), w = dtheta*u + sin(theta)*du + (1 - cos(theta))*cross(u, du)
+    '''
+    u = azimuth_and_elevation_angles_to_axis( azi, ela )
+    du_dazi = numpy.array([ -cos(ela)*sin(azi), cos(ela)*cos(azi), 0 ])
+    du_dela = numpy.array([ -sin(ela)*cos(azi), -sin(ela)*sin(azi), cos(ela) ])
+    s, c = sin(theta), cos(theta)
+    return [ s*du + (1-c)*crossProduct(u, du) for du in [du_dazi, du_dela] ] + [ u ]
+
 def rotation_matrix_to_euler_ZYX(R, debug=False, checkAnswer=False, tol=10**-6, tol_XZ_same_axis=10**-9 ):
     'better way available at http://en.wikipedia.org/wiki/Rotation_formalisms_in_three_dimensions#Rotation_matrix_.E2.86.94_Euler_angles'
     if 1.0 - abs(R[2,0]) > tol_XZ_same_axis :
@@ -398,9 +458,9 @@ def distance_between_two_axes_3_points(p1,u1,p2,u2):
 def distance_between_axis_and_point( p1,u1,p2 ):
     assert numpy.linalg.norm( u1 ) != 0
     d = p2 - p1
-    offset = d - dotProduct(u1,d)*u1
+    offset = d - dotProducts(u1,d)[...,None]*u1 #[...,None] as to support stacks of vectors
     #print(norm(offset))
-    return norm(offset)
+    return dotProducts(offset, offset) ** 0.5
 
 def distance_between_axis_and_point_old( p1, u1, p2 ):
     assert numpy.linalg.norm( u1 ) != 0
@@ -421,7 +481,7 @@ def rotation_required_to_rotate_a_vector_to_be_aligned_to_another_vector( v, v_r
     else: #dont think this ever happens.
         axis, notUsed = plane_degrees_of_freedom( v )
     #if dof_axis == None:
-    angle = arccos2( dotProduct( v, v_ref ))
+    angle = arctan2( norm(c), dotProduct( v, v_ref )) #rather than arccos, which loses precision for small angles
     #else:
     #    axis3 = normalize ( crossProduct(v_ref, dof_axis) )
     #    a = dotProduct( v, v_ref ) #adjacent
@@ -597,6 +657,30 @@ if __name__ == '__main__':
             raise ValueError("norm(axis - axis_out) > 10**-12. \n  in:  axis %s \n  azimuth %f, elavation %f \n  out: axis %s" % (axis,a,e,axis_out))
 
 
+    print('\ntesting azimuth_elevation_rotation_matrices')
+    params = (rand(6,3) - 0.5)*2*pi
+    R_vectorized = azimuth_elevation_rotation_matrices( params[:,0], params[:,1], params[:,2] )
+    for R, p in zip(R_vectorized, params):
+        error = norm( R - azimuth_elevation_rotation_matrix( *p ) )
+        if error > 10**-12:
+            raise ValueError('azimuth_elevation_rotation_matrices check failed, params %s, error %e' % (p, error))
+    print('..passed')
+
+    print('\ntesting azimuth_elevation_angular_velocities against finite differences')
+    for i in range(6):
+        params = (rand(3) - 0.5)*2*pi
+        R = azimuth_elevation_rotation_matrix( *params )
+        for j, w in enumerate( azimuth_elevation_angular_velocities( *params ) ):
+            eps = 10**-7
+            params_c = params.copy()
+            params_c[j] = params_c[j] + eps
+            dR = ( azimuth_elevation_rotation_matrix( *params_c ) - R ) / eps
+            W = dotProduct( dR, R.transpose() ) # should be the cross product matrix of w
+            error = norm( numpy.array([ W[2,1], W[0,2], W[1,0] ]) - w )
+            if error > 10**-5:
+                raise ValueError('azimuth_elevation_angular_velocities check failed, params %s, j %i, error %e' % (params, j, error))
+    print('..passed')
+
     print('\nchecking distance_between_axes function')
     p1 = numpy.array( [0.0 , 0, 0 ] )
     u1 = numpy.array( [1.0 , 0, 0 ] )
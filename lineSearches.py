@@ -1,12 +1,21 @@
 
 import numpy, math
 from numpy.linalg import norm
+import solverTelemetry
 
 class LineSearchEvaluation:
-    def __init__(self, f, x, searchDirection, lam, fv=None):
+    def __init__(self, f, x, searchDirection, lam, fv=None, residual=False):
+        '''
+        if residual, f returns a residual vector which is stored as self.rv, and fv = norm(rv).
+        '''
         self.lam = lam
         self.xv = x + lam*searchDirection
-        self.fv = f(x + lam*searchDirection) if not fv else fv
+        fv = f(self.xv) if fv is None else fv
+        if residual:
+            self.rv = fv
+            self.fv = norm(fv)
+        else:
+            self.fv = fv
     def __lt__(self, b):
         return self.fv < b.fv
     def __eq__(self, b):
@@ -27,6 +36,7 @@ def goldenSectionSearch( f, x1, f1, intialStep, it, debugPrintLevel, printF, it_
     if debugPrintLevel > 0:
         printF('    goldenSection search it 0:  lam  %1.3f  %1.3f  %1.3f  %1.3f    f(lam)  %1.2e  %1.2e  %1.2e  %1.2e' % ( y1.lam, y2.lam, y3.lam, y4.lam, y1.fv, y2.fv, y3.fv, y4.fv))
     for k in range(it_min_at_x1):
+        solverTelemetry.count('lineSearchIterations')
         y_min = min([ y1, y2, y3, y4 ])
         if y_min == y2 or y_min == y1 :
             y4 = y3
@@ -46,24 +56,45 @@ def goldenSectionSearch( f, x1, f1, intialStep, it, debugPrintLevel, printF, it_
             break
     return min([ y1, y2, y3, y4 ]).xv
 
-def quadraticLineSearch( f, x1, f1, intialStep, it, debugPrintLevel, printF, tol_stag=3, tol_x=10**-6): 
+def parabolaMinimum( lams, fvs ):
+    '''
+    closed-form fit of the parabola a*lam**2 + b*lam + c through 3 points (equivalent to numpy.polyfit( lams, fvs, 2)).
+    returns lam at the turning point of the parabola, or None if the parabola is not convex or the lams are not distinct.
+    '''
+    l0, l1, l2 = lams
+    f0, f1, f2 = fvs
+    if l0 == l1 or l1 == l2 or l0 == l2:
+        return None
+    d01 = (f1 - f0) / (l1 - l0)
+    d02 = (f2 - f0) / (l2 - l0)
+    a = (d02 - d01) / (l2 - l1)
+    if not a > 0:
+        return None
+    b = d01 - a*(l0 + l1)
+    return -b / (2*a) #diff poly a*x**2 + b*x + c -> grad_poly = 2*a*x + b
+
+def quadraticLineSearch( f, x1, f1, intialStep, it, debugPrintLevel, printF, tol_stag=3, tol_x=10**-6, residual=False): 
+    '''
+    if residual, f returns the residual vector whose norm is minimized and f1 is the residual vector at x1.
+    The residual vector at the accepted point is then returned alongside it, i.e. x, f(x) = quadraticLineSearch( ..., residual=True )
+    so that the caller does not need to re-evaluate f.
+    '''
     if norm(intialStep) == 0:
         printF('    quadraticLineSearch: norm search direction is 0, aborting!')
-        return x1
+        return x1 if not residual else (x1, f1)
     def LSEval(lam, fv=None):
-        return LineSearchEvaluation( f,  x1, intialStep, lam, fv )
+        return LineSearchEvaluation( f,  x1, intialStep, lam, fv, residual )
     Y = [ LSEval(     0.0,  f1), LSEval(       1 ), LSEval(       2 )]
     y_min_prev = min(Y)
     count_stagnation = 0
     tol_lambda = tol_x / norm(intialStep)
     for k in range(it):
+        solverTelemetry.count('lineSearchIterations')
         Y.sort()
         if debugPrintLevel > 0:
             printF('    quadratic line search   it %i, fmin %1.2e, lam  %1.6f  %1.6f  %1.6f, f(lam) %1.2e  %1.2e  %1.2e'%( k+1, Y[0].fv, Y[0].lam,Y[1].lam,Y[2].lam,Y[0].fv,Y[1].fv,Y[2].fv ))
-        #``p[0]*x**(N-1) + p[1]*x**(N-2) + ... + p[N-2]*x + p[N-1]``
-        quadraticCoefs, residuals, rank, singular_values, rcond = numpy.polyfit( [y.lam for y in Y], [y.fv for y in Y], 2, full=True)
-        if quadraticCoefs[0] > 0 and rank == 3:
-            lam_c = -quadraticCoefs[1] / (2*quadraticCoefs[0]) #diff poly a*x**2 + b*x + c -> grad_poly = 2*a*x + b
+        lam_c = parabolaMinimum( [y.lam for y in Y], [y.fv for y in Y] )
+        if lam_c != None:
             lam_c = min( max( [y.lam for y in Y])*4, lam_c)
             if lam_c < 0:
                 if debugPrintLevel > 1:  printF('    quadratic line search lam_c < 0')
@@ -86,8 +117,8 @@ def quadraticLineSearch( f, x1, f1, intialStep, it, debugPrintLevel, printF, tol
         if max(Lam) - min(Lam) < tol_lambda:
             if debugPrintLevel > 0:  printF('    terminating quadratic max(Lam)-min(Lam) < tol_lambda (%e < %e)' % (max(Lam) - min(Lam), tol_lambda))
             break
-
-    return min(Y).xv
+    y_min = min(Y)
+    return y_min.xv if not residual else (y_min.xv, y_min.rv)
 
 
 if __name__ == '__main__':
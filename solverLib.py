@@ -2,6 +2,7 @@ import numpy
 from numpy.linalg import norm
 from numpy.random import rand
 from lineSearches import *
+import solverTelemetry
 
 def toStdOut(txt):
     print(txt)
@@ -50,47 +51,188 @@ def addEps( x, dim, eps):
     return y
 
 class GradientApproximatorForwardDifference:
-    def __init__(self, f):
+    def __init__(self, f, batch=False):
+        '''if batch, f is called once with the stack of perturbed x values (shape n,n) and should return the stack of f values'''
         self.f = f
+        self.batch = batch
     def __call__(self, x, eps=10**-7, f0=None):
         if hasattr(self.f,'addNote'): self.f.addNote('starting gradient approximation')
         n = len(x)
-        if f0 == None:
-            f0 = self.f(x)
+        if f0 is None:
+            f0 = self.f(x) if not self.batch else self.f(numpy.array([x]))[0]
         f0 = numpy.array(f0)
-        if f0.shape == () or f0.shape == (1,):
-            grad_f = numpy.zeros(n)
+        X_eps = x + eps*numpy.eye(n)
+        if self.batch:
+            F = numpy.array( self.f(X_eps) )
         else:
-            grad_f = numpy.zeros([n,len(f0)])
-        for i in range(n):
-            f_c = self.f( addEps(x,i,eps) )
-            grad_f[i] = (f_c - f0)/eps
+            F = numpy.array([ self.f(x_eps) for x_eps in X_eps ])
+        if f0.shape == (1,):
+            F = F.reshape(n)
+        grad_f = (F - f0)/eps
         if hasattr(self.f,'addNote'): self.f.addNote('finished gradient approximation')
         return grad_f.transpose()
 
+def nullSpaceParametrization( J, rel_tol=10**-6, abs_tol=0 ):
+    '''
+    rank revealing analysis of the Jacobian J (shape m,n) of a set of equations.
+    returns rank, pivots; where the rank is the number of singular values of J above max( rel_tol*largest singular value, abs_tol ), and pivots are the rank columns selected by a QR factorization with column pivoting.
+    The null space of J is then parametrized by the remaining columns, as for given values of the remaining columns the pivot columns can be solved for.
+    O( m*n*min(m,n) ) rather than solving the equations for each candidate parametrization.
+    '''
+    A = numpy.array( J, dtype=float, ndmin=2 )
+    s = numpy.linalg.svd( A, compute_uv=False )
+    if len(s) == 0 or not s[0] > 0:
+        return 0, []
+    rank = int( sum( s > max( s[0] * rel_tol, abs_tol ) ) )
+    pivots = []
+    for k in range(rank): #QR with column pivoting, via modified Gram-Schmidt
+        columnNorms = (A**2).sum(axis=0)
+        columnNorms[pivots] = -1
+        p = int( numpy.argmax( columnNorms ) )
+        pivots.append( p )
+        q = A[:,p] / norm( A[:,p] )
+        A = A - numpy.outer( q, numpy.dot( q, A ) )
+    return rank, pivots
+
 class GradientApproximatorCentralDifference:
-    def __init__(self, f):
+    def __init__(self, f, batch=False):
+        '''if batch, f is called once with the stack of perturbed x values (shape 2n,n) and should return the stack of f values'''
         self.f = f
+        self.batch = batch
     def __call__(self, x, eps=10**-6):
         n = len(x)
         if hasattr(self.f,'addNote'): self.f.addNote('starting gradient approximation')
-        grad_f = None
-        for i in range(n):
-            f_a = self.f( addEps(x,i, eps) )
-            f_b = self.f( addEps(x,i,-eps) )
-            if grad_f == None:
-                if f_a.shape == () or f_a.shape == (1,):
-                    grad_f = numpy.zeros(n)
-                else:
-                    grad_f = numpy.zeros([n,len(f_a)])
-            grad_f[i] = (f_a - f_b)/(2*eps)
+        X_eps = x + eps*numpy.vstack([ numpy.eye(n), -numpy.eye(n) ])
+        if self.batch:
+            F = numpy.array( self.f(X_eps) )
+        else:
+            F = numpy.array([ self.f(x_eps) for x_eps in X_eps ])
+        if F.shape == (2*n,1):
+            F = F.reshape(2*n)
+        grad_f = (F[:n] - F[n:])/(2*eps)
         if hasattr(self.f,'addNote'): self.f.addNote('finished gradient approximation')
         return grad_f.transpose()
 
+class SparseJacobian:
+    def __init__(self, shape, footprint):
+        '''
+        Jacobian stored as dense blocks, where footprint = [ (rows, cols), ... ] lists for each block its rows (a slice, blocks do not share rows)
+        and the columns (a list) which those rows depend on. All other entries are zero.
+        '''
+        self.shape = shape
+        self.footprint = [ (rows, list(cols)) for rows, cols in footprint ]
+        self.blocks = [ numpy.zeros([ rows.stop - rows.start, len(cols) ]) for rows, cols in self.footprint ]
+    def toarray(self):
+        A = numpy.zeros(self.shape)
+        for (rows, cols), B in zip( self.footprint, self.blocks ):
+            A[rows, cols] = B
+        return A
+    def dot(self, x):
+        y = numpy.zeros( self.shape[0] )
+        for (rows, cols), B in zip( self.footprint, self.blocks ):
+            y[rows] = numpy.dot( B, x[cols] )
+        return y
+    def transposeDot(self, y):
+        x = numpy.zeros( self.shape[1] )
+        for (rows, cols), B in zip( self.footprint, self.blocks ):
+            x[cols] += numpy.dot( B.transpose(), y[rows] )
+        return x
+    def triplets(self):
+        'returns the row index, column index and value of each stored entry, as 3 arrays'
+        if len(self.blocks) == 0:
+            return numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int), numpy.zeros(0)
+        I = numpy.hstack([ numpy.repeat( numpy.arange(rows.start, rows.stop), len(cols) ) for rows, cols in self.footprint ])
+        J = numpy.hstack([ numpy.tile( cols, rows.stop - rows.start ) for rows, cols in self.footprint ]).astype(int)
+        V = numpy.hstack([ B.ravel() for B in self.blocks ])
+        return I, J, V
+    def columnSquaredNorms(self):
+        'returns the diagonal of J^T J'
+        I, J, V = self.triplets()
+        return numpy.bincount( J, V**2, minlength=self.shape[1] )
+
+def solve_damped_least_squares( J, r, damping, tol=10**-10, maxIt=None ):
+    '''
+    returns the x which minimizes norm(J x - r)**2 + sum( damping * x**2 ) for the SparseJacobian J, without forming J^T J.
+    Solved using conjugate gradients on the least-squares problem (CGLS), with the columns scaled by the diagonal of J^T J + diag(damping),
+    so that each iteration costs a product with J and with J^T over the stored entries only.
+    '''
+    m, n = J.shape
+    I, K, V = J.triplets()
+    s = 1 / numpy.sqrt( numpy.bincount( K, V**2, minlength=n ) + damping )
+    V = V * s[K]
+    d = damping * s**2 #damping of the scaled variables z = x / s
+    z = numpy.zeros(n)
+    res = numpy.array( r, dtype=float )
+    g = numpy.bincount( K, V*res[I], minlength=n )
+    p = g.copy()
+    gamma = numpy.dot(g, g)
+    gamma_tol = tol**2 * gamma
+    for i in range( maxIt if maxIt != None else 2*n ):
+        if gamma <= gamma_tol:
+            break
+        q = numpy.bincount( I, V*p[K], minlength=m )
+        alpha = gamma / ( numpy.dot(q, q) + numpy.dot(p, d*p) )
+        z = z + alpha*p
+        res = res - alpha*q
+        g = numpy.bincount( K, V*res[I], minlength=n ) - d*z
+        gamma_new = numpy.dot(g, g)
+        p = g + gamma_new / gamma * p
+        gamma = gamma_new
+    return s * z
+
+def colourColumns( footprint, n ):
+    '''
+    greedy colouring of the n columns of a SparseJacobian with the given footprint, so that columns of the same colour never share a row.
+    returns the colour of each column.
+    '''
+    neighbours = [ set() for j in range(n) ]
+    for rows, cols in footprint:
+        for j in cols:
+            neighbours[j].update( cols )
+    colour = -numpy.ones( n, dtype=int )
+    for j in sorted( range(n), key=lambda j: -len(neighbours[j]) ):
+        used = set( colour[k] for k in neighbours[j] )
+        c = 0
+        while c in used:
+            c = c + 1
+        colour[j] = c
+    return colour
+
+class GradientApproximatorSparseCentralDifference:
+    def __init__(self, f, shape, footprint, batch=False):
+        '''
+        central difference approximation of a SparseJacobian. Columns which do not share any rows (see colourColumns) are perturbed together,
+        so that 2 evaluations of f are required per colour rather than 2 per column.
+        if batch, f is called once with the stack of perturbed x values.
+        '''
+        self.f = f
+        self.shape = shape
+        self.footprint = footprint
+        self.batch = batch
+        self.colour = colourColumns( footprint, shape[1] )
+        self.noColours = self.colour.max() + 1 if shape[1] > 0 else 0
+    def __call__(self, x, eps=10**-6):
+        n = len(x)
+        nc = self.noColours
+        P = numpy.zeros([ nc, n ])
+        P[ self.colour, range(n) ] = eps
+        X_eps = numpy.vstack([ x + P, x - P ])
+        if self.batch:
+            F = numpy.array( self.f(X_eps) )
+        else:
+            F = numpy.array([ self.f(x_eps) for x_eps in X_eps ])
+        D = ( F[:nc] - F[nc:] ) / (2*eps)
+        J = SparseJacobian( self.shape, self.footprint )
+        for (rows, cols), B in zip( J.footprint, J.blocks ):
+            B[:,:] = D[ self.colour[cols] ][:, rows].transpose()
+        return J
+
 def solve_via_Newtons_method( f_org, x0, maxStep, grad_f=None, x_tol=10**-6, f_tol=None, maxIt=100, randomPertubationCount=2, 
-                              debugPrintLevel=0, printF=toStdOut, lineSearchIt=5, record=False):
+                              debugPrintLevel=0, printF=toStdOut, lineSearchIt=5, record=False, broyden=False):
     '''
     determine the routes of a non-linear equation using netwons method.
+    if broyden, the Jacobian is kept between iterations using rank-one Broyden updates,
+    and only recomputed using grad_f when the previous step failed to reduce norm(f(x)).
     '''
     f = SearchAnalyticsWrapper(f_org) if record else f_org
     n = len(x0)
@@ -98,13 +240,16 @@ def solve_via_Newtons_method( f_org, x0, maxStep, grad_f=None, x_tol=10**-6, f_t
     x_c = numpy.zeros(n) * numpy.nan
     x_prev =  numpy.zeros( [ maxIt+1, n ] ) #used to check against cyclic behaviour, for randomPertubationCount
     x_prev[0,:] = x
-    if grad_f == None:
+    if grad_f is None:
         #grad_f = GradientApproximatorForwardDifference(f)
         grad_f = GradientApproximatorCentralDifference(f)
-    if lineSearchIt > 0:
-        f_ls = lambda x: norm(f(x))
+    A = None
+    f_x = None #f(x) if already evaluated by the line search
+    perturbed = False
     for i in range(maxIt):
-        b = numpy.array(-f(x))
+        solverTelemetry.count('newtonIterations')
+        b = numpy.array(-f(x)) if f_x is None else -f_x
+        f_x = None
         singleEq = b.shape == () or b.shape == (1,)
         if debugPrintLevel > 0:
             printF('it %02i: norm(prev. step) %1.1e norm(f(x))  %1.1e' % (i, norm(x_c), norm(-b)))
@@ -118,13 +263,25 @@ def solve_via_Newtons_method( f_org, x0, maxStep, grad_f=None, x_tol=10**-6, f_t
                 break
             elif singleEq==False and all( abs(b) < f_tol ):
                 break
-        if not isinstance( grad_f, GradientApproximatorForwardDifference):
-            A = grad_f(x)
+        if broyden and A is not None and not perturbed and norm(b) < norm(b_prev) and norm(x - x_it) > 0:
+            s_c = x - x_it
+            y_c = numpy.atleast_1d(b_prev - b) #f(x) - f(x_it)
+            A = A + numpy.outer( y_c - numpy.dot(A, s_c), s_c ) / numpy.dot(s_c, s_c)
+            solverTelemetry.count('broydenUpdates')
+            if debugPrintLevel > 1:
+                printF('  Broyden update of grad_f')
         else:
-            A = grad_f(x, f0=-b)
-        if len(A.shape) == 1: #singleEq
-            A = numpy.array([A])
-            b = numpy.array([b])
+            if not isinstance( grad_f, GradientApproximatorForwardDifference):
+                A = grad_f(x)
+            else:
+                A = grad_f(x, f0=-b)
+            solverTelemetry.count('gradientEvaluations')
+            if len(A.shape) == 1: #singleEq
+                A = numpy.array([A])
+        b_prev = b
+        x_it = x.copy()
+        perturbed = False
+        b = numpy.atleast_1d(b)
         try:
             x_c, residuals, rank, s = numpy.linalg.lstsq( A, b)
         except ValueError as e:
@@ -142,7 +299,8 @@ def solve_via_Newtons_method( f_org, x0, maxStep, grad_f=None, x_tol=10**-6, f_t
             x_c = x_c / r.max()
         if lineSearchIt > 0:
             #x_next = goldenSectionSearch( f_ls, x, norm(b), x_c, lineSearchIt, lineSearchIt_x0, debugPrintLevel, printF )
-            x_next =  quadraticLineSearch( f_ls, x, norm(b), x_c, lineSearchIt, debugPrintLevel-2, printF, tol_x=x_tol )
+            x_next, f_x =  quadraticLineSearch( f, x, -b, x_c, lineSearchIt, debugPrintLevel-2, printF, tol_x=x_tol, residual=True )
+            f_x = numpy.array(f_x)
             x_c = x_next - x
         x = x + x_c
         if randomPertubationCount > 0 : #then peturb as to avoid lock-up [i.e jam which occurs when trying to solve axis direction constraint]
@@ -154,10 +312,105 @@ def solve_via_Newtons_method( f_org, x0, maxStep, grad_f=None, x_tol=10**-6, f_t
                 x_p = (0.5 - rand(n)) * numpy.array(maxStep)* (1 - i*1.0/maxIt)
                 x = x + x_p
                 x_c = x_c + x_p
+                f_x = None
+                perturbed = True
                 randomPertubationCount = randomPertubationCount - 1
             x_prev[i,:] = x
     return x
 
+def solve_via_Levenberg_Marquardt( f_org, x0, maxStep, grad_f=None, x_tol=10**-6, f_tol=None, maxIt=100, 
+                                   debugPrintLevel=0, printF=toStdOut, record=False, damping0=10**-3, radius0=1.0, radiusMax=2.0, converged=None ):
+    '''
+    determine the routes of a non-linear equation using a damped least-squares (Levenberg-Marquardt) method with a trust-region.
+    The trust-region radius is measured in maxStep units, i.e. max(abs(x_c / maxStep)) <= radius.
+    Unlike solve_via_Newtons_method, no random pertubations are used, so the result is deterministic.
+    converged - optional stopping test converged(x), for when f_tol on the raw residuals is not the caller's acceptance test.
+    If grad_f returns a SparseJacobian, the damped steps are solved using solve_damped_least_squares rather than forming J^T J.
+    '''
+    f = SearchAnalyticsWrapper(f_org) if record else f_org
+    if grad_f is None:
+        grad_f = GradientApproximatorCentralDifference(f)
+    x = numpy.array(x0, dtype=float)
+    maxStep = numpy.array(maxStep, dtype=float)
+    f_x = numpy.atleast_1d( f(x) )
+    A = None
+    mu = None #damping
+    nu = 2
+    radius = radius0
+    x_c = numpy.zeros(len(x)) * numpy.nan
+    for i in range(maxIt):
+        solverTelemetry.count('levenbergMarquardtIterations')
+        if debugPrintLevel > 0:
+            printF('it %02i: norm(prev. step) %1.1e norm(f(x))  %1.1e damping %1.1e radius %1.1e' % (i, norm(x_c), norm(f_x), mu if mu != None else numpy.nan, radius))
+        if debugPrintLevel > 1:
+            printF('  x    %s' % x)
+            printF('  f(x) %s' % f_x)
+        if f_tol != None and all( abs(f_x) < f_tol ):
+            break
+        if converged != None and converged(x):
+            break
+        if A is None: #x changed, so update Jacobian
+            J = grad_f(x)
+            solverTelemetry.count('gradientEvaluations')
+            if isinstance( J, SparseJacobian ):
+                A = J
+                g = J.transposeDot( f_x )
+                diag_A = J.columnSquaredNorms()
+            else:
+                if len(J.shape) == 1: #singleEq
+                    J = numpy.array([J])
+                A = numpy.dot( J.transpose(), J )
+                g = numpy.dot( J.transpose(), f_x )
+                diag_A = numpy.diag(A)
+            D = numpy.maximum( diag_A, 10**-3 * max( diag_A.max(), 10**-12 ) )
+            if mu is None:
+                mu = damping0 * D.max()
+            if debugPrintLevel > 1:
+                printF('  grad_f :')
+                prettyPrintArray(J.toarray() if isinstance( J, SparseJacobian ) else J, printF, '    ')
+        if isinstance( A, SparseJacobian ):
+            x_c = solve_damped_least_squares( A, -f_x, mu*D )
+        else:
+            try:
+                x_c = numpy.linalg.solve( A + mu*numpy.diag(D), -g )
+            except numpy.linalg.LinAlgError:
+                mu = mu * nu
+                nu = 2 * nu
+                continue
+        r = abs(x_c / maxStep).max()
+        if r > radius:
+            x_c = x_c * radius / r
+        if norm(x_c) <= x_tol:
+            break
+        f_c = numpy.atleast_1d( f(x + x_c) )
+        if isinstance( A, SparseJacobian ):
+            Jx_c = A.dot(x_c)
+            predictedReduction = -2*numpy.dot(g, x_c) - numpy.dot(Jx_c, Jx_c)
+        else:
+            predictedReduction = -2*numpy.dot(g, x_c) - numpy.dot(x_c, numpy.dot(A, x_c))
+        actualReduction = numpy.dot(f_x, f_x) - numpy.dot(f_c, f_c)
+        rho = actualReduction / predictedReduction if predictedReduction > 0 else -1 #gain ratio
+        if debugPrintLevel > 1:
+            printF('  x_c    %s, gain ratio %1.2f' % (x_c, rho))
+        if rho > 0: #accept step
+            x = x + x_c
+            f_x = f_c
+            A = None
+            mu = mu * max( 1.0/3, 1 - (2*rho - 1)**3 )
+            nu = 2
+            if rho > 0.75:
+                radius = min( 2*radius, radiusMax )
+        else:
+            mu = mu * nu
+            nu = 2 * nu
+        if rho < 0.25:
+            radius = radius / 2
+        if radius < 10**-12 or mu > 10**16:
+            if debugPrintLevel > 0:
+                printF('  solve_via_Levenberg_Marquardt stalled, radius %1.1e damping %1.1e' % (radius, mu))
+            break
+    return x
+
 analytics = {}
 class SearchAnalyticsWrapper:
     def __init__(self, f):
@@ -246,6 +499,13 @@ if __name__ == '__main__':
         print('    grad_f(X) centralDiff.: %s' % grad_f_cd(X))
         print('  norm(analytical-randomPoints) %e' % norm(grad_f2(X) - grad_f_rp(X)) )
         
+    print('batched evaluation: f2 applied to a stack of X values')
+    f2_batch = lambda Xs: numpy.array([ f2(X) for X in Xs ])
+    for i in range(2):
+        X = rand(2)*10-5
+        print('  norm(centralDiff. - centralDiff. batched) %e' % norm( grad_f_cd(X) - GradientApproximatorCentralDifference(f2_batch, batch=True)(X) ))
+        print('  norm(forwardDiff. - forwardDiff. batched) %e' % norm( grad_f_fd(X) - GradientApproximatorForwardDifference(f2_batch, batch=True)(X, f0=f2(X)) ))
+
     print('now of a function which returns multiple values')
     grad_f_rp = GradientApproximatorRandomPoints(f1)
     grad_f_fd = GradientApproximatorForwardDifference(f1)
@@ -266,6 +526,28 @@ if __name__ == '__main__':
         print('  error rp %e' % norm(grad_f1(X) - grad_f_rp(X))) 
 
     xRoots = solve_via_Newtons_method(f2, rand(2)+3, maxStep, x_tol=0, debugPrintLevel=3, f_tol=10**-12)
+    print('and using Levenberg-Marquardt')
+    xRoots = solve_via_Levenberg_Marquardt(f1, rand(2)+3, maxStep, x_tol=0, debugPrintLevel=1, f_tol=10**-12)
+    print('  f1(xRoots) %s' % f1(xRoots))
+    print('SparseJacobian and GradientApproximatorSparseCentralDifference, on a function where each pair of outputs only depends on 2 of the inputs')
+    def f3(x):
+        return numpy.hstack([ [ x[i]*x[i+1] - 1, x[i]**2 + x[i+1] ] for i in range(0, len(x)-1, 2) ] + [ [ x[1]*x[2] ] ])
+    n = 8
+    footprint = [ (slice(i, i+2), [i, i+1]) for i in range(0, n, 2) ] + [ (slice(n, n+1), [1, 2]) ]
+    grad_f_sparse = GradientApproximatorSparseCentralDifference( f3, (n+1, n), footprint )
+    X = rand(n)
+    J = grad_f_sparse(X)
+    print('  number of colours %i, for %i columns' % (grad_f_sparse.noColours, n))
+    print('  norm(sparse - dense centralDiff.) %e' % norm( J.toarray() - GradientApproximatorCentralDifference(f3)(X) ))
+    y = rand(n+1)
+    print('  norm(J.transposeDot(y) - dot(J^T, y)) %e' % norm( J.transposeDot(y) - numpy.dot( J.toarray().transpose(), y ) ))
+    print('  norm(J.columnSquaredNorms() - diag(J^T J)) %e' % norm( J.columnSquaredNorms() - (J.toarray()**2).sum(axis=0) ))
+    D = rand(n)
+    x_dense = numpy.linalg.solve( numpy.dot( J.toarray().transpose(), J.toarray() ) + numpy.diag(D), numpy.dot( J.toarray().transpose(), y ) )
+    print('  norm(solve_damped_least_squares(J, y, D) - dense solve) %e' % norm( solve_damped_least_squares(J, y, D) - x_dense ))
+    print('and with Broyden updates of the Jacobian')
+    xRoots = solve_via_Newtons_method(f1, rand(2)+3, maxStep, x_tol=0, debugPrintLevel=2, f_tol=10**-12, broyden=True)
+    print('  f1(xRoots) %s' % f1(xRoots))
 
     print(analytics['lastSearch'])
     analytics['lastSearch'].plot()
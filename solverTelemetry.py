@@ -0,0 +1,77 @@
+'''
+Low-overhead counters and timers for the assembly 2 solver.
+
+solveConstraints calls start() at the beginning of each solve, after which the solver modules record to the active SolverTelemetry using count and addTime.
+The SolverTelemetry is then attached to the constraint system returned by solveConstraints (or to the Assembly2SolverError of the constraint which failed, see assembly2solver.addConstraints), i.e.
+
+>>> constraintSystem = solveConstraints( doc )
+>>> print( constraintSystem.telemetry.toJSON( indent=2 ) )
+
+counters
+  residualEvaluations, gradientEvaluations, newtonIterations, broydenUpdates, levenbergMarquardtIterations, lineSearchIterations, analyticalSolutions, numericalSolutions, continuationSteps, conflictPreChecks
+times (seconds)
+  unionClass - constraint system construction (including solving) time per ConstraintSystem label
+  constraint - per constraint object name
+'''
+
+import time, json
+
+class SolverTelemetry:
+    def __init__(self):
+        self.counters = {}
+        self.times = { 'unionClass':{}, 'constraint':{} }
+        self.t_start = time.time()
+        self.wallTime = None
+
+    def count(self, key, n=1):
+        self.counters[key] = self.counters.get(key, 0) + n
+
+    def addTime(self, category, name, t):
+        times = self.times.setdefault( category, {} )
+        if name in times:
+            times[name][0] = times[name][0] + 1
+            times[name][1] = times[name][1] + t
+        else:
+            times[name] = [1, t]
+
+    def finish(self):
+        self.wallTime = time.time() - self.t_start
+
+    def report(self):
+        'returns the telemetry as a dictionary of counters and times'
+        R = { 'counters': dict(self.counters), 'wallTime': self.wallTime }
+        for category, times in self.times.items():
+            R['time_per_%s' % category] = dict( ( name, { 'calls': calls, 'time': t } ) for name, (calls, t) in times.items() )
+        return R
+
+    def toJSON(self, **kwargs):
+        return json.dumps( self.report(), sort_keys=True, **kwargs )
+
+    def writeJSON(self, filename, indent=2):
+        f = open(filename, 'w')
+        f.write( self.toJSON( indent=indent ) )
+        f.close()
+
+    def __repr__(self):
+        return '<SolverTelemetry wallTime %s, counters %s>' % ( '%3.2fs' % self.wallTime if self.wallTime != None else 'n/a', self.counters )
+
+active = SolverTelemetry()
+
+def start():
+    'start a new SolverTelemetry, to which count and addTime record'
+    global active
+    active = SolverTelemetry()
+    return active
+
+def activate(telemetry):
+    'makes telemetry the SolverTelemetry to which count and addTime record, i.e. for a sub-solve recorded separately. returns the previously active SolverTelemetry, to be re-activated afterwards'
+    global active
+    previous = active
+    active = telemetry
+    return previous
+
+def count(key, n=1):
+    active.count(key, n)
+
+def addTime(category, name, t):
+    active.addTime(category, name, t)
@@ -35,7 +35,7 @@ Vector (-0.9991351502732795, 0.0, -0.04158066243329049)
 
 from lib3D import *
 import numpy
-from assembly2lib import debugPrint
+from assembly2lib import debugPrint, getSubElementPos, getSubElementAxis
 
 
 class VariableManager:
@@ -43,8 +43,10 @@ class VariableManager:
         self.doc = doc
         self.index = {}
         X = []
+        Q = [] #placements as read, see updateFreeCADValues
         if objectNames == None:
             objectNames = [obj.Name for obj in doc.Objects if hasattr(obj,'Placement')]
+        self.objectNames = list( objectNames ) #in the order of their placement variables in X
         for objectName in objectNames:
             self.index[objectName] = len(X)
             obj = doc.getObject(objectName)
@@ -55,47 +57,180 @@ class VariableManager:
             else:
                 azi, ela = 0, 0
             X = X + [ x, y, z, azi, ela, theta]
+            Q.append( obj.Placement.Rotation.Q )
         self.X0 = numpy.array(X)
+        self.writtenBases = self.X0.reshape( -1, 6 )[:,:3].copy()
+        self.writtenQ = numpy.array( Q, dtype=float ).reshape( -1, 4 )
         self.X = self.X0.copy()
+        self.rotationMatrices = {} #objectName : ( rotation variables, rotation matrix ), see rotationMatrix
 
     def updateFreeCADValues(self, X, tol_base = 10.0**-8, tol_rotation = 10**-6):
-        for objectName in self.index.keys():
-            i = self.index[objectName]
-            obj = self.doc.getObject(objectName)
-            #obj.Placement.Base.x = X[i]
-            #obj.Placement.Base.y = X[i+1]
-            #obj.Placement.Base.z = X[i+2]
-            if norm( numpy.array(obj.Placement.Base) - X[i:i+3] ) > tol_base: #for speed considerations only update placement variables if change in values occurs
-                obj.Placement.Base = tuple( X[i:i+3] )
-            azi, ela, theta =  X[i+3:i+6]
-            axis = azimuth_and_elevation_angles_to_axis( azi, ela )
-            new_Q = quaternion( theta, *axis ) #tuple type
-            if norm( numpy.array(obj.Placement.Rotation.Q) - numpy.array(new_Q)) > tol_rotation:
-                obj.Placement.Rotation.Q = new_Q
+        '''
+        writes the placement variables X to the FreeCAD objects.
+        The bases and quaternions of all objects are computed in a single pass, and compared against the placements last written (or read in __init__),
+        so that only the objects which moved are touched (i.e. a few property sets per animation frame).
+        Placements changed outside of the variableManager after it was created are therefore not detected, unless invalidateWritten is called.
+        '''
+        X = numpy.asarray( X ).reshape( -1, 6 )
+        bases = X[:,:3]
+        axes = azimuth_and_elevation_angles_to_axis( X[:,3], X[:,4] )
+        Q = numpy.array( quaternion( X[:,5], *axes ) ).transpose()
+        moveBase = norm( bases - self.writtenBases, axis=1 ) > tol_base #for speed considerations only update placement variables if change in values occurs
+        moveRotation = norm( Q - self.writtenQ, axis=1 ) > tol_rotation
+        for j in numpy.flatnonzero( moveBase | moveRotation ):
+            obj = self.doc.getObject( self.objectNames[j] )
+            if moveBase[j]:
+                obj.Placement.Base = tuple( bases[j] )
+                self.writtenBases[j] = bases[j]
+            if moveRotation[j]:
+                obj.Placement.Rotation.Q = tuple( Q[j] )
+                self.writtenQ[j] = Q[j]
+
+    def invalidateWritten( self, objectNames=None ):
+        '''
+        forgets the placements last written for objectNames (all objects if None), so that they are written by the next updateFreeCADValues.
+        For placements which may have been changed outside of the variableManager (i.e. by the user or another command) since it was created.
+        '''
+        if objectNames == None:
+            objectNames = self.objectNames
+        for objectName in objectNames:
+            j = self.objectNames.index( objectName )
+            self.writtenBases[j] = numpy.inf
+            self.writtenQ[j] = numpy.inf
+
+    def rotationMatrix( self, objectName, X ):
+        '''
+        rotation matrix of objectNames placement variables defined in X (not a stack).
+        Cached per object, and only rebuilt when the objects rotation variables differ from those of the cached matrix,
+        as the same objects matrix is otherwise rebuilt by every union involving the object during each constraint equation evaluation.
+        The inverse rotation is the transpose of the cached matrix.
+        '''
+        i = self.index[objectName]
+        key = ( X[i+3], X[i+4], X[i+5] )
+        cached = self.rotationMatrices.get( objectName )
+        if cached == None or cached[0] != key:
+            cached = ( key, azimuth_elevation_rotation_matrix( *key ) )
+            self.rotationMatrices[objectName] = cached
+        return cached[1]
 
     def bounds(self):
         return [ [ -inf, inf], [ -inf, inf], [ -inf, inf], [-pi,pi], [-pi,pi], [-pi,pi] ] * len(self.index)
 
     def rotate(self, objectName, p, X):
-        'rotate a vector p by objectNames placement variables defined in X'
+        'rotate a vector p by objectNames placement variables defined in X. X can also be a stack of variable vectors (shape k,n), in which case an array of shape (k,3) is returned'
         i = self.index[objectName]
-        return azimuth_elevation_rotation( p, *X[i+3:i+6])
+        if X.ndim == 2:
+            R = azimuth_elevation_rotation_matrices( X[:,i+3], X[:,i+4], X[:,i+5] )
+            return numpy.einsum( 'kij,j->ki', R, p )
+        return dotProduct( self.rotationMatrix( objectName, X ), p )
 
     def rotateUndo( self, objectName, p, X):
-        i = self.index[objectName]
-        R = azimuth_elevation_rotation_matrix(*X[i+3:i+6])
-        return numpy.linalg.solve(R,p)
+        return dotProduct( self.rotationMatrix( objectName, X ).transpose(), p )
 
     def rotateAndMove( self, objectName, p, X):
         'rotate the vector p by objectNames placement rotation and then move using objectNames placement'
         i = self.index[objectName]
-        return azimuth_elevation_rotation( p, *X[i+3:i+6]) + X[i:i+3]
+        if X.ndim == 2:
+            return self.rotate( objectName, p, X ) + X[:,i:i+3]
+        return dotProduct( self.rotationMatrix( objectName, X ), p ) + X[i:i+3]
 
     def rotateAndMoveUndo( self, objectName, p, X): # or un(rotate_and_then_move) #synomyn to get co-ordinates relative to objects placement variables.
         i = self.index[objectName]
         v = numpy.array(p) - X[i:i+3]
-        R = azimuth_elevation_rotation_matrix(*X[i+3:i+6])
-        return numpy.linalg.solve(R,v)
+        return dotProduct( self.rotationMatrix( objectName, X ).transpose(), v )
+
+    def objectIndices( self, objectNames ):
+        'per-row object indices for the *Many transforms, i.e. the index of each objects placement variables in X'
+        return numpy.array([ self.index[objectName] for objectName in objectNames ], dtype=int)
+
+    def rotationMatrixStack( self, objectIndices, X ):
+        'rotation matrices of shape (k,3,3) for the object indices (see objectIndices), built once per distinct object'
+        I = numpy.asarray( objectIndices, dtype=int )
+        U, inverse = numpy.unique( I, return_inverse=True )
+        return azimuth_elevation_rotation_matrices( X[U+3], X[U+4], X[U+5] )[ inverse ]
+
+    def rotateMany( self, objectIndices, P, X ):
+        'rotate each row of P (shape k,3) by the placement variables in X of the object on that row, using a single einsum'
+        return numpy.einsum( 'kij,kj->ki', self.rotationMatrixStack( objectIndices, X ), P )
+
+    def rotateUndoMany( self, objectIndices, P, X ):
+        return numpy.einsum( 'kji,kj->ki', self.rotationMatrixStack( objectIndices, X ), P )
+
+    def rotateAndMoveMany( self, objectIndices, P, X ):
+        I = numpy.asarray( objectIndices, dtype=int )
+        return self.rotateMany( I, P, X ) + X[ I[:,None] + numpy.arange(3) ]
+
+    def rotateAndMoveUndoMany( self, objectIndices, P, X ):
+        I = numpy.asarray( objectIndices, dtype=int )
+        return self.rotateUndoMany( I, numpy.asarray(P) - X[ I[:,None] + numpy.arange(3) ], X )
+
+
+class SubElementTable:
+    '''
+    positions and axes of the subelements referenced by the constraint objects, relative to their objects placements in X0 (see rotateAndMoveUndo and rotateUndo).
+    Built once per solve, so that the shape queries are done once per subelement rather than by each union built from a constraint (i.e. axial -> AxisAlignmentUnion, AxisDistanceUnion, ...).
+    Rows of pos_r and axis_r are indexed by self.index[ (objName, subElement) ]; a row which could not be determined is nan, and the error is raised when that row is requested.
+    If constraintUnions is given (see constraintSystems.constraintUnions), axes are only queried for the subelements whose unions use them (see ConstraintSystemPrototype.subElementAxes),
+    the axes of the other subelements are queried when first requested.
+    '''
+    def __init__(self, variableManager, constraintObjs, constraintUnions=None):
+        vM = variableManager
+        self.variableManager = vM
+        self.index = {}
+        axisRequired = []
+        for c in constraintObjs:
+            if constraintUnions != None:
+                required = [ any( U.subElementAxes[j] for U, constraintValue in constraintUnions(c) ) for j in [0,1] ]
+            else:
+                required = [ True, True ]
+            for (objName, subElement), r in zip( [ (c.Object1, c.SubElement1), (c.Object2, c.SubElement2) ], required ):
+                if objName in vM.index:
+                    if not (objName, subElement) in self.index:
+                        self.index[ (objName, subElement) ] = len(self.index)
+                        axisRequired.append( r )
+                    elif r:
+                        axisRequired[ self.index[ (objName, subElement) ] ] = True
+        self.pos_r = numpy.zeros([ len(self.index), 3 ]) * numpy.nan
+        self.axis_r = numpy.zeros([ len(self.index), 3 ]) * numpy.nan
+        self.axisQueried = numpy.array( axisRequired, dtype=bool )
+        self.errors = {}
+        objectIndices = numpy.zeros( len(self.index), dtype=int )
+        for (objName, subElement), k in self.index.items():
+            obj = vM.doc.getObject( objName )
+            objectIndices[k] = vM.index[objName]
+            for table, getSubElementValue in [ (self.pos_r, getSubElementPos), (self.axis_r, getSubElementAxis) ]:
+                if table is self.axis_r and not self.axisQueried[k]:
+                    continue
+                try:
+                    table[k] = getSubElementValue( obj, subElement )
+                except Exception as e: #i.e. axis of a vertex, only an error if the union requires it
+                    self.errors[ (table is self.axis_r, k) ] = e
+        if len(self.index) > 0: #all rows transformed at once, failed queries stay nan
+            self.pos_r = vM.rotateAndMoveUndoMany( objectIndices, self.pos_r, vM.X0 )
+            self.axis_r = vM.rotateUndoMany( objectIndices, self.axis_r, vM.X0 )
+        debugPrint(4, 'SubElementTable: %i subelements, %i axes queried, %i queries failed' % ( len(self.index), self.axisQueried.sum(), len(self.errors) ) )
+
+    def hasSubElement( self, objName, subElement ):
+        return (objName, subElement) in self.index
+
+    def lookup( self, table, objName, subElement ):
+        k = self.index[ (objName, subElement) ]
+        if table is self.axis_r and not self.axisQueried[k]:
+            vM = self.variableManager
+            self.axisQueried[k] = True
+            try:
+                self.axis_r[k] = vM.rotateUndo( objName, getSubElementAxis( vM.doc.getObject( objName ), subElement ), vM.X0 )
+            except Exception as e:
+                self.errors[ (True, k) ] = e
+        if (table is self.axis_r, k) in self.errors:
+            raise self.errors[ (table is self.axis_r, k) ]
+        return table[k].copy()
+
+    def pos( self, objName, subElement ):
+        return self.lookup( self.pos_r, objName, subElement )
+
+    def axis( self, objName, subElement ):
+        return self.lookup( self.axis_r, objName, subElement )
 
 
 class ReversePlacementTransformWithBoundsNormalization:
@@ -110,24 +245,21 @@ class ReversePlacementTransformWithBoundsNormalization:
         self.R = azimuth_elevation_rotation_matrix( azi, ela, theta ) #placement rotation
         #now for bounds normalization
         #V = [ self.undoPlacement(v.Point) for v in obj.Shape.Vertexes] #no nessary in BoundBox is now used.
-        V = [] 
         BB = obj.Shape.BoundBox
-        extraPoints = []
-        for z in [ BB.ZMin, BB.ZMax ]:
-            for y in [ BB.YMin, BB.YMax ]:
-                for x in [ BB.XMin, BB.XMax ] :
-                    V.append( self.undoPlacement([x,y,z]) )
-        V = numpy.array(V)
+        V = numpy.array([ [x,y,z] for z in [ BB.ZMin, BB.ZMax ] for y in [ BB.YMin, BB.YMax ] for x in [ BB.XMin, BB.XMax ] ])
+        V = self.undoPlacement( V )
         self.Bmin = V.min(axis=0)
         self.Bmax = V.max(axis=0)
         self.dB = self.Bmax - self.Bmin
 
     def undoPlacement(self, p):
+        'p can also be an array of points of shape (k,3)'
         # p = R*q + offset
-        return numpy.linalg.solve( self.R, numpy.array(p) - self.offset )
+        return self.unRotate( numpy.array(p) - self.offset )
     
     def unRotate(self, p):
-        return numpy.linalg.solve( self.R, p)
+        'p can also be an array of vectors of shape (k,3)'
+        return numpy.dot( p, self.R ) # R.transpose() * p, for each row of p
 
     def __call__( self, p):
         q = self.undoPlacement(p)